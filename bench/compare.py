@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares two result files of wiggleDB_bench.py, benchmark by benchmark:
+#
+#	bench/compare.py before.json after.json --threshold 0.1
+#
+# Exits with status 1 if any benchmark got slower by more than the
+# threshold (a fraction of the earlier time).
+
+import sys
+import json
+import argparse
+
+def get_options():
+	parser = argparse.ArgumentParser(description='Compare WiggleDB benchmark results.')
+	parser.add_argument('before',help='Earlier result file')
+	parser.add_argument('after',help='Later result file')
+	parser.add_argument('--statistic','-s',dest='statistic',help='Statistic to compare',choices=['mean','median','p95','min','max','total'],default='median')
+	parser.add_argument('--threshold','-t',dest='threshold',help='Relative slowdown reported as a regression',type=float,default=0.1)
+	return parser.parse_args()
+
+def load_results(filename):
+	report = json.load(open(filename))
+	return report['meta'], dict(((X['benchmark'], X['rows']), X) for X in report['results'])
+
+def main():
+	options = get_options()
+	meta_before, before = load_results(options.before)
+	meta_after, after = load_results(options.after)
+	if meta_before['options'] != meta_after['options']:
+		print >>sys.stderr, 'Warning: the runs used different options'
+
+	regressions = 0
+	print "\t".join(['benchmark', 'rows', 'before', 'after', 'change'])
+	for key in sorted(set(before) | set(after), key=lambda X: (X[1], X[0])):
+		if key not in before or key not in after:
+			print "\t".join([key[0], str(key[1]), 'missing' if key not in before else '', 'missing' if key not in after else ''])
+			continue
+		old = before[key][options.statistic]
+		new = after[key][options.statistic]
+		if old > 0:
+			change = (new - old) / old
+		else:
+			change = 0
+		flag = ''
+		if change > options.threshold:
+			flag = '\tREGRESSION'
+			regressions += 1
+		elif change < -options.threshold:
+			flag = '\tfaster'
+		print '%s\t%i\t%.6f\t%.6f\t%+.1f%%%s' % (key[0], key[1], old, new, change * 100, flag)
+
+	if regressions > 0:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks of the database and cache code, on synthetic catalogues and
+# job histories. The batch system and wiggletools are replaced by the stubs
+# in bench/stubs, so that runs only measure WiggleDB itself and can be
+# repeated on any machine:
+#
+#	bench/wiggleDB_bench.py --rows 1000 10000 100000 --output before.json
+#	(change the code)
+#	bench/wiggleDB_bench.py --rows 1000 10000 100000 --output after.json
+#	bench/compare.py before.json after.json
+#
+# Every catalogue size is benchmarked in a fresh database:
+#	- load: wiggleDB.py --load, through the command line as in production
+#	- facet_index: first build of the in-memory facet index
+#	- count_facets, count_sql: selection counts, with and without the index
+#	- count_facets_cached: the same selections again, whose facet counts
+#	are remembered by the index
+#	- request_compute_new, request_compute_cached: submission of new
+#	queries, then of the same queries again. The number of queries which
+#	launched a job is reported as 'launched'.
+#	- query_result: status of the jobs launched above
+#	- clean_database: cleaning of the synthetic history
+# Synthetic catalogues and histories only depend on the options and --seed.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import sqlite3
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIRECTORY = os.path.join(os.path.dirname(BENCH_DIRECTORY), 'python')
+sys.path.insert(0, PYTHON_DIRECTORY)
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_facets
+import wiggledb.wiggleDB_gc
+import wiggledb.wiggleDB_sqlite
+
+JOB_STATUSES = [('DONE', 0.7), ('EMPTY', 0.05), ('ERROR', 0.1), ('CANCELLED', 0.05), ('LAUNCHED', 0.1)]
+
+###########################################
+## Command line interface
+###########################################
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB benchmarks.')
+	parser.add_argument('--rows','-r',dest='rows',help='Catalogue sizes',type=int,nargs='+',default=[1000, 10000, 100000])
+	parser.add_argument('--attributes',dest='attributes',help='Number of attribute columns',type=int,default=4)
+	parser.add_argument('--cardinality',dest='cardinality',help='Number of distinct values of each attribute, cycled over the attributes',type=int,nargs='+',default=[10, 100])
+	parser.add_argument('--assemblies',dest='assemblies',help='Number of assemblies',type=int,default=2)
+	parser.add_argument('--history',dest='history',help='Number of jobs in the synthetic history',type=int,default=10000)
+	parser.add_argument('--queries','-q',dest='queries',help='Number of calls per latency benchmark',type=int,default=50)
+	parser.add_argument('--batch_system',dest='batch_system',help='Batch system to submit to (through the stubs)',choices=['SGE','LSF','local'],default='SGE')
+	parser.add_argument('--seed',dest='seed',help='Random seed',type=int,default=0)
+	parser.add_argument('--output','-o',dest='output',help='JSON result file',default='bench.json')
+	parser.add_argument('--workdir',dest='workdir',help='Directory for the databases and catalogues (default: temporary)')
+	parser.add_argument('--keep',dest='keep',help='Do not delete the working directory',action='store_true')
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	return parser.parse_args()
+
+###########################################
+## Synthetic data
+###########################################
+
+def attribute_names(options):
+	return ['attr%i' % X for X in range(options.attributes)]
+
+def cardinality(options, index):
+	return options.cardinality[index % len(options.cardinality)]
+
+def write_catalogue(filename, rows, options, rng):
+	out = open(filename, 'w')
+	out.write("\t".join(['location', 'name', 'type', 'annotation', 'assembly'] + attribute_names(options)) + "\n")
+	for row in range(rows):
+		if rng.random() < 0.2:
+			type, suffix = 'regions', '.bb'
+		else:
+			type, suffix = 'signal', '.bw'
+		annotation = 'TRUE' if rng.random() < 0.05 else 'FALSE'
+		values = ['v%i' % rng.randrange(cardinality(options, X)) for X in range(options.attributes)]
+		out.write("\t".join(['/bench/data/file%i%s' % (row, suffix), 'dataset%i' % row, type, annotation, 'assembly%i' % (row % options.assemblies)] + values) + "\n")
+	out.close()
+
+def write_chrom_sizes(filename):
+	out = open(filename, 'w')
+	for chrom in range(1, 23):
+		out.write('%i\t%i\n' % (chrom, 250000000 - chrom * 5000000))
+	out.close()
+
+def signal_rows(cursor, options):
+	return cursor.execute('SELECT assembly, %s FROM datasets WHERE type = "signal" ORDER BY location' % ", ".join(attribute_names(options))).fetchall()
+
+def random_selection(rows, options, rng):
+	# One or two attribute constraints, on signal files, taken from an
+	# existing dataset so that every selection matches at least one file
+	row = rng.choice(rows)
+	attributes = rng.sample(range(options.attributes), min(options.attributes, rng.randint(1, 2)))
+	params = dict((attribute_names(options)[X], [row[X + 1]]) for X in attributes)
+	params['type'] = ['signal']
+	return params, row[0]
+
+def weighted_choice(choices, rng):
+	point = rng.random()
+	for value, weight in choices:
+		point -= weight
+		if point < 0:
+			return value
+	return choices[-1][0]
+
+def insert_history(cursor, jobs, workdir, rng):
+	# Past jobs with one to three cache entries each, last queried up to
+	# 60 days ago. Result files do not exist, so cleaning only measures the
+	# database work.
+	for index in range(jobs):
+		status = weighted_choice(JOB_STATUSES, rng)
+		cursor.execute('INSERT INTO jobs (lsf_id, lsf_id2, temp, status, submitted) VALUES (?, ?, ?, ?, datetime(\'now\', ?))', (index, index, os.path.join(workdir, 'missing_temp%i' % index), status, '-%i days' % rng.randrange(60)))
+		jobID = cursor.lastrowid
+		for entry in range(rng.randint(1, 3)):
+			query = 'history %i %i' % (index, entry)
+			cursor.execute('INSERT INTO cache (job_id, query, query_hash, location, remember, primary_loc, last_query, size, hits) VALUES (?, ?, ?, ?, 0, ?, datetime(\'now\', ?), ?, ?)', (jobID, query, wiggledb.wiggleDB.query_digest(query), os.path.join(workdir, 'missing%i_%i.bw' % (index, entry)), int(entry == 0), '-%f days' % (rng.random() * 60), rng.randrange(1 << 30), rng.randrange(10)))
+
+###########################################
+## Measurements
+###########################################
+
+class BenchOptions(object):
+	# Same attributes as the options of the web servers
+	def __init__(self, db, workdir, assembly, params):
+		self.assembly = assembly
+		self.wa = 'sum'
+		self.wb = None
+		self.a = params
+		self.b = None
+		self.fun_merge = None
+		self.working_directory = workdir
+		self.s3 = None
+		self.dry_run = False
+		self.remember = False
+		self.db = db
+		self.config = None
+		self.emails = None
+
+def statistics(samples):
+	samples = sorted(samples)
+	count = len(samples)
+	return {
+		'count': count,
+		'total': sum(samples),
+		'mean': sum(samples) / count,
+		'median': samples[count // 2],
+		'p95': samples[min(count - 1, int(count * 0.95))],
+		'min': samples[0],
+		'max': samples[-1]
+	}
+
+def count_facets(cursor, params, assembly):
+	# As served by wiggleWSGI.py, including the catalogue version check
+	return wiggledb.wiggleDB_facets.get_facet_index(cursor).counts(params, assembly)
+
+def timed_call(function, *args):
+	start = time.time()
+	res = function(*args)
+	return time.time() - start, res
+
+def benchmark_size(rows, options, workdir, rng):
+	res = dict()
+	def record(name, samples, **extra):
+		res[name] = statistics(samples)
+		res[name].update(extra)
+		if options.verbose:
+			print '%i\t%s\t%s' % (rows, name, json.dumps(res[name], sort_keys=True))
+			sys.stdout.flush()
+
+	directory = os.path.join(workdir, str(rows))
+	os.makedirs(directory)
+	db = os.path.join(directory, 'bench.sqlite3')
+	catalogue = os.path.join(directory, 'datasets.tsv')
+	chrom_sizes = os.path.join(directory, 'chrom.sizes')
+	write_catalogue(catalogue, rows, options, rng)
+	write_chrom_sizes(chrom_sizes)
+
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join([PYTHON_DIRECTORY, env.get('PYTHONPATH', '')])
+	cmd = [sys.executable, os.path.join(PYTHON_DIRECTORY, 'wiggledb', 'wiggleDB.py'), '--db', db, '--load', catalogue]
+	start = time.time()
+	assert subprocess.call(cmd, env=env) == 0, 'Failed to load %s' % catalogue
+	record('load', [time.time() - start])
+
+	conn = wiggledb.wiggleDB_sqlite.connect(db)
+	cursor = conn.cursor()
+	for index in range(options.assemblies):
+		wiggledb.wiggleDB.load_assembly(cursor, 'assembly%i' % index, chrom_sizes)
+	conn.commit()
+
+	signals = signal_rows(cursor, options)
+	assert len(signals) > 0, 'No signal datasets in the catalogue'
+	selections = [random_selection(signals, options, rng) for X in range(options.queries)]
+
+	wiggledb.wiggleDB_facets.index = None
+	record('facet_index', [timed_call(wiggledb.wiggleDB_facets.get_facet_index, cursor)[0]])
+	record('count_facets', [timed_call(count_facets, cursor, params, assembly)[0] for params, assembly in selections])
+	record('count_facets_cached', [timed_call(count_facets, cursor, params, assembly)[0] for params, assembly in selections])
+	record('count_sql', [timed_call(wiggledb.wiggleDB.get_dataset_locations, cursor, params, assembly)[0] for params, assembly in selections])
+
+	insert_history(cursor, options.history, directory, rng)
+	conn.commit()
+
+	config = {'working_directory': directory, 'database_location': db, 'batch_system': options.batch_system}
+	jobs = []
+	for cached in (False, True):
+		samples = []
+		for params, assembly in selections:
+			bench_options = BenchOptions(db, directory, assembly, params)
+			elapsed, result = timed_call(wiggledb.wiggleDB.request_compute, conn, cursor, bench_options, config, options.batch_system)
+			conn.commit()
+			samples.append(elapsed)
+			if not cached and result.get('status') == 'LAUNCHED':
+				jobs.append(result['ID'])
+		if cached:
+			record('request_compute_cached', samples)
+		else:
+			# Otherwise the timings are those of the early returns
+			assert len(jobs) > 0, 'None of the queries launched a job'
+			record('request_compute_new', samples, launched=len(jobs))
+
+	if len(jobs) > 0:
+		record('query_result', [timed_call(wiggledb.wiggleDB.query_result, cursor, X, options.batch_system)[0] for X in jobs])
+	conn.commit()
+
+	elapsed, ignore = timed_call(wiggledb.wiggleDB_gc.collect_garbage, conn, 30)
+	record('clean_database', [elapsed])
+	conn.close()
+	return res
+
+###########################################
+## Main
+###########################################
+
+def git_commit():
+	try:
+		p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		stdout, stderr = p.communicate()
+		if p.returncode == 0:
+			return stdout.strip()
+	except OSError:
+		pass
+	return None
+
+def main():
+	options = get_options()
+	os.environ['PATH'] = os.pathsep.join([os.path.join(BENCH_DIRECTORY, 'stubs'), os.environ.get('PATH', '')])
+	if options.workdir is None:
+		workdir = tempfile.mkdtemp(prefix='wiggleDB_bench')
+	else:
+		workdir = options.workdir
+		if not os.path.exists(workdir):
+			os.makedirs(workdir)
+
+	results = []
+	try:
+		for rows in options.rows:
+			# Each size gets the same random sequence, whatever the others
+			rng = random.Random('%i %i' % (options.seed, rows))
+			for name, stats in sorted(benchmark_size(rows, options, workdir, rng).items()):
+				stats.update({'benchmark': name, 'rows': rows})
+				results.append(stats)
+	finally:
+		if not options.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	report = {
+		'meta': {
+			'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'commit': git_commit(),
+			'python': platform.python_version(),
+			'sqlite': sqlite3.sqlite_version,
+			'platform': platform.platform(),
+			'options': dict((X, Y) for X, Y in vars(options).items() if X not in ('output', 'workdir', 'keep', 'verbose'))
+		},
+		'results': results
+	}
+	out = open(options.output, 'w')
+	json.dump(report, out, indent=1, sort_keys=True)
+	out.close()
+
+if __name__ == "__main__":
+	main()
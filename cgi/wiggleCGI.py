@@ -21,12 +21,16 @@ import json
 import sqlite3
 import re
 import wiggledb.wiggleDB
+import wiggledb.wiggleDB_facets
+import wiggledb.wiggleDB_sqlite
+import wiggledb.wiggleDB_metrics
 
 DEBUG = False
 CONFIG_FILE = '/data/wiggletools/wiggletools.conf'
 
 config = wiggletools.wiggleDB.read_config_file(CONFIG_FILE)
 cgitb.enable(logdir=config['logdir'])
+wiggledb.wiggleDB_metrics.configure(config)
 
 class WiggleDBOptions(object):
 	def __init__(self):
@@ -60,7 +64,7 @@ def main():
 
 	try:
 		form = cgi.FieldStorage()
-		conn = sqlite3.connect(config['database_location'])
+		conn = wiggledb.wiggleDB_sqlite.connect(config['database_location'])
 		cursor = conn.cursor()
 		if "result" in form:
 			result = wiggletools.wiggleDB.query_result(cursor, form["result"].value, config['batch_system'])
@@ -71,9 +75,11 @@ def main():
 
 		elif "count" in form:
 			assembly = form['assembly'].value
-			params = dict((re.sub("^._", "", X), form.getlist(X)) for X in form if X != "count")
-			count = len(wiggletools.wiggleDB.get_dataset_locations(cursor, params, assembly))
-			print json.dumps({'query':params,'count':count})
+			params = dict((re.sub("^._", "", X), form.getlist(X)) for X in form if X not in ("count", "assembly"))
+			# Same index and reply as wiggleWSGI.py
+			res = wiggledb.wiggleDB_facets.get_facet_index(cursor).counts(params, assembly)
+			res['query'] = params
+			print json.dumps(res)
 
 		elif 'annotations' in form:
 			assembly = form['assembly'].value
@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Long running alternative to wiggleCGI.py. The configuration is parsed
+# once, each worker thread keeps its own SQLite connection open, and requests
+# are served by a fixed pool of threads. Can be mounted under any WSGI
+# container (mod_wsgi, gunicorn...) through the 'application' callable, or
+# run directly:
+#
+#	wiggleWSGI.py --config /path/to/wiggletools.conf --port 8000 --workers 16
+#
+# Answers which only depend on the catalogue (attributes, annotations and
+# counts) carry the catalogue version as ETag, so that browsers and proxies
+# can cache them, and bodies are gzipped for clients which accept it.
+
+import sys
+import os
+import cgi
+import json
+import sqlite3
+import re
+import zlib
+import argparse
+import time
+import threading
+import traceback
+import socket
+import Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_batch
+import wiggledb.wiggleDB_facets
+import wiggledb.wiggleDB_region
+import wiggledb.wiggleDB_summaries
+import wiggledb.wiggleDB_sqlite
+import wiggledb.wiggleDB_metrics
+
+DEBUG = False
+CONFIG_FILE = os.environ.get('WIGGLEDB_CONFIG', '/data/wiggletools/wiggletools.conf')
+
+config = None
+connections = threading.local()
+watcher = None
+watcher_lock = threading.Lock()
+wait_slots = None
+
+TERMINAL_STATUSES = ('DONE', 'EMPTY', 'EXPIRED', 'ERROR', 'CANCELLED', 'UNKNOWN')
+
+# Smaller bodies are not worth compressing
+GZIP_MIN_SIZE = 1024
+# Cache lifetime of the answers requested with the current catalogue version
+VERSIONED_MAX_AGE = 365 * 24 * 3600
+
+###########################################
+## Warm state
+###########################################
+
+def load_config(filename):
+	global config, CONFIG_FILE
+	CONFIG_FILE = filename
+	config = wiggledb.wiggleDB.read_config_file(filename)
+	wiggledb.wiggleDB_metrics.configure(config)
+	return config
+
+def get_connection():
+	if getattr(connections, 'conn', None) is None:
+		connections.conn = wiggledb.wiggleDB_sqlite.connect(config['database_location'])
+	return connections.conn
+
+def drop_connection():
+	conn = getattr(connections, 'conn', None)
+	if conn is not None:
+		try:
+			conn.close()
+		except sqlite3.Error:
+			pass
+	connections.conn = None
+
+class WiggleDBOptions(object):
+	def __init__(self):
+		self.assembly = None
+		self.wa  = None
+		self.working_directory = None
+		self.s3 = None
+		self.wb = None
+		self.a = None
+		self.b = None
+		self.fun_merge = None
+		self.dry_run = DEBUG
+		self.remember = False
+		self.db = config['database_location']
+		self.config = CONFIG_FILE
+		self.emails = None
+		self.user = None
+
+###########################################
+## Waiting on jobs
+###########################################
+
+class JobWatcher(object):
+	# A single thread checks the status of all the jobs clients are waiting
+	# on, with one query per interval, or as soon as a finishing job notifies
+	# the server. Waiting clients only block on an event.
+	def __init__(self, interval):
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.waiting = dict()
+		self.wake = threading.Event()
+		thread = threading.Thread(target=self.run, name='wiggleWSGI-watcher')
+		thread.daemon = True
+		thread.start()
+
+	def wait(self, jobID, timeout):
+		event = threading.Event()
+		with self.lock:
+			self.waiting.setdefault(jobID, []).append(event)
+		try:
+			event.wait(timeout)
+		finally:
+			with self.lock:
+				self.waiting[jobID].remove(event)
+				if len(self.waiting[jobID]) == 0:
+					del self.waiting[jobID]
+
+	def notify(self):
+		self.wake.set()
+
+	def finished_jobs(self, jobIDs):
+		conn = wiggledb.wiggleDB_sqlite.connect(config['database_location'])
+		try:
+			res = set()
+			for start in range(0, len(jobIDs), 500):
+				chunk = jobIDs[start:start+500]
+				found = dict(conn.execute('SELECT job_id, status FROM jobs WHERE job_id IN (%s)' % ",".join('?' for X in chunk), chunk).fetchall())
+				res.update(X for X in chunk if found.get(X, 'UNKNOWN') in TERMINAL_STATUSES)
+			return res
+		finally:
+			conn.close()
+
+	def run(self):
+		while True:
+			self.wake.wait(self.interval)
+			self.wake.clear()
+			with self.lock:
+				jobIDs = self.waiting.keys()
+			if len(jobIDs) == 0:
+				continue
+			try:
+				finished = self.finished_jobs(jobIDs)
+			except sqlite3.Error:
+				traceback.print_exc()
+				continue
+			with self.lock:
+				for jobID in finished:
+					for event in self.waiting.get(jobID, []):
+						event.set()
+
+def get_watcher():
+	global watcher
+	with watcher_lock:
+		if watcher is None:
+			watcher = JobWatcher(float(config.get('wait_poll_interval', 5)))
+		return watcher
+
+def get_wait_slots():
+	# Bounds the number of clients blocked in long polls, so that they
+	# never take up all the threads of the WSGI container. Threads of the
+	# standalone server have their own.
+	global wait_slots
+	if getattr(connections, 'wait_slots', None) is not None:
+		return connections.wait_slots
+	with watcher_lock:
+		if wait_slots is None:
+			wait_slots = threading.BoundedSemaphore(int(config.get('max_waiters', 8)))
+		return wait_slots
+
+###########################################
+## Actions
+###########################################
+
+def result_report(result):
+	url = wiggledb.wiggleDB.visible_url(result['location'], config)
+	if result['location'][-3:] == ".bw" or result['location'][-3:] == ".bb":
+		ensembl = 'http://%s/%s/Location/View?g=%s;contigviewbottom=url:%s' % (config['ensembl_server'], config['ensembl_species'], config['ensembl_gene'], url)
+	else:
+		ensembl = url + ".png"
+	return {'status':result['status'], 'url':url, 'view':ensembl}
+
+def job_result(cursor, jobID):
+	result = wiggledb.wiggleDB.query_result(cursor, jobID, config['batch_system'])
+	if result['status'] == "DONE":
+		return result_report(result)
+	else:
+		return {'status':result['status']}
+
+def result_action(cursor, form):
+	return job_result(cursor, form["result"].value)
+
+def wait_action(cursor, form):
+	# Long poll: only returns once the job has finished, or on timeout.
+	# When too many clients are waiting already, the current status is
+	# returned at once, with the delay after which to ask again.
+	jobID = int(form['wait'].value)
+	max_timeout = float(config.get('wait_timeout', 60))
+	timeout = min(float(form.getfirst('timeout', max_timeout)), max_timeout)
+	deadline = time.time() + timeout
+	res = job_result(cursor, jobID)
+	if res['status'] not in TERMINAL_STATUSES:
+		slots = get_wait_slots()
+		if slots.acquire(False):
+			try:
+				while res['status'] not in TERMINAL_STATUSES and time.time() < deadline:
+					get_watcher().wait(jobID, deadline - time.time())
+					res = job_result(cursor, jobID)
+			finally:
+				slots.release()
+		else:
+			wiggledb.wiggleDB_metrics.increment('wait_overflows_total')
+			res['retry_after'] = int(config.get('wait_poll_interval', 5))
+	res['ID'] = jobID
+	return res
+
+def notify_action(cursor, form):
+	get_watcher().notify()
+	return {'ID':form['notify'].value, 'status':'NOTIFIED'}
+
+def count_action(cursor, form):
+	assembly = form['assembly'].value
+	params = dict((re.sub("^._", "", X), form.getlist(X)) for X in form if X not in ("count", "assembly", "version"))
+	res = wiggledb.wiggleDB_facets.get_facet_index(cursor).counts(params, assembly)
+	res['query'] = params
+	return res
+
+def annotations_action(cursor, form):
+	assembly = form['assembly'].value
+	return {"annotations": [X[1] for X in wiggledb.wiggleDB.get_annotations(cursor, assembly)]}
+
+def attributes_action(cursor, form):
+	# Selectable attributes, with the number of datasets for each value
+	assembly = form['assembly'].value
+	index = wiggledb.wiggleDB_facets.get_facet_index(cursor)
+	return {'version': index.version, 'assembly': assembly, 'attributes': index.attribute_counts(assembly)}
+
+def region_action(cursor, form):
+	# Interactive preview of the A selection over a single window
+	assembly = form['assembly'].value
+	params = dict((X[2:], form.getlist(X)) for X in form if X[:2] == "A_")
+	data = wiggledb.wiggleDB.get_dataset_locations(cursor, params, assembly)
+	if len(data) == 0:
+		return {'status':'INVALID'}
+	res = wiggledb.wiggleDB_region.evaluate_region(cursor, wiggledb.wiggleDB.normalise_spaces(form['wa'].value), data, assembly, form['region'].value, config)
+	res['status'] = 'DONE'
+	return res
+
+def summary_action(cursor, form):
+	# Statistics of the A selection from the precomputed summaries
+	assembly = form['assembly'].value
+	params = dict((X[2:], form.getlist(X)) for X in form if X[:2] == "A_")
+	data = wiggledb.wiggleDB.get_dataset_locations(cursor, params, assembly)
+	res = wiggledb.wiggleDB_summaries.selection_summary(cursor, data)
+	if 'histogram' in form:
+		res['histogram'] = wiggledb.wiggleDB_summaries.approximate_histogram(cursor, data, int(form.getfirst('histogram') or 20))
+	return res
+
+def compute_action(conn, cursor, form, user):
+	options = WiggleDBOptions()
+	options.user = user
+	options.assembly = form['assembly'].value
+	options.wa = wiggledb.wiggleDB.normalise_spaces(form['wa'].value)
+	options.working_directory = config['working_directory']
+	options.s3 = config.get('s3_bucket')
+	if 'email' in form:
+		options.emails = form.getlist('email')
+
+	if 'wb' in form:
+		options.wb = wiggledb.wiggleDB.normalise_spaces(form['wb'].value)
+
+	if 'w' in form:
+		options.fun_merge = wiggledb.wiggleDB.normalise_spaces(form['w'].value)
+
+	options.a = dict((X[2:], form.getlist(X)) for X in form if X[:2] == "A_")
+	options.b = dict((X[2:], form.getlist(X)) for X in form if X[:2] == "B_")
+	if len(options.b.keys()) == 0:
+		options.b = None
+
+	if options.b is not None and options.a.get('type') == ['regions'] and options.b.get('type') == ['signal']:
+		tmp = options.b
+		options.b = options.a
+		options.a = tmp
+
+	result = wiggledb.wiggleDB.request_compute(conn, cursor, options, config, config['batch_system'])
+	if result['status'] == 'DONE':
+		return result_report(result)
+	else:
+		return result
+
+def batch_action(conn, cursor, form, user):
+	# The batch is described in JSON, see wiggleDB_batch.py
+	spec = json.loads(form['batch'].value)
+	emails = None
+	if 'email' in form:
+		emails = form.getlist('email')
+	res = wiggledb.wiggleDB_batch.submit_batch(conn, cursor, spec, config, config['batch_system'], config['working_directory'], config['database_location'], CONFIG_FILE, emails, user=user)
+	if res['batch'] is None:
+		# Refused
+		return res
+	res['items'] = [batch_item_report(X) for X in res['items']]
+	return res
+
+def batch_item_report(result):
+	if result['status'] == 'DONE':
+		res = result_report(result)
+		res['ID'] = result['ID']
+		res['item'] = result['item']
+		return res
+	return result
+
+def batch_result_action(cursor, form):
+	res = wiggledb.wiggleDB_batch.query_batch(cursor, int(form['batch_result'].value), config, config['batch_system'])
+	res['items'] = [batch_item_report(X) for X in res['items']]
+	return res
+
+def metrics_page():
+	# Prometheus text format, read from the database as other processes
+	# record metrics too
+	wiggledb.wiggleDB_metrics.flush()
+	cursor = get_connection().cursor()
+	return wiggledb.wiggleDB_metrics.prometheus_report(cursor).encode('utf-8')
+
+def request_user(environ):
+	# Admission limits apply per authenticated user, or else per client
+	return environ.get('REMOTE_USER') or environ.get('REMOTE_ADDR')
+
+def dispatch(form, user=None):
+	conn = get_connection()
+	cursor = conn.cursor()
+	try:
+		if "result" in form:
+			res = result_action(cursor, form)
+		elif "wait" in form:
+			res = wait_action(cursor, form)
+		elif "notify" in form:
+			res = notify_action(cursor, form)
+		elif "count" in form:
+			res = count_action(cursor, form)
+		elif 'annotations' in form:
+			res = annotations_action(cursor, form)
+		elif 'attributes' in form:
+			res = attributes_action(cursor, form)
+		elif 'region' in form:
+			res = region_action(cursor, form)
+		elif 'summary' in form:
+			res = summary_action(cursor, form)
+		elif 'batch_result' in form:
+			res = batch_result_action(cursor, form)
+		elif 'batch' in form:
+			res = batch_action(conn, cursor, form, user)
+		elif 'wa' in form:
+			res = compute_action(conn, cursor, form, user)
+		else:
+			res = "No params, no output"
+		conn.commit()
+		return res
+	except:
+		conn.rollback()
+		raise
+
+###########################################
+## HTTP caching
+###########################################
+
+def is_catalogue_request(form):
+	# Same precedence as dispatch()
+	if any(X in form for X in ('result', 'wait', 'notify')):
+		return False
+	return any(X in form for X in ('count', 'annotations', 'attributes'))
+
+def catalogue_headers(form, version):
+	# Clients which pass the version they got from the attributes can keep
+	# the answer until the next load, others have to revalidate
+	if form.getfirst('version') == str(version):
+		cache_control = 'public, max-age=%i, immutable' % VERSIONED_MAX_AGE
+	else:
+		cache_control = 'public, max-age=%i' % int(config.get('catalogue_max_age', 60))
+	return [('ETag', 'W/"catalogue-%i"' % version), ('Cache-Control', cache_control)]
+
+def not_modified(environ, headers):
+	etag = dict(headers)['ETag']
+	tags = [X.strip() for X in environ.get('HTTP_IF_NONE_MATCH', '').split(',')]
+	return etag in tags or etag[2:] in tags or '*' in tags
+
+def accepts_gzip(environ):
+	return any(X.split(';')[0].strip() == 'gzip' for X in environ.get('HTTP_ACCEPT_ENCODING', '').split(','))
+
+def gzip_body(body):
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(body) + compressor.flush()
+
+###########################################
+## WSGI entry point
+###########################################
+
+def application(environ, start_response):
+	if config is None:
+		load_config(environ.get('WIGGLEDB_CONFIG', CONFIG_FILE))
+
+	content_type = 'application/json'
+	headers = []
+	try:
+		form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ, keep_blank_values=True)
+		if 'metrics' in form:
+			body = metrics_page()
+			content_type = 'text/plain; version=0.0.4'
+		else:
+			if is_catalogue_request(form):
+				headers = catalogue_headers(form, wiggledb.wiggleDB.get_catalogue_version(get_connection().cursor()))
+				if not_modified(environ, headers):
+					start_response('304 Not Modified', headers + [('Vary', 'Accept-Encoding')])
+					return []
+			res = dispatch(form, request_user(environ))
+			if isinstance(res, dict) and res.get('status') == 'DEFERRED':
+				headers.append(('Retry-After', str(res['retry_after'])))
+			body = json.dumps(res)
+		status = '200 OK'
+	except sqlite3.DatabaseError:
+		environ['wsgi.errors'].write(traceback.format_exc())
+		drop_connection()
+		body = json.dumps("ERROR")
+		status = '500 Internal Server Error'
+		headers = []
+	except:
+		environ['wsgi.errors'].write(traceback.format_exc())
+		body = json.dumps("ERROR")
+		status = '500 Internal Server Error'
+		headers = []
+
+	wiggledb.wiggleDB_metrics.maybe_flush()
+	headers.append(('Vary', 'Accept-Encoding'))
+	if len(body) >= GZIP_MIN_SIZE and accepts_gzip(environ):
+		body = gzip_body(body)
+		headers.append(('Content-Encoding', 'gzip'))
+	start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body)))] + headers)
+	return [body]
+
+###########################################
+## Standalone server
+###########################################
+
+# Request line of a long poll
+WAIT_REQUEST = re.compile(r'^GET [^ ]*[?&]wait=')
+
+class PooledWSGIServer(WSGIServer):
+	# Incoming sockets are handed over to a fixed pool of worker threads
+	# instead of being served one at a time by the listening thread. Long
+	# polls are passed on to a separate pool of waiter threads, so that
+	# waiting clients do not hold the workers which serve everything else.
+	# When all the waiters are busy, long polls are answered by the workers
+	# without waiting.
+	def __init__(self, server_address, handler_class, workers, waiters=0):
+		WSGIServer.__init__(self, server_address, handler_class)
+		self.requests = Queue.Queue(maxsize=workers * 8)
+		self.waits = Queue.Queue()
+		self.idle_waiters = threading.Semaphore(waiters)
+		for index in range(workers):
+			worker = threading.Thread(target=self.serve_requests, args=(self.requests, 0), name='wiggleWSGI-%i' % index)
+			worker.daemon = True
+			worker.start()
+		for index in range(waiters):
+			worker = threading.Thread(target=self.serve_requests, args=(self.waits, 1), name='wiggleWSGI-waiter-%i' % index)
+			worker.daemon = True
+			worker.start()
+
+	def is_wait(self, request):
+		try:
+			return WAIT_REQUEST.match(request.recv(1024, socket.MSG_PEEK)) is not None
+		except socket.error:
+			return False
+
+	def serve_requests(self, queue, waits):
+		connections.wait_slots = threading.Semaphore(waits)
+		while True:
+			request, client_address = queue.get()
+			if queue is self.requests and self.is_wait(request) and self.idle_waiters.acquire(False):
+				self.waits.put((request, client_address))
+				continue
+			try:
+				self.finish_request(request, client_address)
+			except:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+				if queue is self.waits:
+					self.idle_waiters.release()
+
+	def process_request(self, request, client_address):
+		self.requests.put((request, client_address))
+
+class QuietRequestHandler(WSGIRequestHandler):
+	def log_message(self, format, *args):
+		if DEBUG:
+			WSGIRequestHandler.log_message(self, format, *args)
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB WSGI server.')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file',default=CONFIG_FILE)
+	parser.add_argument('--host',dest='host',help='Interface to listen on',default='')
+	parser.add_argument('--port','-p',dest='port',help='Port to listen on',type=int,default=8000)
+	parser.add_argument('--workers','-n',dest='workers',help='Number of worker threads',type=int,default=32)
+	parser.add_argument('--waiters',dest='waiters',help='Number of threads serving long polls, each waiting client holds one',type=int,default=64)
+	return parser.parse_args()
+
+def main():
+	options = get_options()
+	load_config(options.config)
+	server = PooledWSGIServer((options.host, options.port), QuietRequestHandler, options.workers, options.waiters)
+	server.set_app(application)
+	server.serve_forever()
+
+if __name__ == "__main__":
+	main()
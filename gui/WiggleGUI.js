@@ -5,6 +5,11 @@
 var CGI_URL = "http://" + location.hostname + "/cgi-bin/wiggleCGI.py?";
 var attribute_values_file = "datasets.attribs.json";
 var assembly = "GRCh37";
+// Set to true when served by wiggleWSGI.py, to be notified of job completion
+var wait_for_results = false;
+// Set to true when served by wiggleWSGI.py, to read the attributes and their
+// dataset counts from the server instead of attribute_values_file
+var attributes_from_server = false;
 
 //////////////////////////////////////////
 // Main function 
@@ -13,7 +18,6 @@ var assembly = "GRCh37";
 $(document).ready(
   function () {
     create_all_selectors();
-    add_annotations();
     define_buttons();
   }
 )
@@ -37,6 +41,10 @@ var panel_letters = {
 };
 
 var attribute_values = null;
+// Number of datasets for each attribute value, if known
+var attribute_counts = {};
+// Version of the catalogue the attributes were read from
+var catalogue_version = null;
 
 var reduction_opts = {
   "signal": {"Sum":"sum","Mininum":"min","Maximum":"max","Mean":"mean","Median":"median"},
@@ -58,8 +66,12 @@ var annotation_opts = {
 // Creating multiselects 
 //////////////////////////////////////////
 
-function add_value_to_multiselect(value, div) {
-  $("<option>").attr("value",value).text(value).appendTo(div);
+function add_value_to_multiselect(value, div, counts) {
+  var text = value;
+  if (value in counts) {
+    text += " (" + counts[value] + ")";
+  }
+  $("<option>").attr("value",value).text(text).appendTo(div);
 }
 
 function all_selects_are_used(panel) {
@@ -77,7 +89,8 @@ function create_multiselect(container, attribute, panel) {
     .attr("attribute",panel_letters[panel.attr("id")]+ "_" + attribute);
 
   if (attribute in attribute_values) {
-    attribute_values[attribute].map(function(value) {add_value_to_multiselect(value, multiselect2);});
+    var counts = attribute_counts[attribute] || {};
+    attribute_values[attribute].map(function(value) {add_value_to_multiselect(value, multiselect2, counts);});
   }
   multiselect2.multiselect({onChange: function(element, checked) {update_panel_count(panel);}, maxHeight: 400, buttonWidth:'100%'});
   multiselect2.parent().find('.btn').css("white-space","normal");
@@ -135,11 +148,34 @@ function create_selection_div(panel) {
   update_panel(panel);
 }
 
+function create_all_selectors_2() {
+  selection_panels.map(function (id) {create_selection_div($("#"+id));});
+  add_annotations();
+}
+
 function create_all_selectors() {
-  jQuery.getJSON(attribute_values_file).done(function(values) {
-    attribute_values = values;
-    selection_panels.map(function (id) {create_selection_div($("#"+id));});
-  }).fail(catch_JSON_error);
+  if (attributes_from_server) {
+    jQuery.getJSON(CGI_URL + "assembly=" + assembly + "&attributes=1").done(function(data) {
+      catalogue_version = data["version"];
+      attribute_counts = data["attributes"];
+      attribute_values = {};
+      Object.keys(attribute_counts).map(function(attribute) {attribute_values[attribute] = Object.keys(attribute_counts[attribute]).sort();});
+      create_all_selectors_2();
+    }).fail(catch_JSON_error);
+  } else {
+    jQuery.getJSON(attribute_values_file).done(function(values) {
+      attribute_values = values;
+      create_all_selectors_2();
+    }).fail(catch_JSON_error);
+  }
+}
+
+// Lets the browser cache catalogue queries until the next load
+function catalogue_query() {
+  if (catalogue_version == null) {
+    return "";
+  }
+  return "&version=" + catalogue_version;
 }
 
 //////////////////////////////////////////
@@ -156,7 +192,7 @@ function add_annotations_2(data) {
 }
 
 function add_annotations() {
-  $.getJSON(CGI_URL + "assembly=" + assembly + "&annotations=1").done(add_annotations_2).fail(catch_JSON_error);
+  $.getJSON(CGI_URL + "assembly=" + assembly + "&annotations=1" + catalogue_query()).done(add_annotations_2).fail(catch_JSON_error);
   fill_select($('#reference_reduction'), reduction_opts['regions']);
 }
 
@@ -209,7 +245,7 @@ function panel_reduction(panel) {
 //////////////////////////////////////////
 
 function update_panel_count(panel) {
-  url = CGI_URL + "count=true&assembly=" + assembly + "&" + panel_query(panel);
+  url = CGI_URL + "count=true&assembly=" + assembly + catalogue_query() + "&" + panel_query(panel);
   $.getJSON(url).done(
    function(data, textStatus, jqXHR) {
      panel.find("#count").text("(" + data["count"] + " elements selected)");
@@ -385,12 +421,52 @@ function report_result(data) {
   } else if (data['status'] == "LAUNCHED") {
     var modal = $("#JobSent_modal").clone();
     modal.find("#job_id").text(data["ID"]);
+    if (data["estimate"] != null) {
+      modal.find("#eta").text("It should be finished in about " + describe_eta(data["estimate"]["eta_seconds"]) + ".");
+    }
+    modal.modal();
+    wait_for_result(data["ID"]);
+  } else if (data['status'] == "DEFERRED" || data['status'] == "REJECTED") {
+    var modal = $("#Refused_modal").clone();
+    modal.find("#reason").text(data["reason"] + ".");
+    if (data['status'] == "DEFERRED") {
+      modal.find("#advice").text("Please try again in " + describe_eta(data["retry_after"]) + ".");
+    } else {
+      modal.find("#advice").text("Please select fewer datasets.");
+    }
     modal.modal();
   } else {
     $('#Waiting_modal').modal();	
   }
 }
 
+function describe_eta(seconds) {
+  if (seconds < 5400) {
+    return Math.max(1, Math.round(seconds / 60)) + " minutes";
+  } else {
+    return Math.round(seconds / 3600) + " hours";
+  }
+}
+
+// Wait for a job to finish, then report the result
+function wait_for_result(job_id) {
+  if (!wait_for_results) {
+    return;
+  }
+  $.getJSON(CGI_URL + "wait=" + job_id).done(
+    function(data, textStatus, jqXHR) {
+      if (data["retry_after"] != null) {
+        // The server is busy with other waiting clients
+        setTimeout(function() {wait_for_result(job_id);}, data["retry_after"] * 1000);
+      } else if (data["status"] == "WAITING" || data["status"] == "LAUNCHED") {
+        wait_for_result(job_id);
+      } else {
+        report_result(data);
+      }
+    }
+  ).fail(catch_JSON_error);
+}
+
 // Get result
 function get_result() {
   $.getJSON(CGI_URL + "result=" + $('#result_box').val()).done(report_result).fail(catch_JSON_error);
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Admission of concurrent requests, as from several WSGI workers, and cost
+# estimates of requests computed incrementally.
+#
+# Run with: python -m unittest discover python/tests
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_cost
+import wiggledb.wiggleDB_sqlite
+
+CONFIG = {'max_global_cpu': '100', 'cost_seconds_per_file': '10', 'cost_seconds_per_mb': '0', 'cost_default_file_mb': '1'}
+ESTIMATE = {'cpu_seconds': 60.0, 'memory_mb': 100.0, 'output_mb': 1.0, 'eta_seconds': 60}
+
+class Admission(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db = os.path.join(self.directory, 'test.db')
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		wiggledb.wiggleDB.create_job_table(conn.cursor())
+		wiggledb.wiggleDB.create_cache(conn.cursor())
+		conn.commit()
+		conn.close()
+		self.first = wiggledb.wiggleDB_sqlite.connect(self.db)
+		self.second = wiggledb.wiggleDB_sqlite.open_connection(self.db, 0.1)
+
+	def tearDown(self):
+		self.first.close()
+		self.second.close()
+		shutil.rmtree(self.directory)
+
+	def test_one_at_a_time(self):
+		self.assertEqual(wiggledb.wiggleDB_cost.admit(self.first.cursor(), ESTIMATE, None, CONFIG), None)
+		# The other worker waits until the first request is accounted for
+		with self.assertRaises(sqlite3.OperationalError):
+			wiggledb.wiggleDB_cost.admit(self.second.cursor(), ESTIMATE, None, CONFIG)
+		self.second.rollback()
+		wiggledb.wiggleDB_cost.reserve(self.first.cursor(), ESTIMATE, None)
+		self.first.commit()
+		self.assertEqual(wiggledb.wiggleDB_cost.admit(self.second.cursor(), ESTIMATE, None, CONFIG)['status'], 'DEFERRED')
+
+	def test_release(self):
+		cursor = self.first.cursor()
+		reservation = wiggledb.wiggleDB_cost.reserve(cursor, ESTIMATE, None)
+		self.assertEqual(wiggledb.wiggleDB_cost.inflight(cursor, None, CONFIG), (60.0, 1))
+		wiggledb.wiggleDB_cost.release(cursor, reservation)
+		self.assertEqual(wiggledb.wiggleDB_cost.inflight(cursor, None, CONFIG), (0, 0))
+
+class IncrementalEstimate(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.conn = sqlite3.connect(':memory:')
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_job_table(self.cursor)
+		wiggledb.wiggleDB.create_cache(self.cursor)
+		self.files = ['/d/%i.bw' % X for X in range(10)]
+		self.cached = os.path.join(self.directory, 'subset.bw')
+		open(self.cached, 'w').close()
+
+	def tearDown(self):
+		self.conn.close()
+		shutil.rmtree(self.directory)
+
+	def test_pending_inputs(self):
+		self.assertEqual(wiggledb.wiggleDB.pending_inputs(self.cursor, 'sum', self.files), self.files)
+		jobID = wiggledb.wiggleDB.insert_job(self.cursor, 101)
+		self.cursor.execute('UPDATE jobs SET status = "DONE" WHERE job_id = ?', (jobID,))
+		wiggledb.wiggleDB.insert_cache_entry(self.cursor, jobID, False, " ".join(['sum'] + self.files[:8] + [':']), False, self.cached, 'sum', 8)
+		# Only the cached sum and the two files left are read
+		self.assertEqual(wiggledb.wiggleDB.pending_inputs(self.cursor, 'sum', self.files), [self.cached] + self.files[8:])
+		# Not for reductions which cannot be computed incrementally
+		self.assertEqual(wiggledb.wiggleDB.pending_inputs(self.cursor, 'median', self.files), self.files)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cancelling a job which is attached to the compute step of another job
+# only removes the steps submitted for it, and cancelling the owner of a
+# step which other jobs wait on hands the step over to them.
+#
+# Run with: python -m unittest discover python/tests
+
+import sqlite3
+import unittest
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_local
+
+class CancelAttachedJob(unittest.TestCase):
+	def setUp(self):
+		self.conn = sqlite3.connect(':memory:')
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_job_table(self.cursor)
+		wiggledb.wiggleDB.create_cache(self.cursor)
+		wiggledb.wiggleDB_local.create_task_table(self.cursor)
+
+		# Owner job, with its own compute (101) and finish (102) steps
+		self.owner = wiggledb.wiggleDB.insert_job(self.cursor, 101)
+		self.cursor.execute('UPDATE jobs SET lsf_id2 = 102 WHERE job_id = ?', (self.owner,))
+		wiggledb.wiggleDB.insert_cache_entry(self.cursor, self.owner, False, 'mean a b :', False, '/tmp/owner.bw')
+		# Identical request attached to it, with only a finish step (103)
+		self.attached = wiggledb.wiggleDB.insert_job(self.cursor, None, dependency=101)
+		self.cursor.execute('UPDATE jobs SET lsf_id2 = 103 WHERE job_id = ?', (self.attached,))
+		wiggledb.wiggleDB.insert_cache_entry(self.cursor, self.attached, True, 'write /tmp/owner.bw mean a b :', False, '/tmp/owner.bw')
+
+		self.calls = []
+		self.call = wiggledb.wiggleDB.subprocess.call
+		wiggledb.wiggleDB.subprocess.call = self.calls.append
+
+	def tearDown(self):
+		wiggledb.wiggleDB.subprocess.call = self.call
+		self.conn.close()
+
+	def status(self, jobID):
+		return self.cursor.execute('SELECT status FROM jobs WHERE job_id = ?', (jobID,)).fetchone()[0]
+
+	def test_attached_job_recorded(self):
+		self.assertEqual(self.cursor.execute('SELECT lsf_id, depends_on FROM jobs WHERE job_id = ?', (self.attached,)).fetchone(), (None, 101))
+
+	def test_cancel_attached_job(self):
+		res = wiggledb.wiggleDB.cancel_job(self.cursor, self.attached, 'SGE')
+		self.assertEqual(res['status'], 'CANCELLED')
+		self.assertEqual(self.calls, [['qdel', '103']])
+		self.assertEqual(self.status(self.owner), 'LAUNCHED')
+		self.assertEqual(self.cursor.execute('SELECT count(*) FROM cache WHERE job_id = ?', (self.owner,)).fetchone()[0], 1)
+
+	def test_cancel_owner_job(self):
+		# Only the finish step of the owner is removed
+		wiggledb.wiggleDB.cancel_job(self.cursor, self.owner, 'SGE')
+		self.assertEqual(self.calls, [['qdel', '102']])
+		self.assertEqual(self.status(self.owner), 'CANCELLED')
+		self.assertEqual(self.status(self.attached), 'LAUNCHED')
+		self.assertEqual(self.cursor.execute('SELECT lsf_id, depends_on FROM jobs WHERE job_id = ?', (self.attached,)).fetchone(), (101, None))
+		self.assertEqual(self.cursor.execute('SELECT job_id FROM cache WHERE query = "mean a b :"').fetchall(), [(self.attached,)])
+		# Now owned, the step is removed with the attached job
+		wiggledb.wiggleDB.cancel_job(self.cursor, self.attached, 'SGE')
+		self.assertEqual(self.calls, [['qdel', '102'], ['qdel', '103'], ['qdel', '101']])
+
+	def test_cancel_owner_job_alone(self):
+		wiggledb.wiggleDB.cancel_job(self.cursor, self.attached, 'SGE')
+		wiggledb.wiggleDB.cancel_job(self.cursor, self.owner, 'SGE')
+		self.assertEqual(self.calls, [['qdel', '103'], ['qdel', '102'], ['qdel', '101']])
+
+	def test_inflight_after_cancel(self):
+		# Later requests still find the intermediate result in flight
+		wiggledb.wiggleDB.cancel_job(self.cursor, self.owner, 'SGE')
+		self.assertEqual(wiggledb.wiggleDB.get_inflight_location(self.cursor, 'mean a b :'), ('/tmp/owner.bw', 101))
+
+	def test_cancel_attached_local_job(self):
+		for taskID in (101, 103):
+			self.cursor.execute('INSERT INTO tasks (task_id, status) VALUES (?, "QUEUED")', (taskID,))
+		wiggledb.wiggleDB.cancel_job(self.cursor, self.attached, 'local')
+		tasks = dict(self.cursor.execute('SELECT task_id, status FROM tasks').fetchall())
+		self.assertEqual(tasks, {101: 'QUEUED', 103: 'CANCELLED'})
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# --clear_cache empties the tables of the jobs and of what derives from
+# them, and keeps the rest.
+#
+# Run with: python -m unittest discover python/tests
+
+import sqlite3
+import unittest
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_local
+import wiggledb.wiggleDB_metrics
+
+class ClearCache(unittest.TestCase):
+	def setUp(self):
+		self.conn = sqlite3.connect(':memory:')
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_assembly_table(self.cursor)
+		wiggledb.wiggleDB.create_cache(self.cursor)
+		wiggledb.wiggleDB.create_job_table(self.cursor)
+		wiggledb.wiggleDB_local.create_task_table(self.cursor)
+		wiggledb.wiggleDB.create_tile_table(self.cursor)
+		wiggledb.wiggleDB.create_summary_table(self.cursor)
+		wiggledb.wiggleDB.create_outbox_table(self.cursor)
+		wiggledb.wiggleDB.create_batch_tables(self.cursor)
+		wiggledb.wiggleDB_metrics.create_metrics_table(self.cursor)
+
+	def tearDown(self):
+		self.conn.close()
+
+	def count(self, table):
+		return self.cursor.execute('SELECT count(*) FROM %s' % table).fetchone()[0]
+
+	def test_clear_cache(self):
+		jobID = wiggledb.wiggleDB.insert_job(self.cursor, 101)
+		wiggledb.wiggleDB.insert_cache_entry(self.cursor, jobID, True, 'sum a b', False, '/tmp/result.bw')
+		self.cursor.execute('INSERT INTO jobs_archive (job_id, status) VALUES (1000, "DONE")')
+		self.cursor.execute('INSERT INTO tasks (task_id, status) VALUES (1, "QUEUED")')
+		self.cursor.execute('INSERT INTO batches (shared_job_id) VALUES (?)', (jobID,))
+		self.cursor.execute('INSERT INTO batch_items (batch_id, item, job_id) VALUES (1, 0, ?)', (jobID,))
+		self.cursor.execute('INSERT INTO tiles (query_hash, chrom, tile, data) VALUES ("x", "1", 0, "[]")')
+		wiggledb.wiggleDB.enqueue_email(self.cursor, 'a@example.org', ['b@example.org'], 'Message')
+		self.cursor.execute('INSERT INTO assemblies VALUES ("GRCh37", "/tmp/chrom.sizes")')
+		self.cursor.execute('INSERT INTO summaries (location, total) VALUES ("/d/a.bw", 1)')
+		self.cursor.execute('INSERT INTO metrics (name, labels, count, total) VALUES ("x", "", 1, 1)')
+
+		wiggledb.wiggleDB.clear_cache(self.cursor)
+		for table in wiggledb.wiggleDB.CLEARED_TABLES:
+			self.assertEqual(self.count(table), 0, table)
+		for table in ('assemblies', 'summaries', 'metrics'):
+			self.assertEqual(self.count(table), 1, table)
+		# Job IDs start over
+		self.assertEqual(wiggledb.wiggleDB.insert_job(self.cursor, 102), 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Bit counts of the facet index bitmaps, including bitmaps whose counts
+# are added up over several chunks.
+#
+# Run with: python -m unittest discover python/tests
+
+import random
+import unittest
+
+import wiggledb.wiggleDB_facets
+
+class Popcount(unittest.TestCase):
+	def test_sizes(self):
+		rng = random.Random(0)
+		for bits in (1, 15, 16, 64, 1000, 65520, 65521, 200000):
+			full = (1 << bits) - 1
+			self.assertEqual(wiggledb.wiggleDB_facets.popcount(full), bits)
+			bitmap = rng.getrandbits(bits) | 1
+			self.assertEqual(wiggledb.wiggleDB_facets.popcount(bitmap), bin(bitmap).count('1'))
+		self.assertEqual(wiggledb.wiggleDB_facets.popcount(0), 0)
+		self.assertEqual(wiggledb.wiggleDB_facets.popcount(0L), 0)
+
+	def test_make_bitmap(self):
+		bitmap = wiggledb.wiggleDB_facets.make_bitmap([0, 3, 70000], 70001)
+		self.assertEqual(bitmap, (1 << 70000) | 9)
+		self.assertEqual(wiggledb.wiggleDB_facets.popcount(bitmap), 3)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Batches of the mailer against a fake SMTP server, which can refuse
+# connections or drop them.
+#
+# Run with: python -m unittest discover python/tests
+
+import os
+import shutil
+import socket
+import smtplib
+import tempfile
+import unittest
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_mailer
+import wiggledb.wiggleDB_sqlite
+
+CONFIG = {'smtp_server': 'mail.example.org', 'smtp_starttls': 'false', 'mail_retry_delay': '60'}
+
+class FakeServer(object):
+	def __init__(self):
+		self.reachable = True
+		self.drop = False
+		self.connections = 0
+		self.sent = []
+
+	def connect(self, host, port):
+		self.connections += 1
+		if not self.reachable:
+			raise socket.error('Connection refused')
+		return FakeSMTP(self)
+
+class FakeSMTP(object):
+	def __init__(self, server):
+		self.server = server
+
+	def ehlo(self):
+		return 250, 'OK'
+
+	def noop(self):
+		return 250, 'OK'
+
+	def quit(self):
+		pass
+
+	def sendmail(self, sender, recipients, message):
+		if self.server.drop:
+			raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+		self.server.sent.append(recipients)
+
+class Mailer(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db = os.path.join(self.directory, 'test.db')
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		wiggledb.wiggleDB.create_outbox_table(conn.cursor())
+		for index in range(3):
+			wiggledb.wiggleDB.enqueue_email(conn.cursor(), 'wiggledb@example.org', ['user%i@example.org' % index], 'Message %i' % index)
+		conn.commit()
+		conn.close()
+
+		self.server = FakeServer()
+		self.SMTP = smtplib.SMTP
+		smtplib.SMTP = self.server.connect
+		self.mailer = wiggledb.wiggleDB_mailer.Mailer(self.db, CONFIG)
+
+	def tearDown(self):
+		smtplib.SMTP = self.SMTP
+		shutil.rmtree(self.directory)
+
+	def outbox(self):
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		res = conn.execute('SELECT status, attempts FROM outbox ORDER BY message_id').fetchall()
+		conn.close()
+		return res
+
+	def test_one_connection(self):
+		results = self.mailer.step()
+		self.assertEqual([X[1] for X in results], ['SENT'] * 3)
+		self.assertEqual(self.server.connections, 1)
+		self.assertEqual(self.outbox(), [('SENT', 1)] * 3)
+
+	def test_unreachable(self):
+		self.server.reachable = False
+		# One connection attempt for the whole batch, which stays queued
+		self.assertEqual(self.mailer.step(), [])
+		self.assertEqual(self.server.connections, 1)
+		self.assertEqual(self.outbox(), [('QUEUED', 0)] * 3)
+		# No further attempt until the delay is over
+		self.assertEqual(self.mailer.step(), [])
+		self.assertEqual(self.server.connections, 1)
+
+		self.server.reachable = True
+		self.mailer.next_connect = 0
+		self.assertEqual(len(self.mailer.step()), 3)
+		self.assertEqual(self.server.connections, 2)
+		self.assertEqual(self.mailer.connect_failures, 0)
+
+	def test_backoff(self):
+		self.server.reachable = False
+		delays = []
+		for attempt in range(3):
+			self.mailer.next_connect = 0
+			self.mailer.step()
+			delays.append(self.mailer.next_connect)
+		self.assertTrue(delays[1] - delays[0] > 55)
+		self.assertTrue(delays[2] - delays[1] > 115)
+
+	def test_dropped(self):
+		# The first message fails, then the server cannot be reached again
+		self.server.drop = True
+		original = self.server.connect
+		def connect(host, port):
+			res = original(host, port)
+			self.server.reachable = False
+			return res
+		smtplib.SMTP = connect
+		results = self.mailer.step()
+		self.assertEqual([X[1] for X in results], ['QUEUED'])
+		self.assertEqual(self.server.connections, 2)
+		self.assertEqual(self.outbox(), [('QUEUED', 1), ('QUEUED', 0), ('QUEUED', 0)])
+
+if __name__ == '__main__':
+	unittest.main()
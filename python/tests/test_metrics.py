@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cache lookups of whole results and of intermediate results, which are
+# counted and reported apart.
+#
+# Run with: python -m unittest discover python/tests
+
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_metrics
+
+class CacheLookups(unittest.TestCase):
+	def setUp(self):
+		self.conn = sqlite3.connect(':memory:')
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_job_table(self.cursor)
+		wiggledb.wiggleDB.create_cache(self.cursor)
+		wiggledb.wiggleDB_metrics.create_metrics_table(self.cursor)
+		self.enabled = wiggledb.wiggleDB_metrics.enabled
+		wiggledb.wiggleDB_metrics.enabled = True
+		wiggledb.wiggleDB_metrics.values.clear()
+
+	def tearDown(self):
+		wiggledb.wiggleDB_metrics.enabled = self.enabled
+		wiggledb.wiggleDB_metrics.values.clear()
+		self.conn.close()
+
+	def store(self):
+		wiggledb.wiggleDB_metrics.add_values(self.cursor, wiggledb.wiggleDB_metrics.values)
+		return dict(((X[0], X[1]), X[2]) for X in wiggledb.wiggleDB_metrics.stored_values(self.cursor))
+
+	def test_separate_counters(self):
+		# Planning a reduction only looks up intermediate results
+		directory = tempfile.mkdtemp()
+		try:
+			wiggledb.wiggleDB.plan_expression(self.cursor, 'sum /d/a.bw /d/b.bw :', directory)
+		finally:
+			shutil.rmtree(directory)
+		stored = self.store()
+		self.assertEqual(stored[('intermediate_cache_lookups_total', 'result="miss"')], 1)
+		self.assertFalse(any(X[0] == 'result_cache_lookups_total' for X in stored))
+
+	def test_ratios(self):
+		for result, count in (('hit', 3), ('miss', 1)):
+			wiggledb.wiggleDB_metrics.increment('result_cache_lookups_total', count, result=result)
+		for result, count in (('hit', 1), ('inflight', 1), ('miss', 8)):
+			wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', count, result=result)
+		self.store()
+		report = wiggledb.wiggleDB_metrics.text_report(self.cursor)
+		self.assertTrue('Result cache hit ratio:\t0.750 (3/4)' in report)
+		self.assertTrue('Intermediate cache hit ratio:\t0.200 (2/10)' in report)
+
+if __name__ == '__main__':
+	unittest.main()
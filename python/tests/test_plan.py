@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Command plans of expressions with intermediate results: every file
+# written is split by chromosome, then merged once.
+#
+# Run with: python -m unittest discover python/tests
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import wiggletools.multiJob
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_split
+
+EXPRESSION = 'diff sum /d/a.bw /d/b.bw : sum /d/c.bw /d/d.bw :'
+
+class CommandPlan(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.conn = sqlite3.connect(':memory:')
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_job_table(self.cursor)
+		wiggledb.wiggleDB.create_cache(self.cursor)
+		self.chrom_sizes = os.path.join(self.directory, 'chrom.sizes')
+		out = open(self.chrom_sizes, 'w')
+		out.write('1\t1000\n2\t500\n')
+		out.close()
+
+	def tearDown(self):
+		self.conn.close()
+		shutil.rmtree(self.directory)
+
+	def test_nodes(self):
+		cmd, destination, compute, dependency, nodes = wiggledb.wiggleDB.plan_expression(self.cursor, EXPRESSION, self.directory)
+		self.assertTrue(compute)
+		self.assertEqual(dependency, None)
+		self.assertEqual(sorted(X[0] for X in nodes), sorted([EXPRESSION, 'sum /d/a.bw /d/b.bw :', 'sum /d/c.bw /d/d.bw :']))
+		# One write per node, each to its own file, the root's first
+		written = wiggledb.wiggleDB_split.written_files(cmd)
+		self.assertEqual(written[0], destination)
+		self.assertEqual(sorted(written), sorted(X[1] for X in nodes))
+		self.assertTrue(wiggledb.wiggleDB_split.nested_writes(cmd))
+
+	def test_split(self):
+		cmd, destination, compute, dependency, nodes = wiggledb.wiggleDB.plan_expression(self.cursor, EXPRESSION, self.directory)
+		written = wiggledb.wiggleDB_split.written_files(cmd)
+		compute, merge = wiggledb.wiggleDB_split.plan([cmd], self.chrom_sizes)
+		self.assertEqual(len(compute), 2)
+		for chrom, length, text in zip(['1', '2'], [1000, 500], compute):
+			self.assertTrue(text.startswith('wiggletools write %s.%s.wig seek %s 1 %i ' % (destination, chrom, chrom, length)))
+			# No chromosome writes to the files of another
+			self.assertEqual(wiggledb.wiggleDB_split.written_files(text), [X + '.%s.wig' % chrom for X in written])
+		self.assertEqual(len(merge), 3)
+		for location, text in zip(written, merge):
+			self.assertTrue(text.startswith('cat %s.1.wig %s.2.wig > %s.wig' % (location, location, location)))
+			self.assertTrue('wigToBigWig %s.wig %s %s' % (location, self.chrom_sizes, location) in text)
+
+	def test_cached_intermediate(self):
+		# Cached results are read, not written again
+		jobID = wiggledb.wiggleDB.insert_job(self.cursor, 101)
+		self.cursor.execute('UPDATE jobs SET status = "DONE" WHERE job_id = ?', (jobID,))
+		wiggledb.wiggleDB.insert_cache_entry(self.cursor, jobID, False, 'sum /d/a.bw /d/b.bw :', False, '/cache/ab.bw')
+		cmd, destination, compute, dependency, nodes = wiggledb.wiggleDB.plan_expression(self.cursor, EXPRESSION, self.directory)
+		self.assertEqual(len(wiggledb.wiggleDB_split.written_files(cmd)), 2)
+		self.assertTrue(' /cache/ab.bw ' in cmd)
+
+	def test_dependency(self):
+		# Attached requests are still split, held on the job they wait on
+		submitted = []
+		def submit(cmds, batch_system='LSF', dependency=None, working_directory=None):
+			submitted.append((cmds, dependency))
+			return 500 + len(submitted), 'temp%i' % len(submitted)
+		original = wiggletools.multiJob.submit
+		wiggletools.multiJob.submit = submit
+		try:
+			res = wiggledb.wiggleDB.run_wiggletools(self.cursor, ['write /d/out.bw sum /d/inflight.bw /d/c.bw :'], self.chrom_sizes, 'SGE', self.directory, 101)
+		finally:
+			wiggletools.multiJob.submit = original
+		self.assertEqual(res, (502, ['temp1', 'temp2']))
+		self.assertEqual([len(X[0]) for X in submitted], [2, 1])
+		self.assertEqual([X[1] for X in submitted], [101, 501])
+
+	def test_whole_genome(self):
+		compute, merge = wiggledb.wiggleDB_split.plan(['profile /d/out.txt 10 /d/r.bb /d/a.bw'], self.chrom_sizes)
+		self.assertEqual(compute, ['wiggletools profile /d/out.txt 10 /d/r.bb /d/a.bw'])
+		self.assertEqual(merge, [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Parsing of the histogram and apply_paste outputs, block by block, with
+# or without numpy.
+#
+# Run with: python -m unittest discover python/tests
+
+import unittest
+
+import wiggledb.wiggleDB_plots
+
+class Parsers(unittest.TestCase):
+	def test_histogram(self):
+		parser = wiggledb.wiggleDB_plots.HistogramParser()
+		parser.feed('0.5\t1\t2\n1.5\t3\t4\n')
+		parser.feed('2.5\t5\t6\n')
+		self.assertEqual(parser.rows(), 3)
+		self.assertEqual(list(parser.values()), [0.5, 1, 2, 1.5, 3, 4, 2.5, 5, 6])
+
+	def test_empty_histogram(self):
+		parser = wiggledb.wiggleDB_plots.HistogramParser()
+		self.assertEqual(parser.rows(), 0)
+		parser.feed('\n')
+		self.assertEqual(parser.rows(), 0)
+
+	def test_overlaps(self):
+		parser = wiggledb.wiggleDB_plots.OverlapParser()
+		parser.feed('1\t0\t10\tname\t0.5\n\n')
+		parser.feed('1\t20\t30\tname\t2\n')
+		self.assertEqual(list(parser.values()), [0.5, 2])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Polls of the batch system, through the scheduler stubs of bench/stubs:
+# according to them, SGE jobs have all finished successfully, LSF jobs are
+# all running. The stubs are wrapped in scripts which log their calls.
+#
+# Run with: python -m unittest discover python/tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_poller
+import wiggledb.wiggleDB_sqlite
+
+STUBS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'bench', 'stubs')
+
+class Poller(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db = os.path.join(self.directory, 'test.db')
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		cursor = conn.cursor()
+		wiggledb.wiggleDB.create_job_table(cursor)
+		wiggledb.wiggleDB.create_cache(cursor)
+		# Two jobs with their own compute step, one attached to the first
+		self.jobs = []
+		for lsfID, dependency, lsfID2 in ((101, None, 102), (201, None, 202), (None, 101, 302)):
+			jobID = wiggledb.wiggleDB.insert_job(cursor, lsfID, dependency=dependency)
+			cursor.execute('UPDATE jobs SET lsf_id2 = ? WHERE job_id = ?', (lsfID2, jobID))
+			self.jobs.append(jobID)
+		conn.commit()
+		conn.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def stub(self, name):
+		# Logs the calls then runs the stub
+		path = os.path.join(self.directory, name)
+		out = open(path, 'w')
+		out.write('#!/bin/sh\necho "$@" >> %s.log\nexec %s "$@"\n' % (path, os.path.join(STUBS, name)))
+		out.close()
+		os.chmod(path, 0755)
+		return path
+
+	def calls(self, name):
+		path = os.path.join(self.directory, name + '.log')
+		if not os.path.exists(path):
+			return []
+		return [X.strip() for X in open(path)]
+
+	def rows(self):
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		res = conn.execute('SELECT job_id, status, batch_status, return_values, polled IS NOT NULL, started IS NOT NULL FROM jobs ORDER BY job_id').fetchall()
+		conn.close()
+		return res
+
+	def test_sge(self):
+		config = {'batch_system': 'SGE', 'qstat': self.stub('qstat'), 'qacct': self.stub('qacct')}
+		poller = wiggledb.wiggleDB_poller.Poller(self.db, config)
+		res = poller.poll()
+		self.assertEqual(sorted(X[0] for X in res), self.jobs)
+		# One listing for all the jobs, whose finish steps are accounted for
+		self.assertEqual(self.calls('qstat'), ['-u *'])
+		self.assertEqual(sorted(self.calls('qacct')), ['-j 102', '-j 202', '-j 302'])
+		for jobID, status, batch_status, values, polled, started in self.rows():
+			self.assertEqual((status, batch_status, values, polled), ('LAUNCHED', 'WAITING', '["0"]', 1))
+
+		# Accounting records are only read once
+		poller.poll()
+		self.assertEqual(len(self.calls('qstat')), 2)
+		self.assertEqual(len(self.calls('qacct')), 3)
+
+	def test_lsf(self):
+		config = {'batch_system': 'LSF', 'bjobs': self.stub('bjobs')}
+		res = wiggledb.wiggleDB_poller.Poller(self.db, config).poll()
+		self.assertEqual(len(self.calls('bjobs')), 1)
+		self.assertEqual(sorted(X[0] for X in res), self.jobs)
+		for jobID, status, batch_status, values, polled, started in self.rows():
+			# Every compute step is running, the attached job's included
+			self.assertEqual((status, batch_status, values, polled, started), ('LAUNCHED', 'WAITING', '["RUN"]', 1, 1))
+
+if __name__ == '__main__':
+	unittest.main()
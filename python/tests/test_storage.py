@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Publication of results by the storage backends: local copies and URLs,
+# and retries of failed uploads.
+#
+# Run with: python -m unittest discover python/tests
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+import wiggledb.wiggleDB_storage
+
+class LocalStorage(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.result = os.path.join(self.directory, 'result 1.bw')
+		out = open(self.result, 'w')
+		out.write('data')
+		out.close()
+		self.storage_directory = os.path.join(self.directory, 'storage')
+		os.mkdir(self.storage_directory)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_working_directory(self):
+		storage = wiggledb.wiggleDB_storage.get_storage(dict())
+		self.assertTrue(isinstance(storage, wiggledb.wiggleDB_storage.LocalStorage))
+		storage.store([self.result])
+		self.assertEqual(os.listdir(self.storage_directory), [])
+		self.assertEqual(storage.path(self.result), self.result)
+		self.assertEqual(storage.url(self.result), 'file://' + self.directory + '/result%201.bw')
+
+	def test_storage_directory(self):
+		storage = wiggledb.wiggleDB_storage.get_storage({'storage_directory': self.storage_directory})
+		storage.store([self.result])
+		copy = os.path.join(self.storage_directory, 'result 1.bw')
+		self.assertEqual(os.listdir(self.storage_directory), ['result 1.bw'])
+		self.assertEqual(open(copy).read(), 'data')
+		self.assertEqual(stat.S_IMODE(os.stat(copy).st_mode), 0644)
+		self.assertEqual(storage.path(self.result), copy)
+		self.assertEqual(storage.url(self.result), 'file://' + self.storage_directory + '/result%201.bw')
+
+	def test_storage_url(self):
+		storage = wiggledb.wiggleDB_storage.get_storage({'storage': 'local', 's3_bucket': 'bucket', 'storage_directory': self.storage_directory, 'storage_url': 'http://example.org/results/'})
+		storage.store([self.result])
+		self.assertTrue(os.path.exists(os.path.join(self.storage_directory, 'result 1.bw')))
+		self.assertEqual(storage.url(self.result), 'http://example.org/results/result%201.bw')
+
+class Retries(unittest.TestCase):
+	def setUp(self):
+		self.delays = []
+		self.time = wiggledb.wiggleDB_storage.time
+		delays = self.delays
+		class Clock(object):
+			def sleep(self, seconds):
+				delays.append(seconds)
+		wiggledb.wiggleDB_storage.time = Clock()
+		self.storage = wiggledb.wiggleDB_storage.get_storage({'s3_bucket': 'bucket', 's3_retries': '3'})
+		self.attempts = dict()
+		self.lock = threading.Lock()
+
+	def tearDown(self):
+		wiggledb.wiggleDB_storage.time = self.time
+
+	def failing_upload(self, failures):
+		# Fails the first uploads of each file
+		def upload(location):
+			with self.lock:
+				self.attempts[location] = self.attempts.get(location, 0) + 1
+				if self.attempts[location] <= failures:
+					raise IOError('Connection reset')
+		return upload
+
+	def test_retry_after_failure(self):
+		self.storage.upload = self.failing_upload(1)
+		self.storage.store(['a.bw', 'b.bw'])
+		self.assertEqual(self.attempts, {'a.bw': 2, 'b.bw': 2})
+		self.assertEqual(self.delays, [1, 1])
+
+	def test_give_up(self):
+		self.storage.upload = self.failing_upload(3)
+		self.assertRaises(IOError, self.storage.store, ['a.bw', 'b.bw'])
+		# Both files are attempted until the retries run out
+		self.assertEqual(self.attempts, {'a.bw': 3, 'b.bw': 3})
+		self.assertEqual(sorted(self.delays), [1, 1, 2, 2])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -23,9 +23,18 @@ import tempfile
 import os
 import os.path
 import json
+import time
+import hashlib
 
 import wiggletools.parallelWiggleTools
 import wiggletools.multiJob
+import wiggledb.wiggleDB_local
+import wiggledb.wiggleDB_dag
+import wiggledb.wiggleDB_storage
+import wiggledb.wiggleDB_sqlite
+import wiggledb.wiggleDB_metrics
+import wiggledb.wiggleDB_cost
+import wiggledb.wiggleDB_split
 
 verbose = False
 
@@ -40,11 +49,19 @@ def read_config_file(filename):
 ## Command line interface
 ###########################################
 
+# Operators whose names contain a dash
+DASHED_OPERATORS = ['t-test']
+
 def normalise_spaces(string):
 	if string is None:
 		return None
-	else:
-		return re.sub("^\W+", "", re.sub("\W+", " ", string))
+	# Decimal points and dashes are only kept in numbers, e.g. thresholds:
+	# any other token with a dot would be read as a file
+	tokens = re.sub("[^\w.-]+", " ", string).split()
+	for token in tokens:
+		if ('.' in token or '-' in token) and token not in DASHED_OPERATORS:
+			wiggledb.wiggleDB_dag.canonical_number(token)
+	return " ".join(tokens)
 
 def get_options():
 	parser = argparse.ArgumentParser(description='WiggleDB backend.')
@@ -56,25 +73,47 @@ def get_options():
 	parser.add_argument('-wb',dest='wb',help='WiggleTools command for B')
 	parser.add_argument('--wiggletools','-w',dest='fun_merge',help='Wiggletools command')
 	parser.add_argument('--emails','-e',dest='emails',help='List of e-mail addresses for reminder',nargs='*')
+	parser.add_argument('--user',dest='user',help='User whose admission limits apply to the request')
 
 	parser.add_argument('--load','-l',dest='load',help='Datasets to load in database')
+	parser.add_argument('--summaries',dest='summaries',help='Directory where to store summaries of the datasets which do not have one yet, alone or after --load')
+	parser.add_argument('--upsert',dest='upsert',help='When loading, insert new datasets and update changed ones, keyed on location', action='store_true')
+	parser.add_argument('--batch_size',dest='batch_size',help='Number of datasets inserted per transaction when loading', type=int, default=10000)
 	parser.add_argument('--load_assembly','-la',dest='load_assembly',help='Assembly name and path to file with chromosome lengths',nargs=2)
 	parser.add_argument('--assembly','-y',dest='assembly',help='File with chromosome lengths')
-	parser.add_argument('--clean',dest='clean',help='Delete cached datasets older than X days', type=int)
+	parser.add_argument('--clean',dest='clean',help='Delete cached datasets older than X days, failed jobs and temporary files. With --dry-run, only list the files which would be deleted', type=int)
+	parser.add_argument('--time_limit',dest='time_limit',help='With --clean, stop after about X seconds, the next run resumes the collection', type=float)
+	parser.add_argument('--threads',dest='threads',help='With --clean, number of files deleted concurrently', type=int, default=8)
 	parser.add_argument('--cache',dest='cache',help='Dump cache info', action='store_true')
+	parser.add_argument('--evict',dest='evict',help='Evict cached datasets until disk usage is under budget (e.g. 500G)')
+	parser.add_argument('--evict_policy',dest='evict_policy',help='Evict least recently (lru) or least frequently (lfu) used datasets first', choices=['lru','lfu'], default='lru')
+	parser.add_argument('--interval',dest='interval',help='With --evict, keep running and check the budget every X seconds', type=float)
 	parser.add_argument('--datasets',dest='datasets',help='Print dataset info', action='store_true')
-	parser.add_argument('--clear_cache',dest='clear_cache',help='Reset cache info', nargs='*')
+	parser.add_argument('--clear_cache',dest='clear_cache',help='Reset cache info: all jobs, results, batches, tiles and queued emails, or only the jobs listed', nargs='*')
 	parser.add_argument('--remember',dest='remember',help='Preserve dataset from garbage collection', action='store_true')
 	parser.add_argument('--dry-run',dest='dry_run',help='Do not run the command, print wiggletools command', action='store_true')
 	parser.add_argument('--result','-r',dest='result',help='Return status or end result of job', type=int)
+	parser.add_argument('--cancel',dest='cancel',help='Cancel running jobs', type=int, nargs='+')
+	parser.add_argument('--batch',dest='batch',help='Submit the batch of requests described in a JSON file (- for stdin), see wiggleDB_batch.py')
+	parser.add_argument('--batch_result',dest='batch_result',help='Return the status or end results of the jobs of a batch', type=int)
 	parser.add_argument('--attributes','-t',dest='attributes',help='Print JSON hash of attributes and values', action='store_true')
 	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
 	parser.add_argument('--config','-c',dest='config',help='Configuration file')
 	parser.add_argument('--annotations','-n',dest='annotations',help='Print list of annotation names', action='store_true')
-	parser.add_argument('--jobs','-j',dest='jobs',help='Print list of jobs',nargs='*')
+	parser.add_argument('--jobs','-j',dest='jobs',help='Print the given jobs, or a page of the latest jobs',nargs='*')
+	parser.add_argument('--status',dest='status',help='With --jobs or --cache, only list entries with these job statuses',nargs='+')
+	parser.add_argument('--before',dest='before',help='With --jobs or --cache, list entries older than this job ID or cache entry, as printed at the end of the previous page',type=int)
+	parser.add_argument('--limit',dest='limit',help='With --jobs or --cache, number of entries per page (0 for all)',type=int,default=100)
+	parser.add_argument('--archive',dest='archive',help='Move finished jobs older than X days, whose results have left the cache, to the archive table',type=int)
+	parser.add_argument('--archived',dest='archived',help='With --jobs, read the archive table',action='store_true')
+	parser.add_argument('--upgrade',dest='upgrade',help='Upgrade the tables of a database created by an older version', action='store_true')
+	parser.add_argument('--index',dest='index',help='Build dataset indexes and refresh query statistics', action='store_true')
+	parser.add_argument('--explain',dest='explain',help='Print the query plan for the dataset selection given with -a', action='store_true')
+	parser.add_argument('--stats',dest='stats',help='Print the recorded metrics and job statistics, as text or in the Prometheus format',nargs='?',const='text',choices=['text','prometheus'])
+	parser.add_argument('--region',dest='region',help='Print the values of -wa over the datasets selected with -a in a single region (chrom:start-end), without going through the batch system')
 
 	options = parser.parse_args()
-	if all(X is None for X in [options.load, options.clean, options.result, options.load_assembly, options.datasets, options.clear_cache]) and not options.cache and not options.attributes and not options.annotations:
+	if all(X is None for X in [options.load, options.summaries, options.clean, options.evict, options.result, options.cancel, options.load_assembly, options.datasets, options.clear_cache, options.stats, options.archive, options.batch, options.batch_result]) and not options.cache and not options.attributes and not options.annotations and not options.index and not options.explain and not options.upgrade:
 		assert options.a is not None, 'No dataset selection to run on'
 		assert options.wa is not None, 'No dataset transformation to run on'
 		assert options.assembly is not None, 'No assembly name specified'
@@ -100,13 +139,21 @@ def get_options():
 ## Creating a database
 ###########################################
 
-def create_database(cursor, filename):
+def create_database(cursor, filename, upsert=False, batch_size=10000):
 	if verbose:
 		print 'Creating database'
 	create_assembly_table(cursor)
 	create_cache(cursor)
 	create_job_table(cursor)
-	create_dataset_table(cursor, filename)
+	wiggledb.wiggleDB_local.create_task_table(cursor)
+	create_catalogue_table(cursor)
+	create_tile_table(cursor)
+	create_summary_table(cursor)
+	create_outbox_table(cursor)
+	create_batch_tables(cursor)
+	wiggledb.wiggleDB_metrics.create_metrics_table(cursor)
+	create_dataset_table(cursor, filename, upsert, batch_size)
+	bump_catalogue_version(cursor)
 
 def create_assembly_table(cursor):
 	cursor.execute('''
@@ -126,11 +173,70 @@ def create_job_table(cursor):
 	job_id INTEGER PRIMARY KEY AUTOINCREMENT,
 	lsf_id int,
 	lsf_id2 int,
+	depends_on int,
 	temp varchar(1000),
-	status varchar(255)
+	status varchar(255),
+	batch_status varchar(255),
+	return_values varchar(1000),
+	polled datetime,
+	submitted datetime,
+	started datetime,
+	finished datetime,
+	user varchar(255),
+	cost_cpu float,
+	cost_memory float,
+	cost_output float
+	)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+	# Finished jobs whose temporary files are still to be cleaned
+	cursor.execute('CREATE INDEX IF NOT EXISTS jobs_temp ON jobs (status) WHERE temp IS NOT NULL')
+	create_job_archive_table(cursor)
+
+# Columns of jobs kept once they are archived
+ARCHIVED_COLUMNS = ['job_id', 'lsf_id', 'lsf_id2', 'status', 'return_values', 'submitted', 'started', 'finished']
+
+def create_job_archive_table(cursor):
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	jobs_archive
+	(
+	job_id INTEGER PRIMARY KEY,
+	lsf_id int,
+	lsf_id2 int,
+	status varchar(255),
+	return_values varchar(1000),
+	submitted datetime,
+	started datetime,
+	finished datetime,
+	archived datetime
 	)
 	''')
 
+def upgrade_job_table(cursor):
+	add_missing_columns(cursor, 'jobs', [
+		('batch_status', 'varchar(255)'),
+		('return_values', 'varchar(1000)'),
+		('polled', 'datetime'),
+		('submitted', 'datetime'),
+		('started', 'datetime'),
+		('finished', 'datetime'),
+		('user', 'varchar(255)'),
+		('cost_cpu', 'float'),
+		('cost_memory', 'float'),
+		('cost_output', 'float'),
+		('depends_on', 'int')
+	])
+	create_job_table(cursor)
+
+def add_missing_columns(cursor, table, columns):
+	existing = [X[1] for X in cursor.execute('PRAGMA table_info(%s)' % table).fetchall()]
+	for name, definition in columns:
+		if name not in existing:
+			if verbose:
+				print 'Adding column %s to %s' % (name, table)
+			cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, definition))
+
 def create_cache(cursor):
 	cursor.execute('''
 	CREATE TABLE IF NOT EXISTS
@@ -141,11 +247,162 @@ def create_cache(cursor):
 	location varchar(1000),
 	remember bit,
 	primary_loc bit,
-	last_query datetime
+	last_query datetime,
+	query_hash char(40),
+	size int,
+	hits int DEFAULT 0,
+	reduction varchar(255),
+	file_count int
+	)
+	''')
+	cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS cache_query_hash ON cache (query_hash)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_job_id ON cache (job_id)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_location ON cache (location)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_reduction ON cache (reduction, file_count)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_last_query ON cache (remember, last_query)')
+
+def query_digest(query):
+	# Cache entries are keyed on a fixed size digest of the query, the full
+	# text is only kept for display
+	if isinstance(query, unicode):
+		query = query.encode('utf-8')
+	return hashlib.sha1(query).hexdigest()
+
+def upgrade_cache(cursor):
+	if 'query_hash' not in [X[1] for X in cursor.execute('PRAGMA table_info(cache)').fetchall()]:
+		if verbose:
+			print 'Adding query digests to cache'
+		cursor.execute('ALTER TABLE cache ADD COLUMN query_hash char(40)')
+		for rowid, query in cursor.execute('SELECT rowid, query FROM cache').fetchall():
+			cursor.execute('UPDATE cache SET query_hash = ? WHERE rowid = ?', (query_digest(query), rowid))
+		# Only keep the latest entry for each query
+		cursor.execute('DELETE FROM cache WHERE rowid NOT IN (SELECT max(rowid) FROM cache GROUP BY query_hash)')
+	add_missing_columns(cursor, 'cache', [
+		('size', 'int'),
+		('hits', 'int DEFAULT 0'),
+		('reduction', 'varchar(255)'),
+		('file_count', 'int')
+	])
+	create_cache(cursor)
+
+def create_tile_table(cursor):
+	# Results of interactive region queries, see wiggleDB_region.py
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	tiles
+	(
+	query_hash char(40),
+	chrom varchar(255),
+	tile int,
+	data text,
+	last_query datetime,
+	PRIMARY KEY (query_hash, chrom, tile)
+	)
+	''')
+
+def create_summary_table(cursor):
+	# Genome wide totals of each dataset, see wiggleDB_summaries.py
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	summaries
+	(
+	location varchar(1000) PRIMARY KEY,
+	path varchar(1000),
+	coverage float,
+	total float,
+	total_squares float,
+	minimum float,
+	maximum float
+	)
+	''')
+
+def create_outbox_table(cursor):
+	# Outgoing emails, see wiggleDB_mailer.py
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	outbox
+	(
+	message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	sender varchar(1000),
+	recipients text,
+	message text,
+	status varchar(255),
+	attempts int,
+	error text,
+	created datetime,
+	next_attempt datetime,
+	sent datetime
 	)
 	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_attempt)')
 
-def create_dataset_table(cursor, filename):
+def create_batch_tables(cursor):
+	# Requests submitted together, see wiggleDB_batch.py
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	batches
+	(
+	batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	shared_job_id int,
+	emails varchar(1000),
+	submitted datetime,
+	reported datetime
+	)
+	''')
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	batch_items
+	(
+	batch_id int,
+	item int,
+	job_id int,
+	request text,
+	PRIMARY KEY (batch_id, item)
+	)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS batch_items_job_id ON batch_items (job_id)')
+
+def upgrade_database(cursor):
+	if verbose:
+		print 'Upgrading database'
+	create_assembly_table(cursor)
+	upgrade_job_table(cursor)
+	wiggledb.wiggleDB_local.create_task_table(cursor)
+	create_catalogue_table(cursor)
+	create_tile_table(cursor)
+	create_summary_table(cursor)
+	create_outbox_table(cursor)
+	create_batch_tables(cursor)
+	wiggledb.wiggleDB_metrics.create_metrics_table(cursor)
+	upgrade_cache(cursor)
+
+def create_catalogue_table(cursor):
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	catalogue
+	(
+	version int
+	)
+	''')
+
+def bump_catalogue_version(cursor):
+	if cursor.execute('SELECT version FROM catalogue').fetchone() is None:
+		cursor.execute('INSERT INTO catalogue (version) VALUES (1)')
+	else:
+		cursor.execute('UPDATE catalogue SET version = version + 1')
+
+def get_catalogue_version(cursor):
+	try:
+		res = cursor.execute('SELECT version FROM catalogue').fetchone()
+	except sqlite3.OperationalError:
+		# Database loaded before the catalogue was versioned
+		return 0
+	if res is None:
+		return 0
+	else:
+		return res[0]
+
+def create_dataset_table(cursor, filename, upsert=False, batch_size=10000):
 	file = open(filename)
 	items = file.readline().strip().split('\t')
 	assert items[:5] == list(('location','name','type','annotation','assembly')), "Badly formed dataset table, please ensure the first five columns refer to location, name, type, annotation and assembly"
@@ -161,13 +418,66 @@ def create_dataset_table(cursor, filename):
 		 '''
 	cursor.execute('\n'.join([header] + [",\n".join(['%s varchar(255)' % X for X in items[5:]])] + [')']))
 
-	cursor.execute('SELECT * FROM datasets').fetchall()
+	cursor.execute('SELECT * FROM datasets LIMIT 0').fetchall()
 	column_names = [X[0] for X in cursor.description]
 	assert column_names == items, 'Mismatch between the expected columns: \n%s\nAnd the columns in file:\n%s' % ("\t".join(column_names), '\t'.join(items))
 
-	for line in file:
-		cursor.execute('INSERT INTO datasets VALUES (%s)' % ",".join("'%s'" % X for X in line.strip().split('\t')))
+	if upsert:
+		# Rows are keyed on location, new values overwrite the old ones
+		cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS datasets_location ON datasets (location)')
+		insert = 'INSERT OR REPLACE INTO datasets VALUES (%s)' % ",".join('?' for X in items)
+	else:
+		insert = 'INSERT INTO datasets VALUES (%s)' % ",".join('?' for X in items)
+	cursor.connection.commit()
+
+	start = time.time()
+	count = 0
+	batch = []
+	for line_number, line in enumerate(file, 2):
+		line = line.rstrip('\r\n')
+		if len(line) == 0:
+			continue
+		row = line.split('\t')
+		if len(row) != len(items):
+			cursor.connection.rollback()
+			file.close()
+			raise AssertionError('Line %i of %s has %i columns, expected %i. %i rows were loaded before it.' % (line_number, filename, len(row), len(items), count))
+		batch.append(row)
+		if len(batch) == batch_size:
+			count += load_dataset_batch(cursor, insert, batch)
+			batch = []
+			if verbose:
+				report_load_progress(count, start)
+	count += load_dataset_batch(cursor, insert, batch)
 	file.close()
+	if verbose:
+		report_load_progress(count, start)
+	create_dataset_indexes(cursor)
+
+def load_dataset_batch(cursor, insert, batch):
+	# Each batch is committed as a single transaction
+	cursor.executemany(insert, batch)
+	cursor.connection.commit()
+	return len(batch)
+
+def report_load_progress(count, start):
+	elapsed = time.time() - start
+	if elapsed > 0:
+		print 'Loaded %i rows in %.1fs (%i rows/sec)' % (count, elapsed, count / elapsed)
+	else:
+		print 'Loaded %i rows' % count
+
+def create_dataset_indexes(cursor):
+	if verbose:
+		print 'Indexing datasets'
+	attributes = sorted(get_dataset_attributes(cursor))
+	for column in ['assembly', 'type', 'annotation', 'name'] + attributes:
+		cursor.execute('CREATE INDEX IF NOT EXISTS datasets_%s ON datasets (%s)' % (column, column))
+	# Every selection is constrained by assembly, and most by type
+	for column in ['type', 'annotation'] + attributes:
+		cursor.execute('CREATE INDEX IF NOT EXISTS datasets_assembly_%s ON datasets (assembly, %s)' % (column, column))
+	cursor.execute('CREATE INDEX IF NOT EXISTS datasets_assembly_type_annotation ON datasets (assembly, type, annotation)')
+	cursor.execute('ANALYZE datasets')
 
 ###########################################
 ## Loading assembly info
@@ -176,7 +486,7 @@ def create_dataset_table(cursor, filename):
 def load_assembly(cursor, assembly_name, chrom_sizes):
 	if verbose:
 		print 'Loading path to assembly chromosome length %s for %s' % (chrom_sizes, assembly_name)
-	cursor.execute('INSERT INTO assemblies VALUES(\'%s\',\'%s\')' % (assembly_name, chrom_sizes))
+	cursor.execute('INSERT INTO assemblies VALUES(?, ?)', (assembly_name, chrom_sizes))
 
 ###########################################
 ## Garbage cleaning 
@@ -190,21 +500,149 @@ def remove_jobs(cursor, jobs):
 	for job in jobs:
 		remove_job(cursor, job)
 
-def clean_database(cursor, days):
-	for location in cursor.execute('SELECT location FROM cache WHERE julianday(\'now\') - julianday(last_query) > %i AND remember = 0' % days).fetchall():
-		if verbose:
-			print 'Removing %s' % location[0]
-		if os.path.exists(location[0]):
-			os.remove(location[0])
-	cursor.execute('DELETE FROM cache WHERE julianday(\'now\') - julianday(last_query) > %i AND remember = 0' % days)
+# Tables of the jobs and of everything derived from them. The datasets,
+# assemblies, dataset summaries and metrics are kept.
+CLEARED_TABLES = ['cache', 'jobs', 'jobs_archive', 'tasks', 'batches', 'batch_items', 'tiles', 'outbox']
 
-	for temp in cursor.execute('SELECT temp FROM jobs WHERE status="DONE" OR status="EMPTY"').fetchall():
+def clear_cache(cursor):
+	for table in CLEARED_TABLES:
+		cursor.execute('DROP TABLE IF EXISTS %s' % table)
+	create_cache(cursor)
+	create_job_table(cursor)
+	wiggledb.wiggleDB_local.create_task_table(cursor)
+	create_batch_tables(cursor)
+	create_tile_table(cursor)
+	create_outbox_table(cursor)
+
+def horizon(days):
+	# Time stamps are compared as text, so that the indexes can be used
+	return '-%i days' % days
+
+def clean_temp_files(temps):
+	# Called once the jobs are committed, see also wiggleDB_gc.py
+	for temp in temps:
 		if verbose:
-			print 'Removing %s and derived files' % temp[0]
-		multiJob.clean_temp_file(temp[0])
+			print 'Removing %s and derived files' % temp
+		wiggletools.multiJob.clean_temp_file(temp)
+
+def archive_jobs(conn, days, batch_size=500):
+	# Moves the finished jobs older than the horizon, whose results have
+	# left the cache, to the archive table. Batches are committed one by
+	# one, so as not to hold the write lock for long, and their temporary
+	# files removed after the commit. Jobs which predate the time stamps
+	# compare as older than any date.
+	cursor = conn.cursor()
+	columns = ", ".join(ARCHIVED_COLUMNS)
+	count = 0
+	while True:
+		jobs = cursor.execute('''
+		SELECT job_id, temp FROM jobs
+		WHERE status IN ("DONE", "EMPTY", "ERROR", "CANCELLED")
+		AND coalesce(finished, polled, submitted, 0) < datetime('now', ?)
+		AND NOT EXISTS (SELECT 1 FROM cache WHERE cache.job_id = jobs.job_id)
+		LIMIT ?
+		''', (horizon(days), batch_size)).fetchall()
+		if len(jobs) == 0:
+			break
+		jobIDs = [X[0] for X in jobs]
+		placeholders = ",".join('?' for X in jobIDs)
+		cursor.execute('INSERT OR REPLACE INTO jobs_archive (%s, archived) SELECT %s, datetime(\'now\') FROM jobs WHERE job_id IN (%s)' % (columns, columns, placeholders), jobIDs)
+		cursor.execute('DELETE FROM jobs WHERE job_id IN (%s)' % placeholders, jobIDs)
+		conn.commit()
+		clean_temp_files([X[1] for X in jobs if X[1] is not None])
+		count += len(jobIDs)
+		if verbose:
+			print 'Archived %i jobs' % count
+	return count
+
+def get_archived_status(cursor, jobID):
+	try:
+		res = cursor.execute('SELECT status FROM jobs_archive WHERE job_id = ?', (jobID,)).fetchone()
+	except sqlite3.OperationalError:
+		# Database created before jobs were archived
+		return None
+	if res is None:
+		return None
+	return res[0]
+
+def file_size(location):
+	# Plots are stored next to their data file
+	res = 0
+	for filename in (location, location + '.png'):
+		if os.path.exists(filename):
+			res += os.path.getsize(filename)
+	return res
 
-	cursor.execute('DELETE FROM cache WHERE job_id IN (SELECT job_id FROM jobs WHERE status = "ERROR")' % days)
-	cursor.execute('DELETE FROM jobs WHERE status = "ERROR"' % days)
+def record_cache_sizes(cursor, jobID):
+	for rowid, location in cursor.execute('SELECT rowid, location FROM cache WHERE job_id = ? AND location IS NOT NULL', (jobID,)).fetchall():
+		cursor.execute('UPDATE cache SET size = ? WHERE rowid = ?', (file_size(location), rowid))
+
+def cache_usage(cursor):
+	# Several entries can share the same file
+	for rowid, location in cursor.execute('SELECT cache.rowid, location FROM cache NATURAL JOIN jobs WHERE size IS NULL AND location IS NOT NULL AND status IN ("DONE", "EMPTY")').fetchall():
+		cursor.execute('UPDATE cache SET size = ? WHERE rowid = ?', (file_size(location), rowid))
+	res = cursor.execute('SELECT sum(size) FROM (SELECT max(size) AS size FROM cache WHERE location IS NOT NULL GROUP BY location)').fetchone()[0]
+	if res is None:
+		return 0
+	return res
+
+def parse_size(string):
+	units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+	string = string.strip().upper().rstrip('B')
+	if len(string) > 0 and string[-1] in units:
+		return int(float(string[:-1]) * units[string[-1]])
+	return int(string)
+
+def evict_cache(cursor, budget, high_water=0.9, low_water=0.75, policy='lru'):
+	# Once usage exceeds the high water mark of the budget, delete the least
+	# recently (lru) or least frequently (lfu) used files which are neither
+	# remembered nor still being computed, down to the low water mark.
+	usage = cache_usage(cursor)
+	if usage <= budget * high_water:
+		cursor.connection.commit()
+		return 0, 0, usage
+
+	if policy == 'lfu':
+		order = 'sum(coalesce(hits, 0)), max(last_query)'
+	else:
+		order = 'max(last_query), sum(coalesce(hits, 0))'
+	candidates = cursor.execute('''
+	SELECT location, max(size) FROM cache NATURAL JOIN jobs
+	WHERE location IS NOT NULL
+	GROUP BY location
+	HAVING max(remember) = 0 AND min(status IN ("DONE", "EMPTY")) = 1
+	ORDER BY %s
+	''' % order).fetchall()
+
+	victims = []
+	reclaimed = 0
+	for location, size in candidates:
+		if usage - reclaimed <= budget * low_water:
+			break
+		victims.append(location)
+		reclaimed += size
+	for location in victims:
+		cursor.execute('DELETE FROM cache WHERE location = ?', (location,))
+	cursor.connection.commit()
+
+	# Files are only deleted once no entry points to them anymore
+	for location in victims:
+		if verbose:
+			print 'Removing %s' % location
+		for filename in (location, location + '.png'):
+			if os.path.exists(filename):
+				os.remove(filename)
+	return len(victims), reclaimed, usage - reclaimed
+
+def evict_cache_loop(conn, budget, high_water, low_water, policy, interval):
+	while True:
+		cursor = conn.cursor()
+		count, reclaimed, usage = evict_cache(cursor, budget, high_water, low_water, policy)
+		print 'Evicted %i files, reclaimed %i bytes, cache now uses %i of %i bytes' % (count, reclaimed, usage, budget)
+		sys.stdout.flush()
+		if interval is None:
+			break
+		time.sleep(interval)
 
 ###########################################
 ## Search datasets
@@ -225,79 +663,134 @@ def get_attribute_values(cursor):
 def get_annotations(cursor, assembly):
 	return cursor.execute('SELECT * FROM datasets WHERE assembly=? AND annotation', (assembly,)).fetchall()
 
-def get_job(cursor, job):
-	res = cursor.execute('SELECT * FROM jobs WHERE job_id = ?', (job,)).fetchall()
+def job_table(archived):
+	if archived:
+		return 'jobs_archive'
+	return 'jobs'
+
+def get_job(cursor, job, archived=False):
+	res = cursor.execute('SELECT * FROM %s WHERE job_id = ?' % job_table(archived), (job,)).fetchall()
 	if len(res) == 0:
-		return [job, None, None, None, None, None]
+		return [job] + [None] * (len(cursor.description) - 1)
 	else:
 		return res[0]
 
-def get_jobs(cursor, joblist):
-	if len(joblist) == 0:
-		res = cursor.execute('SELECT * FROM jobs').fetchall()
-	else:
-		res = [get_job(cursor, X) for X in joblist]
+def get_jobs(cursor, joblist, archived=False):
+	res = [get_job(cursor, X, archived) for X in joblist]
+	return [[X[0] for X in cursor.description]] + res
+
+def list_page(cursor, query, conditions, params, key, before, limit):
+	# Pages are read backwards from the latest rows, the key of the last
+	# row printed is passed as before to read the next page
+	if before is not None:
+		conditions = conditions + ['%s < ?' % key]
+		params = params + [before]
+	if len(conditions) > 0:
+		query += ' WHERE ' + " AND ".join(conditions)
+	query += ' ORDER BY %s DESC LIMIT ?' % key
+	# A limit of 0 lists everything
+	res = cursor.execute(query, params + [limit or -1]).fetchall()
 	return [[X[0] for X in cursor.description]] + res
 
+def list_jobs(cursor, statuses=None, before=None, limit=100, archived=False):
+	conditions = []
+	params = []
+	if statuses is not None:
+		conditions.append('status IN (%s)' % ",".join('?' for X in statuses))
+		params += statuses
+	return list_page(cursor, 'SELECT * FROM %s' % job_table(archived), conditions, params, 'job_id', before, limit)
+
+def list_cache(cursor, statuses=None, before=None, limit=100):
+	# Filtered on the status of the jobs which produced the entries
+	if statuses is None:
+		return list_page(cursor, 'SELECT rowid AS entry, * FROM cache', [], [], 'rowid', before, limit)
+	else:
+		return list_page(cursor, 'SELECT cache.rowid AS entry, cache.* FROM cache JOIN jobs ON jobs.job_id = cache.job_id', ['jobs.status IN (%s)' % ",".join('?' for X in statuses)], statuses, 'cache.rowid', before, limit)
+
+def print_page(rows, limit):
+	print "\n".join("\t".join(map(str, X)) for X in rows)
+	if limit and len(rows) - 1 == limit:
+		print >>sys.stderr, 'More rows with --before %s' % rows[-1][0]
+
 def get_datasets(cursor):
 	res = cursor.execute('SELECT * FROM datasets').fetchall()
 	return [[X[0] for X in cursor.description]] + res
 
 def attribute_selector(attribute, params):
-	return "( %s )" % " OR ".join("%s=:%s_%i" % (attribute,attribute,index) for index in range(len(params[attribute])))
+	return "%s IN ( %s )" % (attribute, ", ".join(":%s_%i" % (attribute,index) for index in range(len(params[attribute]))))
 
 def denormalize_params(params):
 	return dict(("%s_%i" % (attribute, index),value) for attribute in params for (index, value) in enumerate(params[attribute]))
 
-def get_dataset_locations(cursor, params, assembly):
+def dataset_query(params, assembly):
 	# Quick check that all the keys are purely alphanumeric to avoid MySQL injections
 	assert not any(re.match('\W', X) is not None for X in params)
 	params['assembly'] = [assembly]
-	query = " AND ".join(attribute_selector(X, params) for X in params)
+	return 'SELECT location FROM datasets WHERE ' + " AND ".join(attribute_selector(X, params) for X in params)
+
+@wiggledb.wiggleDB_metrics.timed('dataset_selection_seconds')
+def get_dataset_locations(cursor, params, assembly):
+	query = dataset_query(params, assembly)
 	if verbose:
-		print 'Query: SELECT location FROM datasets WHERE ' + query
+		print 'Query: ' + query
 		print 'Where:' + str(denormalize_params(params))
-	res = cursor.execute('SELECT location FROM datasets WHERE ' + query, denormalize_params(params)).fetchall()
+	res = cursor.execute(query, denormalize_params(params)).fetchall()
 	if verbose:
 		print 'Found:\n' + "\n".join(X[0] for X in res)
 	return sorted(X[0] for X in res)
 
+def explain_dataset_query(cursor, params, assembly):
+	return cursor.execute('EXPLAIN QUERY PLAN ' + dataset_query(params, assembly), denormalize_params(params)).fetchall()
+
 ###########################################
 ## Search cache
 ###########################################
 
 def reset_time_stamp(cursor, cmd):
-	cursor.execute('UPDATE cache SET last_query= date(\'now\') WHERE query = \'%s\'' % cmd)
+	cursor.execute('UPDATE cache SET last_query= datetime(\'now\'), hits = coalesce(hits, 0) + 1 WHERE query_hash = ?', (query_digest(cmd),))
 
+@wiggledb.wiggleDB_metrics.timed('cache_lookup_seconds')
 def get_precomputed_jobID(cursor, cmd):
-	reset_time_stamp(cursor, cmd)
-	reports = cursor.execute('SELECT job_id FROM cache WHERE query = \'%s\'' % cmd).fetchall()
+	# Misses write nothing, so that new requests are estimated and admitted
+	# before the first write
+	reports = cursor.execute('SELECT job_id FROM cache WHERE query_hash = ?', (query_digest(cmd),)).fetchall()
 	if len(reports) == 0:
 		if verbose:
 			print 'Did not find prior job for query: %s' % cmd
 		return None
 	else:
+		reset_time_stamp(cursor, cmd)
 		if verbose:
 			print 'Found prior job for query: %s' % cmd
 			print reports[0][0]
 		return reports[0][0]
 
 def get_job_location_2(cursor, jobID):
-	reports = cursor.execute('SELECT location FROM cache WHERE job_id = \'%s\' and primary_loc=1' % jobID).fetchall()
-	assert len(reports) == 1
+	reports = cursor.execute('SELECT location FROM cache WHERE job_id = ? and primary_loc=1', (jobID,)).fetchall()
+	assert len(reports) <= 1
+	if len(reports) == 0:
+		# Result evicted from the cache
+		return None
 	return reports[0][0]
 
 def get_job_location(db, jobID):
-	connection = sqlite3.connect(db)
+	connection = wiggledb.wiggleDB_sqlite.connect(db)
 	cursor = connection.cursor()
 	res = get_job_location_2(cursor, jobID)
 	connection.close()
 	return res
 
+@wiggledb.wiggleDB_metrics.timed('cache_lookup_seconds')
 def get_precomputed_location(cursor, cmd):
-	reports = cursor.execute('SELECT location FROM jobs NATURAL JOIN cache WHERE (status="DONE" OR status="EMPTY") AND query = ?', (cmd,)).fetchall()
-	if len(reports) > 0:
+	location = find_precomputed_location(cursor, cmd)
+	if location is not None:
 		reset_time_stamp(cursor, cmd)
+	return location
+
+def find_precomputed_location(cursor, cmd):
+	# Read only, the caller resets the time stamp
+	reports = cursor.execute('SELECT location FROM jobs NATURAL JOIN cache WHERE (status="DONE" OR status="EMPTY") AND query_hash = ?', (query_digest(cmd),)).fetchall()
+	if len(reports) > 0:
 		if verbose:
 			print 'Found pre-computed file for query: %s' % cmd
 			print reports[0]
@@ -307,13 +800,141 @@ def get_precomputed_location(cursor, cmd):
 			print 'Did not find pre-computed file for query: %s' % cmd
 		return None
 
-def reuse_or_write_precomputed_location(cursor, cmd, working_directory):
+def insert_cache_entry(cursor, jobID, primary, query, remember, location, reduction=None, file_count=None):
+	cursor.execute('INSERT OR REPLACE INTO cache (job_id,primary_loc,query,query_hash,remember,last_query,location,reduction,file_count) VALUES (?,?,?,?,?,datetime(\'now\'),?,?,?)', (jobID, int(primary), query, query_digest(query), int(remember), location, reduction, file_count))
+
+###########################################
+## Incremental reductions
+###########################################
+
+# Reductions which can be computed from a cached result over a subset of
+# the files, combined with the remaining files
+DECOMPOSABLE_REDUCTIONS = ['sum', 'min', 'max', 'mean', 'unit sum', 'unit mult']
+
+def get_cached_subset(cursor, fun, data):
+	# Largest finished result of the same reduction over a strict subset of
+	# the files. Subsets smaller than half the selection are not worth it.
+	files = set(data)
+	candidates = cursor.execute('SELECT query, location, file_count FROM cache NATURAL JOIN jobs WHERE status = "DONE" AND reduction = ? AND file_count < ? AND file_count * 2 >= ? ORDER BY file_count DESC', (fun, len(data), len(data))).fetchall()
+	for query, location, file_count in candidates:
+		subset = query[len(fun) + 1:-2].split(' ')
+		if len(subset) == file_count and files.issuperset(subset) and os.path.exists(location):
+			return query, location, subset
+	return None
+
+def incremental_form(cursor, fun, data):
+	if fun not in DECOMPOSABLE_REDUCTIONS:
+		return None
+	subset = get_cached_subset(cursor, fun, data)
+	if subset is None:
+		return None
+
+	query, location, files = subset
+	reset_time_stamp(cursor, query)
+	files = set(files)
+	rest = [X for X in data if X not in files]
+	if verbose:
+		print 'Reusing %s over %i files, %i files left to compute' % (location, len(files), len(rest))
+	if fun == 'mean':
+		# Mean over all files from the mean over the subset
+		return " ".join(['scale', repr(1.0 / len(data)), 'sum', 'scale', str(len(files)), location] + rest + [':'])
+	else:
+		return " ".join([fun, location] + rest + [':'])
+
+def get_inflight_location(cursor, cmd):
+	# Intermediate results are produced by the first step of their job
+	reports = cursor.execute('SELECT location, lsf_id FROM jobs NATURAL JOIN cache WHERE status="LAUNCHED" AND primary_loc=0 AND lsf_id IS NOT NULL AND location IS NOT NULL AND query_hash = ?', (query_digest(cmd),)).fetchall()
+	if len(reports) > 0:
+		if verbose:
+			print 'Found job in flight for query: %s' % cmd
+			print reports[0]
+		return reports[0]
+	else:
+		return None
+
+def reuse_or_write_precomputed_location(cursor, cmd, working_directory, dependency=None, fun=None, data=None):
 	pre_location = get_precomputed_location(cursor, cmd)
 	if pre_location is not None:
-		return pre_location, pre_location, False
+		wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='hit')
+		return pre_location, pre_location, False, dependency
+
+	# Attach to an identical computation which is still running. Only one
+	# batch job can be waited on, as parallelWiggleTools and multiJob
+	# accept a single dependency.
+	inflight = get_inflight_location(cursor, cmd)
+	if inflight is not None and (dependency is None or dependency == inflight[1]):
+		wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='inflight')
+		reset_time_stamp(cursor, cmd)
+		return inflight[0], inflight[0], False, inflight[1]
+
+	fh, destination = tempfile.mkstemp(suffix='.bw',dir=working_directory)
+	if fun is not None:
+		incremental_cmd = incremental_form(cursor, fun, data)
+		if incremental_cmd is not None:
+			wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='incremental')
+			return 'write %s %s' % (destination, incremental_cmd), destination, True, dependency
+	wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='miss')
+	return 'write %s %s' % (destination, cmd), destination, True, dependency
+
+def plan_node(cursor, node, working_directory, dependency, nodes, planned):
+	# Returns the text computing the node, the file which will hold its
+	# result, and the batch job to wait on. Intermediate nodes are read from
+	# the cache, shared with a job in flight, or written to a new file.
+	if node.is_leaf():
+		return node.canonical, node.canonical, dependency
+	if node.canonical in planned:
+		# Already being written by this command, cannot be read back
+		return planned[node.canonical], None, dependency
+
+	pre_location = get_precomputed_location(cursor, node.canonical)
+	if pre_location is not None:
+		wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='hit')
+		return pre_location, pre_location, dependency
+
+	inflight = get_inflight_location(cursor, node.canonical)
+	if inflight is not None and (dependency is None or dependency == inflight[1]):
+		wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='inflight')
+		reset_time_stamp(cursor, node.canonical)
+		return inflight[0], inflight[0], inflight[1]
+
+	reduction = node.reduction()
+	if reduction is not None:
+		expression = incremental_form(cursor, reduction[0], reduction[1])
+	else:
+		expression = None
+	if expression is not None:
+		wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='incremental')
 	else:
-		fh, destination = tempfile.mkstemp(suffix='.bw',dir=working_directory)
-		return 'write %s %s' % (destination, cmd), destination, True
+		wiggledb.wiggleDB_metrics.increment('intermediate_cache_lookups_total', result='miss')
+		operands = []
+		for child in node.children:
+			text, location, dependency = plan_node(cursor, child, working_directory, dependency, nodes, planned)
+			operands.append(text)
+		expression = node.render(operands)
+
+	fh, destination = tempfile.mkstemp(suffix='.bw',dir=working_directory)
+	planned[node.canonical] = expression
+	if reduction is not None:
+		nodes.append((node.canonical, destination, reduction[0], len(reduction[1])))
+	else:
+		nodes.append((node.canonical, destination, None, None))
+	return 'write %s %s' % (destination, expression), destination, dependency
+
+def plan_expression(cursor, cmd, working_directory, dependency=None):
+	# Returns the command, its destination, whether anything needs computing,
+	# the batch job to wait on, and the cache entries of the new files
+	try:
+		root = wiggledb.wiggleDB_dag.parse(cmd)
+	except ValueError:
+		cmd2, destination, compute, dependency = reuse_or_write_precomputed_location(cursor, cmd, working_directory, dependency)
+		if compute:
+			return cmd2, destination, True, dependency, [(cmd, destination, None, None)]
+		else:
+			return cmd2, destination, False, dependency, []
+
+	nodes = []
+	cmd2, destination, dependency = plan_node(cursor, root, working_directory, dependency, nodes, dict())
+	return cmd2, destination, cmd2 != destination, dependency, nodes
 
 def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, batch_system):
 	destination = None
@@ -324,7 +945,7 @@ def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, option
 	options.apply_paste = None
 
 	cmd_A = " ".join([fun_A] + data_A + [':'])
-	cmd_A2, destinationA, computeA = reuse_or_write_precomputed_location(cursor, cmd_A, options.working_directory)
+	cmd_A2, destinationA, computeA, dependency, nodes = plan_expression(cursor, cmd_A, options.working_directory)
 
 	if data_B is not None:
 		merge_words = fun_merge.split(' ')
@@ -332,7 +953,8 @@ def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, option
 		assert fun_merge is not None
 		if fun_B is not None:
 			cmd_B = " ".join([fun_B] + data_B + [':'])
-			cmd_B2, destinationB, computeB = reuse_or_write_precomputed_location(cursor, cmd_B, options.working_directory)
+			cmd_B2, destinationB, computeB, dependency, nodesB = plan_expression(cursor, cmd_B, options.working_directory, dependency)
+			nodes += nodesB
 		else:
 			cmd_B2 = " ".join(data_B)
 			computeB = False
@@ -370,31 +992,30 @@ def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, option
 			cmds = [" ".join(['write', destination, fun_merge, cmd_A2, cmd_B2])]
 	else:
 		computeB = False
-		cmds = [cmd_A2]
+		if computeA:
+			cmds = [cmd_A2]
+		else:
+			cmds = []
 		destination = destinationA
-		destinationA = None
 
 	chrom_sizes = get_chrom_sizes(cursor, options.assembly)
+	# Cache time stamps are not worth holding the write lock while jobs are submitted
+	conn.commit()
 	if len(cmds) > 0:
-		lsfID, options.temps = parallelWiggleTools.run(cmds, chrom_sizes, batch_system=batch_system, tmp=options.working_directory)
-		cursor.execute('INSERT INTO jobs (lsf_id, status) VALUES (?, "LAUNCHED")', (lsfID,))
-		jobID = cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
-		cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',1,\'%s\',\'%i\',date(\'now\'),\'%s\')' % (jobID, normalised_form, int(options.remember), destination))
-		if computeA: 
-			cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',0,\'%s\',\'0\',date(\'now\'),\'%s\')' % (jobID, cmd_A, destinationA))
-		if computeB:
-			cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',0,\'%s\',\'0\',date(\'now\'),\'%s\')' % (jobID, cmd_B, destinationB))
+		with wiggledb.wiggleDB_metrics.timer('job_submission_seconds', step='compute'):
+			lsfID, options.temps = run_wiggletools(cursor, cmds, chrom_sizes, batch_system, options.working_directory, dependency)
+		jobID = insert_job(cursor, lsfID, getattr(options, 'user', None), getattr(options, 'estimate', None), dependency)
+		insert_cache_entry(cursor, jobID, True, normalised_form, options.remember, destination)
+		for query, location, reduction, file_count in nodes:
+			insert_cache_entry(cursor, jobID, False, query, False, location, reduction, file_count)
 		conn.commit()
 	else:
-		lsfID = None
-		cursor.execute('INSERT INTO jobs (lsf_id, status) VALUES (NULL, "LAUNCHED")')
-		jobID = cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
-		if options.histogram is not None:
-			cmd = options.histogram
-		elif options.apply_paste is not None:
-			cmd = options.apply_paste
-		assert cmd is not None and destination is not None
-		cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',1,\'%s\',\'%i\',date(\'now\'),\'%s\')' % (jobID, cmd, int(options.remember), destination))
+		# Nothing to compute, or only waiting on jobs in flight, whose
+		# compute steps belong to their own jobs
+		lsfID = dependency
+		jobID = insert_job(cursor, None, getattr(options, 'user', None), getattr(options, 'estimate', None), dependency)
+		assert destination is not None
+		insert_cache_entry(cursor, jobID, True, normalised_form, options.remember, destination)
 		options.temps = None
 
 	options.jobID = jobID
@@ -409,28 +1030,70 @@ def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, option
 	else:
 		options.labels = None
 
-	fh, options_file = tempfile.mkstemp(dir=options.working_directory)
+	options_file = write_options_file(options.__dict__, options.working_directory)
+	finishCmd = 'wiggleDB_finish.py ' + options_file
+	with wiggledb.wiggleDB_metrics.timer('job_submission_seconds', step='finish'):
+		lsfID2, temp = submit_commands(cursor, [finishCmd], batch_system, lsfID, options.working_directory)
+	cursor.execute('UPDATE jobs SET lsf_id2 = ?, temp = ? WHERE job_id = ?', (lsfID2, temp, jobID))
+	return jobID
+
+def insert_job(cursor, lsfID, user=None, estimate=None, dependency=None):
+	# lsfID is the compute step submitted for this job, if any, dependency
+	# the batch job it waits on. The estimate is kept to account for the job
+	# until it finishes
+	if estimate is None:
+		estimate = dict()
+	cursor.execute('INSERT INTO jobs (lsf_id, depends_on, status, submitted, user, cost_cpu, cost_memory, cost_output) VALUES (?, ?, "LAUNCHED", datetime(\'now\'), ?, ?, ?, ?)', (lsfID, dependency, user, estimate.get('cpu_seconds'), estimate.get('memory_mb'), estimate.get('output_mb')))
+	return cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
+
+def write_options_file(options, working_directory):
+	fh, options_file = tempfile.mkstemp(dir=working_directory)
 	# To ensure object can be serialised and to avoid side effects
 	f = open(options_file, 'w')
-	json.dump(options.__dict__, f)
+	json.dump(options, f)
 	f.close()
-	finishCmd = 'wiggleDB_finish.py ' + options_file
-	lsfID2, temp = multiJob.submit([finishCmd], batch_system=batch_system, dependency=lsfID, working_directory=options.working_directory)
-	cursor.execute('UPDATE jobs SET lsf_id2=\'%s\',temp=\'%s\' WHERE job_id=\'%s\'' % (lsfID2, temp, jobID))
-	return jobID
+	return options_file
+
+def run_wiggletools(cursor, cmds, chrom_sizes, batch_system, working_directory, dependency=None):
+	if batch_system == 'local':
+		taskID, temp = wiggledb.wiggleDB_local.submit(cursor, ['wiggletools ' + X for X in cmds], dependency, working_directory)
+		return taskID, [temp]
+	elif dependency is not None or any(wiggledb.wiggleDB_split.nested_writes(X) for X in cmds):
+		# parallelWiggleTools cannot wait on another job, and would have
+		# every chromosome write the same intermediate files
+		return wiggledb.wiggleDB_split.run(cmds, chrom_sizes, batch_system, working_directory, dependency)
+	else:
+		return wiggletools.parallelWiggleTools.run(cmds, chrom_sizes, batch_system=batch_system, tmp=working_directory)
+
+def submit_commands(cursor, cmds, batch_system, dependency, working_directory):
+	if batch_system == 'local':
+		return wiggledb.wiggleDB_local.submit(cursor, cmds, dependency, working_directory)
+	else:
+		return wiggletools.multiJob.submit(cmds, batch_system=batch_system, dependency=dependency, working_directory=working_directory)
 
 def get_chrom_sizes(cursor, assembly):
-	res = cursor.execute('SELECT location FROM assemblies WHERE name = \'%s\'' % (assembly)).fetchall()
+	res = cursor.execute('SELECT location FROM assemblies WHERE name = ?', (assembly,)).fetchall()
 	return res[0][0]
 
 def make_normalised_form(fun_merge, fun_A, data_A, fun_B, data_B):
-	cmd_A = " ".join([fun_A] + data_A)
+	# Normalised forms drop the final ':', so as to differ from the cache
+	# keys of the intermediate results
+	expression_A = wiggledb.wiggleDB_dag.canonical_form(" ".join([fun_A] + data_A + [':']))
+	cmd_A = expression_A[:-2]
+	cmd_B = None
 	if data_B is not None:
 		if fun_B is not None:
-			cmd_B = " ".join([fun_B] + data_B)
+			expression_B = wiggledb.wiggleDB_dag.canonical_form(" ".join([fun_B] + data_B + [':']))
+			cmd_B = expression_B[:-2]
 		else:
-			cmd_B = " ".join(data_B)
+			expression_B = cmd_B = " ".join(data_B)
 		res = "; ".join([fun_merge, cmd_A, cmd_B])
+		if fun_merge.split(' ')[0] not in ['histogram', 'profile', 'profiles', 'apply_paste']:
+			# Equivalent merges, e.g. commutative ones, share a normalised form
+			try:
+				res = wiggledb.wiggleDB_dag.parse(" ".join([fun_merge, expression_A, expression_B])).canonical
+			except ValueError:
+				pass
 	else:
 		res = cmd_A
 
@@ -441,6 +1104,45 @@ def make_normalised_form(fun_merge, fun_A, data_A, fun_B, data_B):
 
 	return res
 
+###########################################
+## Cost estimates
+###########################################
+
+def pending_result(cursor, fun, data):
+	# Result file of a reduction which is cached or in flight
+	if fun is None:
+		return None
+	reports = cursor.execute('SELECT location FROM jobs NATURAL JOIN cache WHERE status IN ("DONE", "EMPTY", "LAUNCHED") AND query_hash = ?', (query_digest(wiggledb.wiggleDB_dag.canonical_form(" ".join([fun] + data + [':']))),)).fetchall()
+	if len(reports) > 0:
+		return reports[0][0]
+	return None
+
+def pending_inputs(cursor, fun, data):
+	# Files which the jobs of a request will read: a reduction which is
+	# cached or in flight only counts as its result file, one computed
+	# incrementally as the cached subset and the remaining files
+	result = pending_result(cursor, fun, data)
+	if result is not None:
+		return [result]
+	if fun in DECOMPOSABLE_REDUCTIONS:
+		subset = get_cached_subset(cursor, fun, data)
+		if subset is not None:
+			files = set(subset[2])
+			return [subset[1]] + [X for X in data if X not in files]
+	return data
+
+def estimate_request(cursor, options, data_A, data_B, config):
+	sides = []
+	computed = []
+	for fun, data, params in ((options.wa, data_A, options.a), (options.wb, data_B, options.b)):
+		if data is None:
+			continue
+		computed.append(fun is not None and pending_result(cursor, fun, data) is None)
+		sides.append((fun, pending_inputs(cursor, fun, data), params))
+	if not wiggledb.wiggleDB_cost.computes(options.fun_merge, computed):
+		return wiggledb.wiggleDB_cost.attached_estimate(cursor, config)
+	return wiggledb.wiggleDB_cost.estimate(cursor, config, sides, options.fun_merge, get_chrom_sizes(cursor, options.assembly))
+
 def request_compute(conn, cursor, options, config, batch_system):
 	fun_A = options.wa 
 	data_A = get_dataset_locations(cursor, options.a, options.assembly)
@@ -463,17 +1165,34 @@ def request_compute(conn, cursor, options, config, batch_system):
 	normalised_form = make_normalised_form(options.fun_merge, fun_A, data_A, fun_B, data_B)
 	prior_jobID = get_precomputed_jobID(cursor, normalised_form)
 	if prior_jobID is not None:
+		wiggledb.wiggleDB_metrics.increment('result_cache_lookups_total', result='hit')
 		res = query_result(cursor, prior_jobID, batch_system)
 		options.jobID = res['ID']
 		if res['status'] == 'DONE':
 			options.data = res['location']
-			report_to_user(options, config)
+			report_to_user(options, config, cursor)
 		else:
-			acknowledge_job_to_user(options, config)
+			acknowledge_job_to_user(options, config, cursor)
 	else:
-		res = {'ID':launch_compute(conn, cursor, options.fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, batch_system), 'status':'LAUNCHED'}
+		wiggledb.wiggleDB_metrics.increment('result_cache_lookups_total', result='miss')
+		options.estimate = estimate_request(cursor, options, data_A, data_B, config)
+		# Batches are admitted as a whole
+		if not getattr(options, 'admitted', False):
+			refusal = wiggledb.wiggleDB_cost.admit(cursor, options.estimate, getattr(options, 'user', None), config)
+			if refusal is not None:
+				return refusal
+			# Accounted for until the job is recorded, as launch_compute
+			# commits before submitting it
+			reservation = wiggledb.wiggleDB_cost.reserve(cursor, options.estimate, getattr(options, 'user', None))
+		else:
+			reservation = None
+		try:
+			res = {'ID':launch_compute(conn, cursor, options.fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, batch_system), 'status':'LAUNCHED', 'estimate':options.estimate}
+		finally:
+			if reservation is not None:
+				wiggledb.wiggleDB_cost.release(cursor, reservation)
 		options.jobID = res['ID']
-		acknowledge_job_to_user(options, config)
+		acknowledge_job_to_user(options, config, cursor)
 
 	return res
 
@@ -482,14 +1201,18 @@ def request_compute(conn, cursor, options, config, batch_system):
 ## Querying jobs
 ####################################################
 
+@wiggledb.wiggleDB_metrics.timed('scheduler_poll_seconds', command='qstat')
 def sge_job_running(lsfID):
 	return subprocess.Popen(['qstat','-j',str(lsfID)], stdout=subprocess.PIPE, stderr=subprocess.PIPE).wait() == 0
 
-def sge_job_return_values(lsfID):
-	p = subprocess.Popen(['qacct','-j',str(lsfID)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	p.wait()
+@wiggledb.wiggleDB_metrics.timed('scheduler_poll_seconds', command='qacct')
+def sge_job_return_values(lsfID, qacct='qacct'):
+	p = subprocess.Popen([qacct,'-j',str(lsfID)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	(stdout, stderr) = p.communicate()
 	assert p.returncode == 0, 'Error when polling SGE job %i' % lsfID
+	return parse_qacct(stdout)
+
+def parse_qacct(stdout):
 	values = []
 	failedTask = False
 	for line in stdout.split('\n'):
@@ -505,34 +1228,78 @@ def sge_job_return_values(lsfID):
 	return values
 
 def mark_job_status2(cursor, jobID, status):
-	cursor.execute('UPDATE jobs SET status = \'%s\' WHERE job_id = \'%s\'' % (status, jobID))
+	# Only ever called with final statuses
+	cursor.execute('UPDATE jobs SET status = ?, finished = coalesce(finished, datetime(\'now\')) WHERE job_id = ?', (status, jobID))
 
-def mark_job_status(db, jobID, status):
-	conn = sqlite3.connect(db)
-	cursor = conn.cursor()
+def update_job_status(cursor, jobID, status):
 	mark_job_status2(cursor, jobID, status)
-	conn.commit()
-	conn.close()
+	if status == 'DONE' or status == 'EMPTY':
+		record_cache_sizes(cursor, jobID)
+
+def mark_job_status(db, jobID, status, config=None):
+	wiggledb.wiggleDB_sqlite.write(db, update_job_status, jobID, status)
+	if config is not None and 'notify_url' in config:
+		notify_server(config['notify_url'], jobID)
+
+def notify_server(url, jobID):
+	# Wakes up the clients of wiggleWSGI.py waiting on this job. Best effort
+	# only, the server also checks the database regularly.
+	import urllib2
+	if '?' in url:
+		url += '&'
+	else:
+		url += '?'
+	try:
+		urllib2.urlopen(url + 'notify=%i' % int(jobID), timeout=5).read()
+	except Exception:
+		if verbose:
+			print 'Could not notify %s of job %s' % (url, jobID)
 
 def query_result(cursor, jobID, batch_system):
-	reports = cursor.execute('SELECT status, lsf_id, lsf_id2 FROM jobs WHERE job_id =?', (jobID,)).fetchall()
+	# Jobs attached to others wait on the compute step of their owner
+	reports = cursor.execute('SELECT status, coalesce(lsf_id, depends_on), lsf_id2, batch_status, return_values, polled FROM jobs WHERE job_id =?', (jobID,)).fetchall()
 
 	if len(reports) == 0:
+		archived = get_archived_status(cursor, jobID)
+		if archived == 'DONE':
+			# Archived jobs have no result left in the cache
+			return {'ID':jobID, 'status':'EXPIRED'}
+		elif archived is not None:
+			return {'ID':jobID, 'status':archived}
 		return {'ID':jobID, 'status':'UNKNOWN'}
 	else:
 		assert len(reports) == 1, 'Found %i status reports for job %s' % (len(reports), jobID)
 
-	status, lsfID, lsfID2 = reports[0]
+	status, lsfID, lsfID2, batch_status, return_values, polled = reports[0]
 	if status == 'DONE':
-		return {'ID':jobID, 'status':'DONE', 'location':get_job_location_2(cursor, jobID)}
+		location = get_job_location_2(cursor, jobID)
+		if location is None:
+			return {'ID':jobID, 'status':'EXPIRED'}
+		return {'ID':jobID, 'status':'DONE', 'location':location}
 	elif status == 'EMPTY':
 		return {'ID':jobID, 'status':'EMPTY'}
-	elif status == 'ERROR' or lsfID is None or lsfID2 is None:
+	elif status == 'CANCELLED':
+		return {'ID':jobID, 'status':'CANCELLED'}
+	elif status == 'ERROR' or lsfID2 is None:
 		return {'ID':jobID, 'status':'ERROR'}
+	elif polled is not None:
+		# Job status is kept up to date by wiggleDB_poller.py
+		res = {'ID':jobID, 'status':batch_status, 'LSF_ID':lsfID}
+		if return_values is not None:
+			res['return_values'] = json.loads(return_values)
+		return res
+	elif batch_system == 'local':
+		values = [wiggledb.wiggleDB_local.task_status(cursor, X) for X in (lsfID, lsfID2)]
+		if any(X[0] in ('ERROR', 'CANCELLED') for X in values):
+			mark_job_status2(cursor, jobID, 'ERROR')
+			return {'ID':jobID, 'status':"ERROR", 'return_values':[X[1] for X in values]}
+		else:
+			return {'ID':jobID, 'status':"WAITING", 'return_values':[X[0] for X in values]}
 	elif batch_system == 'LSF':
-		p = subprocess.Popen(['bjobs','-noheader',str(lsfID2)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		ret = p.wait()
-		(stdout, stderr) = p.communicate()
+		with wiggledb.wiggleDB_metrics.timer('scheduler_poll_seconds', command='bjobs'):
+			p = subprocess.Popen(['bjobs','-noheader',str(lsfID2)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			ret = p.wait()
+			(stdout, stderr) = p.communicate()
 		assert ret == 0, 'Error when polling LSF job %i' % lsfID2
 		values = []
 		for line in stdout.split('\n'):
@@ -542,7 +1309,7 @@ def query_result(cursor, jobID, batch_system):
 		return {'ID':jobID, 'status':"WAITING", 'return_values':values}
 	elif batch_system == 'SGE':
 		if sge_job_running(lsfID2):
-			if sge_job_running(lsfID):
+			if lsfID is None or sge_job_running(lsfID):
 				return {'ID':jobID, 'status':"WAITING", 'LSF_ID':lsfID}
 			else:
 				values = sge_job_return_values(lsfID)
@@ -563,35 +1330,65 @@ def query_result(cursor, jobID, batch_system):
 		raise NameError
 		return {'ID':jobID, 'status':'CONFIG_ERROR'}
 
+def cancel_job(cursor, jobID, batch_system):
+	reports = cursor.execute('SELECT status, lsf_id, lsf_id2 FROM jobs WHERE job_id = ?', (jobID,)).fetchall()
+	if len(reports) == 0 or reports[0][0] != 'LAUNCHED':
+		return query_result(cursor, jobID, batch_system)
+
+	# Only the steps submitted for this job, not those it depends on
+	status, lsfID, lsfID2 = reports[0]
+	if lsfID is not None and hand_over_step(cursor, jobID, lsfID):
+		lsfID = None
+	for batchID in (lsfID2, lsfID):
+		if batchID is None:
+			continue
+		elif batch_system == 'local':
+			wiggledb.wiggleDB_local.cancel(cursor, batchID)
+		elif batch_system == 'SGE':
+			subprocess.call(['qdel', str(batchID)])
+		elif batch_system == 'LSF':
+			subprocess.call(['bkill', str(batchID)])
+	mark_job_status2(cursor, jobID, 'CANCELLED')
+	# The same query can be submitted anew
+	cursor.execute('DELETE FROM cache WHERE job_id = ?', (jobID,))
+	return {'ID':jobID, 'status':'CANCELLED'}
+
+def hand_over_step(cursor, jobID, lsfID):
+	# A compute step which other jobs wait on keeps running. Its
+	# intermediate results go to one of these jobs, preferably one without
+	# a compute step of its own, which then owns the step.
+	heir = cursor.execute('SELECT job_id, lsf_id FROM jobs WHERE status = "LAUNCHED" AND depends_on = ? AND job_id != ? ORDER BY lsf_id IS NOT NULL, job_id LIMIT 1', (lsfID, jobID)).fetchone()
+	if heir is None:
+		return False
+	if heir[1] is None:
+		cursor.execute('UPDATE jobs SET lsf_id = ?, depends_on = (SELECT depends_on FROM jobs WHERE job_id = ?) WHERE job_id = ?', (lsfID, jobID, heir[0]))
+	cursor.execute('UPDATE cache SET job_id = ? WHERE job_id = ? AND primary_loc = 0', (heir[0], jobID))
+	if verbose:
+		print 'Handed step %s of job %s over to job %s' % (lsfID, jobID, heir[0])
+	return True
+
 ###########################################
 ## When a job finishes:
 ###########################################
 
-def send_SMTP(msg, emails, config):
-	import smtplib
-	s = smtplib.SMTP(config['smtp_server'], config['smtp_port'])
-        s.ehlo()
-        s.starttls()
-        s.ehlo()
-        s.login(config['user'], config['password'])
-	s.sendmail(config['reply_to'], emails, msg.as_string())
-	s.quit()
-
-def send_email(text, title, emails, config):
+def send_email(text, title, emails, config, cursor=None):
+	# Messages are queued in the outbox table, and sent by wiggleDB_mailer.py
 	from email.mime.text import MIMEText
 	msg = MIMEText(text, 'html')
 	msg['Subject'] = '[WiggleTools] ' + title
 	msg['From'] = config['reply_to']
 	msg['To'] = ", ".join(emails)
         msg['sendername'] = config['sendername']
-	send_SMTP(msg, emails, config)
+	if cursor is not None:
+		enqueue_email(cursor, config['reply_to'], emails, msg.as_string())
+	else:
+		wiggledb.wiggleDB_sqlite.write(config['database_location'], enqueue_email, config['reply_to'], emails, msg.as_string())
+
+def enqueue_email(cursor, sender, emails, message):
+	cursor.execute('INSERT INTO outbox (sender, recipients, message, status, attempts, created, next_attempt) VALUES (?, ?, ?, "QUEUED", 0, datetime(\'now\'), datetime(\'now\'))', (sender, json.dumps(emails), message))
 
 def visible_url(location, config):
-	if 's3_bucket' in config:
-		base_url = 'http://s3-%s.amazonaws.com/%s/' % (config['s3_region'], config['s3_bucket'])
-		return re.sub(config['working_directory'], base_url, location)		
-	else:
-		return location
+	return wiggledb.wiggleDB_storage.get_storage(config).url(location)
 
 def job_description(options):
 	text = "<table>"
@@ -683,7 +1480,7 @@ def job_description(options):
 	text += "</table>"
 	return text	
 
-def report_to_user(options, config):
+def report_to_user(options, config, cursor=None):
 	if options.emails is None:
 		return
 	else:
@@ -720,9 +1517,9 @@ def report_to_user(options, config):
 		text += "<p>"
 		text += "</body>"
 		text += "<html>"
-		send_email(text, 'Job %i succeeded' % options.jobID, options.emails, config)
+		send_email(text, 'Job %i succeeded' % options.jobID, options.emails, config, cursor)
 
-def acknowledge_job_to_user(options, config):
+def acknowledge_job_to_user(options, config, cursor=None):
 	if options.emails is None:
 		return
 	else:
@@ -737,6 +1534,10 @@ def acknowledge_job_to_user(options, config):
 		text += "Your job %i has been despatched with options:" % options.jobID
 		text += "</p>"
 		text += job_description(options)
+		if getattr(options, 'estimate', None) is not None:
+			text += "<p>"
+			text += "It should be finished in about %s." % wiggledb.wiggleDB_cost.describe_eta(options.estimate['eta_seconds'])
+			text += "</p>"
 		text += "<p>"
 		text += "Best regards,"
 		text += "</p>"
@@ -746,9 +1547,9 @@ def acknowledge_job_to_user(options, config):
 		text += "<p>"
 		text += "</body>"
 		text += "</html>"
-		send_email(text, 'Job %i dispatched' % options.jobID, options.emails, config)
+		send_email(text, 'Job %i dispatched' % options.jobID, options.emails, config, cursor)
 
-def report_empty_to_user(options, config):
+def report_empty_to_user(options, config, cursor=None):
 	if options.emails is None:
 		return
 	else:
@@ -772,15 +1573,27 @@ def report_empty_to_user(options, config):
 		text += "<p>"
 		text += "</body>"
 		text += "</html>"
-		send_email(text, 'Job %i returned an empty result' % options.jobID, options.emails, config)
+		send_email(text, 'Job %i returned an empty result' % options.jobID, options.emails, config, cursor)
 
 ###########################################
 ## Main
 ###########################################
 
+def parse_constraints(constraints):
+	if constraints is None:
+		return None
+	res = dict()
+	for constraint in constraints:
+		attribute, value = constraint.split("=")
+		if attribute not in res:
+			res[attribute] = []
+		res[attribute].append(value)
+	return res
+
 def main():
 	options, config = get_options()
-	conn = sqlite3.connect(options.db)
+	wiggledb.wiggleDB_metrics.configure(config, options.db)
+	conn = wiggledb.wiggleDB_sqlite.connect(options.db)
 	cursor = conn.cursor()
 
 	if config is None or 'batch_system' not in config:
@@ -788,50 +1601,83 @@ def main():
 	else:
 		batch_system = config['batch_system']
 
-	if options.load is not None:
-		create_database(cursor, options.load)
+	if options.load is not None or options.summaries is not None:
+		if options.load is not None:
+			create_database(cursor, options.load, options.upsert, options.batch_size)
+			conn.commit()
+		if options.summaries is not None:
+			from wiggledb import wiggleDB_summaries
+			wiggleDB_summaries.verbose = verbose
+			create_summary_table(cursor)
+			wiggleDB_summaries.summarise_datasets(conn, options.summaries, config or dict())
 	elif options.load_assembly is not None:
 		load_assembly(cursor, options.load_assembly[0], options.load_assembly[1])
 	elif options.clean is not None:
-		clean_database(cursor, options.clean)
+		from wiggledb import wiggleDB_gc
+		wiggleDB_gc.verbose = verbose
+		wiggleDB_gc.collect_garbage(conn, options.clean, options.dry_run, options.time_limit, options.threads)
+	elif options.archive is not None:
+		archive_jobs(conn, options.archive)
+	elif options.evict is not None:
+		if config is None:
+			config = dict()
+		high_water = float(config.get('cache_high_water', 0.9))
+		low_water = float(config.get('cache_low_water', 0.75))
+		evict_cache_loop(conn, parse_size(options.evict), high_water, low_water, options.evict_policy, options.interval)
 	elif options.result is not None:
 		print json.dumps(query_result(cursor, options.result, batch_system))
+	elif options.batch is not None:
+		from wiggledb import wiggleDB_batch
+		if options.batch == '-':
+			spec = json.load(sys.stdin)
+		else:
+			spec = json.load(open(options.batch))
+		print json.dumps(wiggleDB_batch.submit_batch(conn, cursor, spec, config, batch_system, options.working_directory, options.db, options.config, options.emails, options.remember, options.user))
+	elif options.batch_result is not None:
+		from wiggledb import wiggleDB_batch
+		print json.dumps(wiggleDB_batch.query_batch(cursor, options.batch_result, config, batch_system))
+	elif options.cancel is not None:
+		for jobID in options.cancel:
+			print json.dumps(cancel_job(cursor, jobID, batch_system))
 	elif options.cache:
-		for entry in cursor.execute('SELECT * FROM cache').fetchall():
-			print entry
+		print_page(list_cache(cursor, options.status, options.before, options.limit), options.limit)
 	elif options.clear_cache is not None:
 		if len(options.clear_cache) == 0:
-			cursor.execute('DROP TABLE cache')
-			create_cache(cursor)
-			cursor.execute('DROP TABLE jobs')
-			create_job_table(cursor)
+			clear_cache(cursor)
 		else:
 			remove_jobs(cursor, options.clear_cache)
 	elif options.attributes:
 		print json.dumps(get_attribute_values(cursor))
+	elif options.jobs is not None and len(options.jobs) > 0:
+		print "\n".join("\t".join(map(str, X)) for X in get_jobs(cursor, options.jobs, options.archived))
 	elif options.jobs is not None:
-		print "\n".join("\t".join(map(str, X)) for X in get_jobs(cursor, options.jobs))
+		print_page(list_jobs(cursor, options.status, options.before, options.limit, options.archived), options.limit)
 	elif options.datasets:
 		print "\n".join("\t".join(map(str, X)) for X in get_datasets(cursor))
 	elif options.annotations:
 		print "\n".join("\t".join(map(str, X)) for X in get_annotations(cursor, options.assembly))
+	elif options.index:
+		create_dataset_indexes(cursor)
+	elif options.upgrade:
+		upgrade_database(cursor)
+	elif options.stats is not None:
+		wiggledb.wiggleDB_metrics.create_metrics_table(cursor)
+		if options.stats == 'prometheus':
+			sys.stdout.write(wiggledb.wiggleDB_metrics.prometheus_report(cursor))
+		else:
+			print wiggledb.wiggleDB_metrics.text_report(cursor)
+	elif options.explain:
+		print "\n".join("\t".join(map(str, X)) for X in explain_dataset_query(cursor, parse_constraints(options.a), options.assembly))
+	elif options.region is not None:
+		from wiggledb import wiggleDB_region
+		data = get_dataset_locations(cursor, parse_constraints(options.a), options.assembly)
+		assert len(data) > 0, 'No datasets selected'
+		res = wiggleDB_region.evaluate_region(cursor, options.wa, data, options.assembly, options.region, config or dict())
+		chrom = res['region'].split(':')[0]
+		print "\n".join("%s\t%i\t%i\t%s" % (chrom, X[0], X[1], X[2]) for X in res['values'])
 	else:
-		if options.a is not None:
-			res = dict()
-			for constraint in options.a:
-				attribute, value = constraint.split("=")
-				if attribute not in res:
-					res[attribute] = []
-				res[attribute].append(value)
-			options.a = res
-		if options.b is not None:
-			res = dict()
-			for constraint in options.b:
-				attribute, value = constraint.split("=")
-				if attribute not in res:
-					res[attribute] = []
-				res[attribute].append(value)
-			options.b = res
+		options.a = parse_constraints(options.a)
+		options.b = parse_constraints(options.b)
 		print json.dumps(request_compute(conn, cursor, options, config, batch_system))
 
 	conn.commit()
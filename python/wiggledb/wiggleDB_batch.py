@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Batches of requests, e.g. every tissue against every annotation, submitted
+# at once. A batch is described in JSON:
+#
+#	{
+#		"assembly": "GRCh37",
+#		"emails": ["me@domain.org"],
+#		"items": [{"wa": "mean", "a": {"tissue": ["liver"]}, "w": "histogram 10", "b": {"name": ["genes"]}}],
+#		"matrix": {"wa": "mean", "a": [{"tissue": ["liver"]}, {"tissue": ["lung"]}], "w": "histogram 10", "b": [{"name": ["genes"]}, {"name": ["exons"]}]}
+#	}
+#
+# where the matrix stands for every combination of its A and B selections.
+# The A and B reductions which several items share are computed once, by a
+# single batch job which the items then wait on, as every job can only wait
+# on one other. Identical items share the same job. Instead of a message per
+# item, the users receive one acknowledgement for the batch, and one report
+# once all its items have finished. Admission limits apply to the estimated
+# cost of the whole batch, before any of its jobs is launched.
+
+import json
+import sqlite3
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_dag
+import wiggledb.wiggleDB_metrics
+import wiggledb.wiggleDB_cost
+
+###########################################
+## Batch description
+###########################################
+
+class ItemOptions(object):
+	# Same fields as the options of a single request. Selections are copied
+	# as the dataset query adds the assembly to them.
+	def __init__(self, item, assembly, working_directory, remember, db, config_file, user=None):
+		self.assembly = assembly
+		self.wa = wiggledb.wiggleDB.normalise_spaces(item['wa'])
+		self.a = dict(item['a'])
+		self.wb = wiggledb.wiggleDB.normalise_spaces(item.get('wb'))
+		if item.get('b') is not None:
+			self.b = dict(item['b'])
+		else:
+			self.b = None
+		self.fun_merge = wiggledb.wiggleDB.normalise_spaces(item.get('w'))
+		self.working_directory = working_directory
+		self.remember = remember
+		self.db = db
+		self.config = config_file
+		# The batch is reported and admitted as a whole
+		self.emails = None
+		self.user = user
+		self.admitted = True
+
+def expand_items(spec):
+	res = list(spec.get('items', []))
+	if 'matrix' in spec:
+		matrix = spec['matrix']
+		for a in matrix['a']:
+			for b in matrix.get('b', [None]):
+				item = dict((X, matrix[X]) for X in ('wa', 'wb', 'w') if X in matrix)
+				item['a'] = a
+				if b is not None:
+					item['b'] = b
+				res.append(item)
+	for item in res:
+		assert 'wa' in item and 'a' in item, 'Batch item without A selection or operation: %s' % json.dumps(item)
+		if item.get('b') is not None:
+			assert item.get('w') is not None, 'Batch item with B selection but no final operation: %s' % json.dumps(item)
+	assert len(res) > 0, 'Empty batch'
+	return res
+
+def describe_selection(params):
+	return " AND ".join("(" + " OR ".join("%s=%s" % (X, Y) for Y in params[X]) + ")" for X in params)
+
+###########################################
+## Shared computations
+###########################################
+
+def shared_reductions(cursor, items, assembly):
+	# A and B reductions used by more than one item, as launch_compute
+	# writes them
+	counts = dict()
+	commands = dict()
+	selections = dict()
+	for item in items:
+		for fun, params in ((item['wa'], item['a']), (item.get('wb'), item.get('b'))):
+			if fun is None or params is None:
+				continue
+			key = json.dumps(params, sort_keys=True)
+			if key not in selections:
+				selections[key] = wiggledb.wiggleDB.get_dataset_locations(cursor, dict(params), assembly)
+			if len(selections[key]) == 0:
+				continue
+			cmd = " ".join([wiggledb.wiggleDB.normalise_spaces(fun)] + selections[key] + [':'])
+			canonical = wiggledb.wiggleDB_dag.canonical_form(cmd)
+			counts[canonical] = counts.get(canonical, 0) + 1
+			commands[canonical] = cmd
+	return [commands[X] for X in sorted(counts) if counts[X] > 1]
+
+def launch_shared(conn, cursor, cmds, assembly, working_directory, batch_system, db, config_file, user=None, estimate=None):
+	# Returns the job which computes the shared reductions, if any
+	nodes = []
+	planned = dict()
+	dependency = None
+	commands = []
+	for cmd in cmds:
+		try:
+			root = wiggledb.wiggleDB_dag.parse(cmd)
+		except ValueError:
+			# Left to the items
+			continue
+		text, location, dependency = wiggledb.wiggleDB.plan_node(cursor, root, working_directory, dependency, nodes, planned)
+		if text != location:
+			commands.append(text)
+	if len(commands) == 0:
+		return None
+
+	chrom_sizes = wiggledb.wiggleDB.get_chrom_sizes(cursor, assembly)
+	conn.commit()
+	with wiggledb.wiggleDB_metrics.timer('job_submission_seconds', step='shared'):
+		lsfID, temps = wiggledb.wiggleDB.run_wiggletools(cursor, commands, chrom_sizes, batch_system, working_directory, dependency)
+	jobID = wiggledb.wiggleDB.insert_job(cursor, lsfID, user, estimate)
+	# Only intermediate results, which the items find in flight
+	for query, location, reduction, file_count in nodes:
+		wiggledb.wiggleDB.insert_cache_entry(cursor, jobID, False, query, False, location, reduction, file_count)
+	conn.commit()
+
+	# The finish step marks the job as done, without publishing anything
+	options = {'jobID': jobID, 'db': db, 'config': config_file, 'data': None, 'temps': temps}
+	options_file = wiggledb.wiggleDB.write_options_file(options, working_directory)
+	lsfID2, temp = wiggledb.wiggleDB.submit_commands(cursor, ['wiggleDB_finish.py ' + options_file], batch_system, lsfID, working_directory)
+	cursor.execute('UPDATE jobs SET lsf_id2 = ?, temp = ? WHERE job_id = ?', (lsfID2, temp, jobID))
+	return jobID
+
+###########################################
+## Cost estimates
+###########################################
+
+def estimate_batch(cursor, items, assembly, shared, config):
+	# Returns the estimates of the shared job and of the whole batch. Shared
+	# reductions are counted once, in the shared job, then as a single file
+	# in each item which reads them. Cached items cost nothing.
+	chrom_sizes = wiggledb.wiggleDB.get_chrom_sizes(cursor, assembly)
+	shared = set(wiggledb.wiggleDB_dag.canonical_form(X) for X in shared)
+	counted = set()
+	forms = set()
+	shared_sides = []
+	total = None
+	for item in items:
+		options = ItemOptions(item, assembly, None, False, None, None)
+		data = []
+		sides = []
+		computed = []
+		for fun, params in ((options.wa, options.a), (options.wb, options.b)):
+			if params is None:
+				continue
+			data.append(wiggledb.wiggleDB.get_dataset_locations(cursor, dict(params), assembly))
+			if fun is None:
+				sides.append((fun, data[-1], params))
+				computed.append(False)
+				continue
+			canonical = wiggledb.wiggleDB_dag.canonical_form(" ".join([fun] + data[-1] + [':']))
+			if canonical in shared:
+				if canonical not in counted:
+					counted.add(canonical)
+					shared_sides.append((fun, wiggledb.wiggleDB.pending_inputs(cursor, fun, data[-1]), params))
+				sides.append((fun, [canonical], params))
+				computed.append(False)
+			else:
+				sides.append((fun, wiggledb.wiggleDB.pending_inputs(cursor, fun, data[-1]), params))
+				computed.append(wiggledb.wiggleDB.pending_result(cursor, fun, data[-1]) is None)
+		if any(len(X) == 0 for X in data):
+			continue
+		form = wiggledb.wiggleDB.make_normalised_form(options.fun_merge, options.wa, data[0], options.wb, data[1] if len(data) > 1 else None)
+		if form in forms or cursor.execute('SELECT count(*) FROM cache WHERE query_hash = ?', (wiggledb.wiggleDB.query_digest(form),)).fetchone()[0] > 0:
+			continue
+		forms.add(form)
+		# Items which only wait on the shared job or on others cost nothing
+		if wiggledb.wiggleDB_cost.computes(options.fun_merge, computed):
+			total = wiggledb.wiggleDB_cost.add_estimates(total, wiggledb.wiggleDB_cost.estimate(cursor, config, sides, options.fun_merge, chrom_sizes))
+
+	if len(shared_sides) == 0:
+		return None, total
+	shared_estimate = wiggledb.wiggleDB_cost.estimate(cursor, config, shared_sides, None, chrom_sizes)
+	if total is None:
+		return shared_estimate, shared_estimate
+	total = wiggledb.wiggleDB_cost.add_estimates(shared_estimate, total)
+	# The items only start once the shared job is done
+	total['eta_seconds'] = shared_estimate['eta_seconds'] + max(0, total['eta_seconds'] - wiggledb.wiggleDB_cost.queue_wait(cursor))
+	return shared_estimate, total
+
+###########################################
+## Submission
+###########################################
+
+def submit_batch(conn, cursor, spec, config, batch_system, working_directory, db, config_file, emails=None, remember=False, user=None):
+	items = expand_items(spec)
+	assembly = spec['assembly']
+	emails = spec.get('emails', emails)
+	remember = spec.get('remember', remember)
+
+	shared = shared_reductions(cursor, items, assembly)
+	shared_estimate, estimate = estimate_batch(cursor, items, assembly, shared, config)
+	if estimate is not None:
+		refusal = wiggledb.wiggleDB_cost.admit(cursor, estimate, user, config)
+		if refusal is not None:
+			refusal['batch'] = None
+			return refusal
+		# Accounted for until all the jobs of the batch are recorded
+		reservation = wiggledb.wiggleDB_cost.reserve(cursor, estimate, user)
+	else:
+		reservation = None
+
+	try:
+		sharedID = launch_shared(conn, cursor, shared, assembly, working_directory, batch_system, db, config_file, user, shared_estimate)
+		cursor.execute('INSERT INTO batches (shared_job_id, emails, submitted) VALUES (?, ?, datetime(\'now\'))', (sharedID, json.dumps(emails)))
+		batchID = cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
+
+		results = []
+		for index, item in enumerate(items):
+			options = ItemOptions(item, assembly, working_directory, remember, db, config_file, user)
+			res = wiggledb.wiggleDB.request_compute(conn, cursor, options, config, batch_system)
+			cursor.execute('INSERT INTO batch_items (batch_id, item, job_id, request) VALUES (?, ?, ?, ?)', (batchID, index, res.get('ID'), json.dumps(item)))
+			wiggledb.wiggleDB_metrics.increment('batch_items_total')
+			res['item'] = index
+			results.append(res)
+	finally:
+		if reservation is not None:
+			wiggledb.wiggleDB_cost.release(cursor, reservation)
+	conn.commit()
+
+	acknowledge_batch_to_user(batchID, items, results, emails, config, cursor)
+	# In case everything was cached
+	report_finished_batch(cursor, batchID, config, batch_system)
+	return {'batch': batchID, 'items': results, 'estimate': estimate}
+
+###########################################
+## Status
+###########################################
+
+TERMINAL_STATUSES = ('DONE', 'EMPTY', 'EXPIRED', 'ERROR', 'CANCELLED', 'UNKNOWN', 'INVALID')
+
+def batch_items(cursor, batchID):
+	return cursor.execute('SELECT item, job_id, request FROM batch_items WHERE batch_id = ? ORDER BY item', (batchID,)).fetchall()
+
+def batch_result(cursor, batchID, batch_system):
+	items = batch_items(cursor, batchID)
+	if len(items) == 0:
+		return {'batch': batchID, 'status': 'UNKNOWN', 'items': []}
+	results = []
+	for item, jobID, request in items:
+		if jobID is None:
+			res = {'status': 'INVALID'}
+		else:
+			res = wiggledb.wiggleDB.query_result(cursor, jobID, batch_system)
+		res['item'] = item
+		results.append(res)
+	if all(X['status'] in TERMINAL_STATUSES for X in results):
+		status = 'DONE'
+	else:
+		status = 'WAITING'
+	return {'batch': batchID, 'status': status, 'items': results}
+
+def query_batch(cursor, batchID, config, batch_system):
+	# Querying the items also finds out which ones failed, the report may
+	# then be due
+	res = batch_result(cursor, batchID, batch_system)
+	if res['status'] == 'DONE' and config is not None:
+		report_finished_batch(cursor, batchID, config, batch_system)
+	return res
+
+###########################################
+## Reporting to users
+###########################################
+
+def item_rows(items, results, config):
+	text = "<table>"
+	text += "<tr><th>Item</th><th>Job</th><th>Status</th><th>Selector</th><th>Operation</th><th>Righthand selector</th><th>Righthand operation</th><th>Final operation</th></tr>"
+	for item, res in zip(items, results):
+		text += "<tr>"
+		text += "<td>%i</td>" % res['item']
+		text += "<td>%s</td>" % res.get('ID', '')
+		if res['status'] == 'DONE':
+			text += "<td><a href=%s>DONE</a></td>" % wiggledb.wiggleDB.visible_url(res['location'], config)
+		else:
+			text += "<td>%s</td>" % res['status']
+		text += "<td>%s</td>" % describe_selection(item['a'])
+		text += "<td>%s</td>" % item['wa']
+		text += "<td>%s</td>" % describe_selection(item.get('b') or dict())
+		text += "<td>%s</td>" % (item.get('wb') or '')
+		text += "<td>%s</td>" % (item.get('w') or '')
+		text += "</tr>"
+	text += "</table>"
+	return text
+
+def acknowledge_batch_to_user(batchID, items, results, emails, config, cursor=None):
+	if emails is None:
+		return
+	else:
+		text = "<html>"
+		text += "<head>"
+		text += "</head>"
+		text += "<body>"
+		text += "<p>"
+		text += "Hello"
+		text += "</p>"
+		text += "<p>"
+		text += "Your batch %i of %i jobs has been despatched:" % (batchID, len(items))
+		text += "</p>"
+		text += item_rows(items, results, config)
+		text += "<p>"
+		text += "Best regards,"
+		text += "</p>"
+		text += "<p>"
+		text += "The WiggleTools team"
+		text += "</p>"
+		text += "</body>"
+		text += "</html>"
+		wiggledb.wiggleDB.send_email(text, 'Batch %i dispatched' % batchID, emails, config, cursor)
+
+def running_items(cursor, batchID):
+	return cursor.execute('SELECT count(*) FROM batch_items NATURAL JOIN jobs WHERE batch_id = ? AND status = "LAUNCHED"', (batchID,)).fetchone()[0]
+
+def report_finished_batch(cursor, batchID, config, batch_system):
+	# Sends the report once, when all the items have finished. Jobs which
+	# failed are only known as such once their status has been queried.
+	if running_items(cursor, batchID) > 0:
+		return False
+	status = batch_result(cursor, batchID, batch_system)
+	cursor.execute('UPDATE batches SET reported = datetime(\'now\') WHERE batch_id = ? AND reported IS NULL', (batchID,))
+	if cursor.rowcount == 0:
+		return False
+	emails = json.loads(cursor.execute('SELECT emails FROM batches WHERE batch_id = ?', (batchID,)).fetchone()[0])
+	if emails is None:
+		return True
+	items = [json.loads(X[2]) for X in batch_items(cursor, batchID)]
+	text = "<html>"
+	text += "<head>"
+	text += "</head>"
+	text += "<body>"
+	text += "<p>"
+	text += "Hello"
+	text += "</p>"
+	text += "<p>"
+	text += "Your batch %i is now finished, please refer to the WiggleTools server for your results:" % batchID
+	text += "</p>"
+	text += item_rows(items, status['items'], config)
+	text += "<p>"
+	text += "Best regards,"
+	text += "</p>"
+	text += "<p>"
+	text += "The WiggleTools team"
+	text += "</p>"
+	text += "</body>"
+	text += "</html>"
+	wiggledb.wiggleDB.send_email(text, 'Batch %i finished' % batchID, emails, config, cursor)
+	return True
+
+def report_finished_batches(cursor, jobID, config):
+	# Called by the finish step of every job, within a write transaction
+	try:
+		batches = cursor.execute('SELECT DISTINCT batch_id FROM batch_items NATURAL JOIN batches WHERE job_id = ? AND reported IS NULL', (jobID,)).fetchall()
+	except sqlite3.OperationalError:
+		# Database created before batches
+		return
+	for batchID, in batches:
+		report_finished_batch(cursor, batchID, config, config.get('batch_system', 'SGE'))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cost estimates of the requests which miss the cache, and admission
+# control before anything is launched. CPU time is predicted from the size
+# of the files left to read, weighted by their type and by the operations,
+# memory from the number of files opened at once, and output size from the
+# largest input, or a small plot for histograms and profiles. The ETA adds
+# the mean queue wait of the latest jobs. Requests which only wait on
+# results cached or in flight cost nothing.
+#
+# Relevant config keys, all optional:
+#	- cost_seconds_per_mb (default 2), cost_seconds_per_file (default 1),
+#	cost_default_file_mb (for files which cannot be read, default 50),
+#	cost_base_memory_mb (default 100), cost_memory_mb_per_file (default 8),
+#	cost_finish_seconds (default 30), cost_parallelism (most chromosomes
+#	computed at once, default 24)
+#	- max_request_cpu (seconds) and max_request_memory (MB): larger
+#	requests are rejected
+#	- max_user_cpu, max_user_jobs, max_global_cpu and max_global_jobs: the
+#	CPU time and number of the jobs in flight, per user and overall, beyond
+#	which requests are deferred
+#	- admission_window (hours, default 24): older jobs still marked as in
+#	flight are assumed lost
+#	- admission_retry_after (seconds, default 300), returned with deferrals
+
+import os
+import threading
+
+import wiggledb.wiggleDB_metrics
+import wiggledb.wiggleDB_sqlite
+
+MB = float(2 ** 20)
+
+# Relative cost of reading the files of each type
+TYPE_FACTORS = {'signal': 1.0, 'regions': 0.5}
+# Relative cost of operations, compared to a sum or mean
+OPERATION_FACTORS = {'median': 3.0, 'var': 2.0, 'stddev': 2.0, 'CV': 2.0, 't-test': 3.0, 'wilcoxon': 4.0, 'histogram': 1.5, 'profile': 1.5, 'profiles': 2.0, 'apply_paste': 1.5}
+# Merges which produce a plot or a table rather than a track
+TEXT_OUTPUTS = ['histogram', 'profile', 'profiles', 'apply_paste']
+# Merges run by the finish step, as launched by wiggleDB.launch_compute
+FINISH_MERGES = ['histogram', 'apply_paste']
+TEXT_OUTPUT_MB = 0.1
+
+sizes = dict()
+chromosomes = dict()
+sizes_lock = threading.Lock()
+
+###########################################
+## Inputs
+###########################################
+
+def setting(config, key, default):
+	if config is None or key not in config:
+		return default
+	return float(config[key])
+
+def file_sizes(locations, default):
+	# Datasets do not change once loaded, their sizes are only read once
+	# per process. Results in flight are still empty.
+	res = []
+	for location in locations:
+		with sizes_lock:
+			size = sizes.get(location)
+		if size is None:
+			try:
+				size = os.path.getsize(location)
+			except OSError:
+				size = 0
+			if size > 0:
+				with sizes_lock:
+					sizes[location] = size
+			else:
+				size = default
+		res.append(size)
+	return res
+
+def chromosome_count(chrom_sizes):
+	with sizes_lock:
+		if chrom_sizes not in chromosomes:
+			try:
+				chromosomes[chrom_sizes] = max(1, len([X for X in open(chrom_sizes) if len(X.strip()) > 0]))
+			except IOError:
+				chromosomes[chrom_sizes] = 1
+		return chromosomes[chrom_sizes]
+
+def selection_type(params):
+	if params is not None and len(params.get('type', [])) == 1:
+		return params['type'][0]
+	return 'signal'
+
+def operation_factor(fun):
+	if fun is None:
+		return 1.0
+	return max(OPERATION_FACTORS.get(X, 1.0) for X in fun.split(' '))
+
+def queue_wait(cursor):
+	# Mean wait of the latest jobs between submission and start
+	res = cursor.execute('SELECT avg((julianday(started) - julianday(submitted)) * 86400) FROM (SELECT started, submitted FROM jobs WHERE started IS NOT NULL AND submitted IS NOT NULL ORDER BY job_id DESC LIMIT 100)').fetchone()[0]
+	if res is None:
+		return 0
+	return max(0, res)
+
+###########################################
+## Model
+###########################################
+
+def estimate(cursor, config, sides, fun_merge, chrom_sizes):
+	# sides: (operation, files left to read, selection) of each operand
+	default = setting(config, 'cost_default_file_mb', 50) * MB
+	files = 0
+	mb = 0.0
+	largest = 0.0
+	for fun, locations, params in sides:
+		if len(locations) == 0:
+			continue
+		side_sizes = file_sizes(locations, default)
+		files += len(locations)
+		mb += sum(side_sizes) / MB * TYPE_FACTORS.get(selection_type(params), 1.0) * operation_factor(fun)
+		largest = max(largest, max(side_sizes) / MB)
+
+	cpu = setting(config, 'cost_seconds_per_file', 1) * files + setting(config, 'cost_seconds_per_mb', 2) * mb * operation_factor(fun_merge)
+	memory = setting(config, 'cost_base_memory_mb', 100) + setting(config, 'cost_memory_mb_per_file', 8) * files
+	if fun_merge is not None and fun_merge.split(' ')[0] in TEXT_OUTPUTS:
+		output = TEXT_OUTPUT_MB
+	else:
+		output = largest
+	parallelism = min(chromosome_count(chrom_sizes), setting(config, 'cost_parallelism', 24))
+	eta = queue_wait(cursor) + cpu / parallelism + setting(config, 'cost_finish_seconds', 30)
+	return {'cpu_seconds': round(cpu, 1), 'memory_mb': round(memory, 1), 'output_mb': round(output, 1), 'eta_seconds': int(eta)}
+
+def computes(fun_merge, computed):
+	# Whether a request launches a compute step of its own, given which of
+	# its reductions are neither cached nor in flight
+	if fun_merge is not None and fun_merge.split(' ')[0] not in FINISH_MERGES:
+		return True
+	return any(computed)
+
+def attached_estimate(cursor, config):
+	# Only a finish step, which waits on the jobs of others
+	return {'cpu_seconds': 0.0, 'memory_mb': 0.0, 'output_mb': 0.0, 'eta_seconds': int(queue_wait(cursor) + setting(config, 'cost_finish_seconds', 30))}
+
+def describe_eta(seconds):
+	if seconds < 5400:
+		return '%i minutes' % max(1, round(seconds / 60.0))
+	else:
+		return '%i hours' % round(seconds / 3600.0)
+
+def add_estimates(first, second):
+	# Jobs which run one after the other, e.g. in a batch
+	if first is None:
+		return second
+	return {
+		'cpu_seconds': first['cpu_seconds'] + second['cpu_seconds'],
+		'memory_mb': max(first['memory_mb'], second['memory_mb']),
+		'output_mb': first['output_mb'] + second['output_mb'],
+		'eta_seconds': max(first['eta_seconds'], second['eta_seconds'])
+	}
+
+###########################################
+## Admission control
+###########################################
+
+def inflight(cursor, user, config):
+	# CPU time and number of the jobs in flight, of a user or overall,
+	# including the requests admitted but not submitted yet
+	window = '-%i hours' % setting(config, 'admission_window', 24)
+	if user is None:
+		return cursor.execute('SELECT coalesce(sum(cost_cpu), 0), count(*) FROM jobs WHERE status IN ("LAUNCHED", "RESERVED") AND submitted > datetime(\'now\', ?)', (window,)).fetchone()
+	else:
+		return cursor.execute('SELECT coalesce(sum(cost_cpu), 0), count(*) FROM jobs WHERE status IN ("LAUNCHED", "RESERVED") AND submitted > datetime(\'now\', ?) AND user = ?', (window, user)).fetchone()
+
+def refusal(status, reason, estimate, config):
+	wiggledb.wiggleDB_metrics.increment('admissions_total', result=status.lower())
+	res = {'status': status, 'reason': reason, 'estimate': estimate}
+	if status == 'DEFERRED':
+		res['retry_after'] = int(setting(config, 'admission_retry_after', 300))
+	return res
+
+def too_large(estimate, user, config):
+	# Requests which would never fit within the limits
+	for key in ('max_request_cpu', 'max_user_cpu', 'max_global_cpu'):
+		if user is None and key == 'max_user_cpu':
+			continue
+		limit = setting(config, key, None)
+		if limit is not None and estimate['cpu_seconds'] > limit:
+			return 'Estimated CPU time of %is is over the limit of %is' % (estimate['cpu_seconds'], limit)
+	limit = setting(config, 'max_request_memory', None)
+	if limit is not None and estimate['memory_mb'] > limit:
+		return 'Estimated memory of %iMB is over the limit of %iMB' % (estimate['memory_mb'], limit)
+	return None
+
+def too_busy(cursor, estimate, user, prefix, config):
+	cpu_limit = setting(config, prefix + '_cpu', None)
+	jobs_limit = setting(config, prefix + '_jobs', None)
+	if cpu_limit is None and jobs_limit is None:
+		return None
+	used, jobs = inflight(cursor, user, config)
+	if cpu_limit is not None and used + estimate['cpu_seconds'] > cpu_limit:
+		return 'Too much work in flight (%is of CPU time)' % used
+	if jobs_limit is not None and jobs >= jobs_limit:
+		return 'Too many jobs in flight (%i)' % jobs
+	return None
+
+def admit(cursor, estimate, user, config):
+	# Returns None if the request can be launched, the reply otherwise.
+	# The write lock is taken before the jobs in flight are counted, so
+	# concurrent requests are admitted one at a time: the caller must
+	# reserve() the estimate before its next commit.
+	reason = too_large(estimate, user, config)
+	if reason is not None:
+		return refusal('REJECTED', reason, estimate, config)
+	wiggledb.wiggleDB_sqlite.lock(cursor)
+	if user is not None:
+		reason = too_busy(cursor, estimate, user, 'max_user', config)
+	if reason is None:
+		reason = too_busy(cursor, estimate, None, 'max_global', config)
+	if reason is not None:
+		return refusal('DEFERRED', reason, estimate, config)
+	wiggledb.wiggleDB_metrics.increment('admissions_total', result='accepted')
+	return None
+
+def reserve(cursor, estimate, user):
+	# Counts an admitted request in flight until its jobs are recorded
+	cursor.execute('INSERT INTO jobs (status, submitted, user, cost_cpu, cost_memory, cost_output) VALUES ("RESERVED", datetime(\'now\'), ?, ?, ?, ?)', (user, estimate['cpu_seconds'], estimate['memory_mb'], estimate['output_mb']))
+	return cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
+
+def release(cursor, reservation):
+	cursor.execute('DELETE FROM jobs WHERE job_id = ? AND status = "RESERVED"', (reservation,))
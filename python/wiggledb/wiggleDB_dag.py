@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Parses wiggletools expressions into a DAG of nodes with a canonical text
+# form: operands of commutative operators are sorted, numeric parameters
+# (e.g. gt thresholds) are normalised, and identical subexpressions are
+# shared. The canonical text of each node is its cache key.
+
+# Operators followed by a list of iterators, terminated by ':' or the end
+# of the expression. The order of the list does not matter.
+MULTIPLEXERS = ['sum', 'mult', 'min', 'max', 'mean', 'median', 'var', 'stddev', 'CV']
+# Operators followed by a fixed number of numeric parameters and one iterator
+PARAMETRISED = {'gt':1, 'gte':1, 'lt':1, 'lte':1, 'scale':1, 'pow':1, 'offset':1, 'shift':1, 'default':1}
+# Operators followed by a fixed number of iterators, in order
+FIXED = {'unit':1, 'abs':1, 'ln':1, 'log':1, 'exp':1, 'isZero':1, 'diff':2, 'ratio':2}
+
+###########################################
+## Nodes
+###########################################
+
+class Node(object):
+	def __init__(self, op, children=(), multiplexer=False):
+		self.op = op
+		self.multiplexer = multiplexer
+		if multiplexer:
+			self.children = tuple(sorted(children, key=lambda X: X.canonical))
+		else:
+			self.children = tuple(children)
+		self.canonical = self.render([X.canonical for X in self.children])
+
+	def is_leaf(self):
+		return len(self.children) == 0
+
+	def render(self, operands):
+		# Text of the node, with the given text substituted for its children
+		if self.is_leaf():
+			return self.op
+		elif self.multiplexer:
+			return " ".join([self.op] + list(operands) + [':'])
+		else:
+			return " ".join([self.op] + list(operands))
+
+	def reduction(self):
+		# Reduction and files, if the node reduces a list of files
+		if self.multiplexer and all(X.is_leaf() for X in self.children):
+			return self.op, [X.op for X in self.children]
+		elif self.op == 'unit' and self.children[0].multiplexer:
+			res = self.children[0].reduction()
+			if res is not None:
+				return 'unit ' + res[0], res[1]
+		return None
+
+###########################################
+## Parser
+###########################################
+
+def canonical_number(token):
+	try:
+		return '%.12g' % float(token)
+	except ValueError:
+		raise ValueError('Expected a number, found %s' % token)
+
+def is_file(token):
+	return '/' in token or '.' in token
+
+class Parser(object):
+	def __init__(self, expression):
+		self.tokens = expression.split()
+		self.position = 0
+		# Identical subexpressions are represented by the same node
+		self.nodes = dict()
+
+	def next_token(self):
+		if self.position == len(self.tokens):
+			raise ValueError('Unexpected end of expression')
+		token = self.tokens[self.position]
+		self.position += 1
+		return token
+
+	def node(self, op, children=(), multiplexer=False):
+		node = Node(op, children, multiplexer)
+		return self.nodes.setdefault(node.canonical, node)
+
+	def parse_list(self):
+		children = []
+		while self.position < len(self.tokens) and self.tokens[self.position] != ':':
+			children.append(self.parse_expression())
+		if self.position < len(self.tokens):
+			self.position += 1
+		if len(children) == 0:
+			raise ValueError('Empty list of iterators')
+		return children
+
+	def parse_expression(self):
+		token = self.next_token()
+		if token in MULTIPLEXERS:
+			return self.node(token, self.parse_list(), True)
+		elif token in PARAMETRISED:
+			op = " ".join([token] + [canonical_number(self.next_token()) for X in range(PARAMETRISED[token])])
+			return self.node(op, [self.parse_expression()])
+		elif token in FIXED:
+			return self.node(token, [self.parse_expression() for X in range(FIXED[token])])
+		elif is_file(token):
+			return self.node(token)
+		else:
+			raise ValueError('Unknown operator %s' % token)
+
+def parse(expression):
+	parser = Parser(expression)
+	res = parser.parse_expression()
+	if parser.position != len(parser.tokens):
+		raise ValueError('Trailing tokens in expression: %s' % " ".join(parser.tokens[parser.position:]))
+	return res
+
+def canonical_form(expression):
+	# Expressions which cannot be parsed are left as they are
+	try:
+		return parse(expression).canonical
+	except ValueError:
+		return expression
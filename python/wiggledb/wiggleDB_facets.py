@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-memory facet index over the datasets table. For every assembly, each
+# attribute value is mapped to a bitmap (a Python long) of the datasets
+# which carry it, so that a selection count is a handful of ANDs, ORs and a
+# popcount rather than an SQL query. Bitmaps are built from the sorted IDs
+# of the datasets of each value. Dataset names are unique, they are only
+# mapped to their IDs. The number of datasets of every value is counted
+# once, when the index is built, and the counts of recent selections are
+# remembered.
+
+import array
+import binascii
+import marshal
+import threading
+import zlib
+
+import wiggledb.wiggleDB
+
+# Counts remembered for the latest selections
+MEMO_SIZE = 1024
+
+###########################################
+## Bitmaps
+###########################################
+
+# Number of bits set in each byte
+BYTE_COUNTS = "".join(chr(bin(X).count('1')) for X in range(256))
+# Bytes of bit counts added up at once: at most 15 bits are set in each
+# pair of bytes, so that their sum stays below the Adler-32 modulus
+ADLER_CHUNK = 8190
+
+def popcount(bitmap):
+	# A long is marshalled as a type byte, a 4 byte length and its 15 bit
+	# digits, whose bytes are replaced by their bit counts. These are
+	# added up in C by Adler-32, whose low half is 1 + their sum.
+	if type(bitmap) is not long:
+		return bin(bitmap).count('1')
+	counts = marshal.dumps(bitmap)[5:].translate(BYTE_COUNTS)
+	res = 0
+	for start in xrange(0, len(counts), ADLER_CHUNK):
+		res += (zlib.adler32(counts[start:start + ADLER_CHUNK]) & 0xffff) - 1
+	return res
+
+def union(bitmaps):
+	res = 0
+	for bitmap in bitmaps:
+		res |= bitmap
+	return res
+
+def make_bitmap(ids, size):
+	# Built in one go, as setting bits one at a time copies the whole long
+	bits = bytearray((size + 7) // 8)
+	for id in ids:
+		bits[id >> 3] |= 1 << (id & 7)
+	if len(bits) == 0:
+		return 0
+	bits.reverse()
+	return long(binascii.hexlify(bits), 16)
+
+###########################################
+## Facet index
+###########################################
+
+class FacetIndex(object):
+	def __init__(self, cursor):
+		self.version = wiggledb.wiggleDB.get_catalogue_version(cursor)
+		columns = [X for X in wiggledb.wiggleDB.get_dataset_attributes_2(cursor) if X not in ('location', 'assembly')]
+		# Attributes offered in the GUI, i.e. everything but the dataset names
+		self.facets = sorted(X for X in columns if X != 'name')
+		# Attributes listed in the selectors, the type and annotation flag
+		# being chosen separately
+		self.attributes = [X for X in self.facets if X not in ('type', 'annotation')]
+		self.datasets = dict()
+		self.names = dict()
+		self.bitmaps = dict()
+		self.sizes = dict()
+		self.catalogues = dict()
+		self.memo = dict()
+
+		ids = dict()
+		for row in cursor.execute('SELECT %s FROM datasets' % ", ".join(['assembly', 'name'] + self.facets)):
+			assembly = row[0]
+			if assembly not in ids:
+				self.datasets[assembly] = 0
+				ids[assembly] = dict((X, dict()) for X in self.facets)
+				self.names[assembly] = dict()
+			id = self.datasets[assembly]
+			self.datasets[assembly] += 1
+			self.names[assembly].setdefault(row[1], array.array('L')).append(id)
+			values = ids[assembly]
+			for column, value in zip(self.facets, row[2:]):
+				if value not in values[column]:
+					values[column][value] = array.array('L')
+				values[column][value].append(id)
+
+		for assembly in ids:
+			size = self.datasets[assembly]
+			self.bitmaps[assembly] = dict((X, dict((Y, make_bitmap(Z, size)) for Y, Z in ids[assembly][X].items())) for X in self.facets)
+			self.sizes[assembly] = dict((X, dict((Y, len(Z)) for Y, Z in ids[assembly][X].items())) for X in self.facets)
+
+	def full(self, assembly):
+		return (1 << self.datasets[assembly]) - 1
+
+	def values_bitmap(self, attribute, values, assembly):
+		if attribute == 'name':
+			names = self.names[assembly]
+			return make_bitmap(sorted(Y for X in values for Y in names.get(X, [])), self.datasets[assembly])
+		bitmaps = self.bitmaps[assembly]
+		assert attribute in bitmaps, 'Unknown attribute %s' % attribute
+		return union(bitmaps[attribute].get(value, 0) for value in values)
+
+	def selection(self, params, assembly, exclude=None):
+		if assembly not in self.bitmaps:
+			return 0
+		res = self.full(assembly)
+		for attribute in params:
+			if attribute == 'assembly' or attribute == exclude:
+				continue
+			res &= self.values_bitmap(attribute, params[attribute], assembly)
+		return res
+
+	def count(self, params, assembly):
+		return popcount(self.selection(params, assembly))
+
+	def value_counts(self, params, assembly):
+		# For each attribute, the number of datasets each of its values
+		# would select, given the constraints on all the other attributes
+		res = dict()
+		if assembly not in self.bitmaps:
+			return res
+		for attribute in self.facets:
+			key = (assembly, attribute, tuple(sorted((X, tuple(sorted(Y))) for X, Y in params.items() if X not in ('assembly', attribute))))
+			counts = self.memo.get(key)
+			if counts is None:
+				counts = self.masked_counts(self.selection(params, assembly, exclude=attribute), attribute, assembly)
+				if len(self.memo) >= MEMO_SIZE:
+					self.memo.clear()
+				self.memo[key] = counts
+			res[attribute] = dict(counts)
+		return res
+
+	def masked_counts(self, mask, attribute, assembly):
+		sizes = self.sizes[assembly][attribute]
+		if mask == self.full(assembly):
+			return sizes
+		elif mask == 0:
+			return dict((X, 0) for X in sizes)
+		bitmaps = self.bitmaps[assembly][attribute]
+		return dict((X, popcount(mask & bitmaps[X])) for X in sizes)
+
+	def counts(self, params, assembly):
+		return {'count': self.count(params, assembly), 'facets': self.value_counts(params, assembly)}
+
+	def attribute_counts(self, assembly):
+		# Number of datasets carrying each attribute value
+		if assembly not in self.catalogues:
+			sizes = self.sizes.get(assembly, dict())
+			self.catalogues[assembly] = dict((X, dict((Y, Z) for Y, Z in sizes.get(X, dict()).items() if Y is not None)) for X in self.attributes)
+		return self.catalogues[assembly]
+
+###########################################
+## Shared index
+###########################################
+
+index = None
+index_lock = threading.Lock()
+
+def get_facet_index(cursor):
+	# The index is only rebuilt when a load bumps the catalogue version.
+	# Meanwhile, the previous version answers the other requests.
+	global index
+	version = wiggledb.wiggleDB.get_catalogue_version(cursor)
+	current = index
+	if current is not None and current.version == version:
+		return current
+	if current is not None and not index_lock.acquire(False):
+		return current
+	elif current is None:
+		index_lock.acquire()
+	try:
+		if index is None or index.version != version:
+			index = FacetIndex(cursor)
+		return index
+	finally:
+		index_lock.release()
@@ -20,9 +20,13 @@ import os
 import os.path
 import json
 
-import wiggleDB.wiggleDB
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_batch
+import wiggledb.wiggleDB_plots
+import wiggledb.wiggleDB_storage
+import wiggledb.wiggleDB_metrics
+import wiggledb.wiggleDB_sqlite
 import wiggletools.multiJob 
-import wiggletools.wigglePlots
 
 class Struct(object):
         def __init__(self, **entries):
@@ -31,51 +35,63 @@ class Struct(object):
 def get_options():
 	assert len(sys.argv) == 2
 	options = Struct(**(json.load(open(sys.argv[-1]))))
-	return options, wiggleDB.wiggleDB.read_config_file(options.config)
+	return options, wiggledb.wiggleDB.read_config_file(options.config)
 
-def copy_to_longterm(data, config):
-	if 's3_bucket' in config:
-		os.environ['AWS_CONFIG_FILE'] = config['aws_config']
-		cmd = "aws s3 cp %s s3://%s/%s --acl public-read" % (data, config['s3_bucket'], os.path.basename(data))
-		if subprocess.call(cmd, shell=True) != 0:
-			print "Failed to copy over results"
-			print cmd
-			sys.exit(100)
+def copy_to_longterm(locations, config):
+	try:
+		with wiggledb.wiggleDB_metrics.timer('result_upload_seconds'):
+			wiggledb.wiggleDB_storage.get_storage(config).store(locations)
+	except Exception as e:
+		print "Failed to copy over results"
+		print e
+		sys.exit(100)
+
+def finish_shared(options, config):
+	# Reductions shared by the items of a batch: nothing to publish, the
+	# jobs of the items read them from the working directory
+	wiggledb.wiggleDB.mark_job_status(options.db, options.jobID, 'DONE', config)
+	if options.temps is not None:
+		wiggletools.multiJob.clean_temp_files(options.temps)
+	os.remove(sys.argv[-1])
 
 def main():
 	try:
 		options, config = get_options()
+		wiggledb.wiggleDB_metrics.configure(config, options.db)
+		if options.data is None:
+			finish_shared(options, config)
+			return
 		empty = os.path.exists(options.data + ".empty")
 
-		# Optional graphics
+		# Optional graphics, streamed from wiggletools
 		if options.histogram is not None:
-			if subprocess.call("wiggletools "  + options.histogram, shell=True):
+			try:
+				if not wiggledb.wiggleDB_plots.make_histogram(options.histogram, options.data, options.labels):
+					empty = True
+			except AssertionError:
 				print "Failed to construct histogram"
 				sys.exit(1)
-			if os.path.getsize(options.data) > 0:
-				wiggletools.wigglePlots.make_histogram(options.data, options.labels, options.data + ".png", format='png')
-			else:
-				empty = True
 
 		if options.apply_paste is not None:
-			if subprocess.call("wiggletools "  + options.apply_paste, shell=True):
+			try:
+				if not wiggledb.wiggleDB_plots.make_overlaps(options.apply_paste, options.data):
+					empty = True
+			except AssertionError:
 				print "Failed to construct overlap graph"
 				sys.exit(1)
-			if os.path.getsize(options.data) > 0:
-				wiggletools.wigglePlots.make_overlaps(options.data, options.data + ".png", format='png')
-			else:
-				empty = True
 
 		# Signing off
 		if empty:
-			wiggleDB.wiggleDB.report_empty_to_user(options, config)
-			wiggleDB.wiggleDB.mark_job_status(options.db, options.jobID, 'EMPTY')
+			wiggledb.wiggleDB.report_empty_to_user(options, config)
+			wiggledb.wiggleDB.mark_job_status(options.db, options.jobID, 'EMPTY', config)
 		else:
-			copy_to_longterm(options.data, config)
 			if os.path.exists(options.data + ".png"):
-				copy_to_longterm(data + ".png", config)
-			wiggleDB.wiggleDB.report_to_user(options, config)
-			wiggleDB.wiggleDB.mark_job_status(options.db, options.jobID, 'DONE')
+				copy_to_longterm([options.data, options.data + ".png"], config)
+			else:
+				copy_to_longterm([options.data], config)
+			wiggledb.wiggleDB.report_to_user(options, config)
+			wiggledb.wiggleDB.mark_job_status(options.db, options.jobID, 'DONE', config)
+		wiggledb.wiggleDB_sqlite.write(options.db, wiggledb.wiggleDB_batch.report_finished_batches, options.jobID, config)
 
 		# Housekeeping
 		if options.temps is not None:
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Garbage collection of expired cache entries, preview tiles, failed jobs
+# and the temporary files of finished jobs (wiggleDB.py --clean). Work is
+# done in slices: each slice removes a bounded number of rows in a short
+# write transaction, then deletes the files which no cache entry points to
+# anymore with a pool of threads, outside of any transaction. Temporary
+# files are cleaned first and then marked as such (jobs.temp is cleared),
+# so that every job is only cleaned once. With a time limit, collection
+# stops after the slice which reaches it, and the next run resumes from
+# there. A dry run only lists what would be reclaimed.
+
+import os
+import sys
+import bisect
+import time
+import multiprocessing.pool
+
+import wiggletools.multiJob
+import wiggledb.wiggleDB
+
+verbose = False
+
+###########################################
+## Files
+###########################################
+
+def result_files(location):
+	# Plots are stored next to their data file
+	return [X for X in (location, location + '.png') if os.path.exists(X)]
+
+def temp_files(temps):
+	# The temporary file of each job, and the files derived from its name.
+	# Directories are listed once, rather than globbed for every job.
+	listings = dict()
+	res = []
+	for temp in temps:
+		directory, name = os.path.split(temp)
+		if directory not in listings:
+			try:
+				listings[directory] = sorted(os.listdir(directory or '.'))
+			except OSError:
+				listings[directory] = []
+		listing = listings[directory]
+		index = bisect.bisect_left(listing, name)
+		while index < len(listing) and listing[index].startswith(name):
+			res.append(os.path.join(directory, listing[index]))
+			index += 1
+	return res
+
+def total_size(filenames):
+	res = 0
+	for filename in filenames:
+		try:
+			res += os.path.getsize(filename)
+		except OSError:
+			pass
+	return res
+
+def remove_result(location):
+	filenames = result_files(location)
+	size = total_size(filenames)
+	for filename in filenames:
+		try:
+			os.remove(filename)
+		except OSError:
+			# Already gone
+			pass
+	if verbose:
+		print 'Removed %s' % location
+	return size
+
+def remove_temp(temp):
+	wiggletools.multiJob.clean_temp_file(temp)
+	if verbose:
+		print 'Removed %s and derived files' % temp
+
+###########################################
+## Collection
+###########################################
+
+def placeholders(values):
+	return ",".join('?' for X in values)
+
+class Collector(object):
+	def __init__(self, conn, days, slice_size=500, threads=8, time_limit=None):
+		self.conn = conn
+		self.cursor = conn.cursor()
+		self.horizon = wiggledb.wiggleDB.horizon(days)
+		self.slice_size = slice_size
+		self.threads = threads
+		self.time_limit = time_limit
+		self.start = time.time()
+		self.report = {'cache_entries':0, 'tiles':0, 'failed_jobs':0, 'files':0, 'temps':0, 'bytes':0, 'complete':False}
+
+	def out_of_time(self):
+		return self.time_limit is not None and time.time() - self.start > self.time_limit
+
+	def orphans(self, locations):
+		# Locations which no remaining cache entry points to
+		locations = list(set(X for X in locations if X is not None))
+		if len(locations) == 0:
+			return []
+		referenced = set(X[0] for X in self.cursor.execute('SELECT DISTINCT location FROM cache WHERE location IN (%s)' % placeholders(locations), locations))
+		return [X for X in locations if X not in referenced]
+
+	def drop_cache_entries(self, rows):
+		# Write transaction: removes the entries, returns the files to delete
+		self.cursor.execute('DELETE FROM cache WHERE rowid IN (%s)' % placeholders(rows), [X[0] for X in rows])
+		res = self.orphans([X[1] for X in rows])
+		self.conn.commit()
+		return res
+
+	def expired_entries(self):
+		return self.cursor.execute('SELECT rowid, location FROM cache WHERE remember = 0 AND last_query < datetime(\'now\', ?) LIMIT ?', (self.horizon, self.slice_size)).fetchall()
+
+	def failed_jobs(self):
+		return [X[0] for X in self.cursor.execute('SELECT job_id FROM jobs WHERE status = "ERROR" LIMIT ?', (self.slice_size,)).fetchall()]
+
+	def failed_entries(self, jobIDs):
+		return self.cursor.execute('SELECT rowid, location FROM cache WHERE job_id IN (%s)' % placeholders(jobIDs), jobIDs).fetchall()
+
+	def unclean_jobs(self):
+		return self.cursor.execute('SELECT job_id, temp FROM jobs WHERE status IN ("DONE", "EMPTY") AND temp IS NOT NULL LIMIT ?', (self.slice_size,)).fetchall()
+
+	def slices(self, step):
+		# Runs step until it has nothing left to do or time is up
+		while not self.out_of_time():
+			if step() == 0:
+				return True
+		return False
+
+	def cache_slice(self):
+		rows = self.expired_entries()
+		if len(rows) > 0:
+			self.delete_results(self.drop_cache_entries(rows))
+			self.report['cache_entries'] += len(rows)
+		return len(rows)
+
+	def tile_slice(self):
+		self.cursor.execute('DELETE FROM tiles WHERE rowid IN (SELECT rowid FROM tiles WHERE last_query < datetime(\'now\', ?) LIMIT ?)', (self.horizon, self.slice_size))
+		count = self.cursor.rowcount
+		self.conn.commit()
+		self.report['tiles'] += count
+		return count
+
+	def failed_slice(self):
+		# Failed jobs and their partial results are forgotten
+		jobIDs = self.failed_jobs()
+		if len(jobIDs) > 0:
+			rows = self.failed_entries(jobIDs)
+			self.cursor.execute('DELETE FROM jobs WHERE job_id IN (%s)' % placeholders(jobIDs), jobIDs)
+			if len(rows) > 0:
+				orphans = self.drop_cache_entries(rows)
+			else:
+				orphans = []
+				self.conn.commit()
+			self.delete_results(orphans)
+			self.report['failed_jobs'] += len(jobIDs)
+		return len(jobIDs)
+
+	def temp_slice(self):
+		jobs = self.unclean_jobs()
+		if len(jobs) > 0:
+			temps = [X[1] for X in jobs]
+			self.report['bytes'] += total_size(temp_files(temps))
+			self.pool.map(remove_temp, temps)
+			self.report['temps'] += len(jobs)
+			self.cursor.execute('UPDATE jobs SET temp = NULL WHERE job_id IN (%s)' % placeholders(jobs), [X[0] for X in jobs])
+			self.conn.commit()
+		return len(jobs)
+
+	def delete_results(self, locations):
+		if len(locations) > 0:
+			self.report['bytes'] += sum(self.pool.map(remove_result, locations))
+			self.report['files'] += len(locations)
+
+	def run(self):
+		self.pool = multiprocessing.pool.ThreadPool(self.threads)
+		try:
+			# Anything read before is released before the first write
+			self.conn.commit()
+			self.report['complete'] = all(self.slices(X) for X in (self.cache_slice, self.tile_slice, self.failed_slice, self.temp_slice))
+		finally:
+			self.pool.close()
+			self.pool.join()
+		self.report['seconds'] = time.time() - self.start
+		return self.report
+
+###########################################
+## Dry run
+###########################################
+
+def reclaimable(cursor, days):
+	# Files and sizes which a collection would delete now
+	horizon = wiggledb.wiggleDB.horizon(days)
+	res = []
+	for location, in cursor.execute('''
+	SELECT DISTINCT location FROM cache AS expired
+	WHERE location IS NOT NULL
+	AND (
+		(remember = 0 AND last_query < datetime('now', ?))
+		OR job_id IN (SELECT job_id FROM jobs WHERE status = "ERROR")
+	)
+	AND NOT EXISTS (
+		SELECT 1 FROM cache AS kept LEFT JOIN jobs ON jobs.job_id = kept.job_id
+		WHERE kept.location = expired.location
+		AND (kept.remember != 0 OR kept.last_query >= datetime('now', ?))
+		AND coalesce(jobs.status, '') != "ERROR"
+	)
+	''', (horizon, horizon)).fetchall():
+		for filename in result_files(location):
+			res.append((filename, total_size([filename])))
+	temps = [X[0] for X in cursor.execute('SELECT temp FROM jobs WHERE status IN ("DONE", "EMPTY") AND temp IS NOT NULL').fetchall()]
+	for filename in temp_files(temps):
+		res.append((filename, total_size([filename])))
+	return res
+
+###########################################
+## Entry point
+###########################################
+
+def collect_garbage(conn, days, dry_run=False, time_limit=None, threads=8, slice_size=500):
+	if dry_run:
+		files = reclaimable(conn.cursor(), days)
+		for filename, size in files:
+			print '%s\t%i' % (filename, size)
+		print 'Would reclaim %i bytes in %i files' % (sum(X[1] for X in files), len(files))
+		return None
+	report = Collector(conn, days, slice_size, threads, time_limit).run()
+	if verbose or not report['complete']:
+		print 'Removed %(cache_entries)i cache entries, %(tiles)i tiles and %(failed_jobs)i failed jobs, cleaned %(temps)i jobs, deleted %(files)i results, reclaimed %(bytes)i bytes in %(seconds).1fs' % report
+	if not report['complete']:
+		print >>sys.stderr, 'Stopped after %is, rerun to resume' % time_limit
+	return report
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local batch system. When batch_system is set to local in the config file,
+# jobs are queued in the tasks table of the database, and run by this
+# script on the local machine, with a bounded number of concurrent processes:
+#
+#	wiggleDB_local.py --config /path/to/wiggletools.conf
+#
+# Relevant config keys: local_workers (number of concurrent tasks, default 4),
+# local_memory_limit (address space limit per task in MB, default none) and
+# local_poll_interval (seconds, default 2).
+
+import sys
+import os
+import json
+import time
+import signal
+import argparse
+import sqlite3
+import subprocess
+import tempfile
+import traceback
+
+import wiggledb.wiggleDB_sqlite
+
+verbose = False
+
+###########################################
+## Task queue
+###########################################
+
+def create_task_table(cursor):
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	tasks
+	(
+	task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	cmds text,
+	dependency int,
+	log varchar(1000),
+	status varchar(255),
+	pid int,
+	return_value int,
+	submitted datetime,
+	started datetime,
+	finished datetime
+	)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)')
+
+def submit(cursor, cmds, dependency=None, working_directory=None):
+	# Same return values as wiggletools.multiJob.submit: task ID and log file
+	fh, log = tempfile.mkstemp(suffix='.log', dir=working_directory)
+	os.close(fh)
+	cursor.execute('INSERT INTO tasks (cmds, dependency, log, status, submitted) VALUES (?, ?, ?, "QUEUED", datetime(\'now\'))', (json.dumps(cmds), dependency, log))
+	return cursor.lastrowid, log
+
+def task_status(cursor, taskID):
+	res = cursor.execute('SELECT status, return_value FROM tasks WHERE task_id = ?', (taskID,)).fetchone()
+	if res is None:
+		return 'UNKNOWN', None
+	else:
+		return res
+
+def cancel(cursor, taskID):
+	# Queued tasks are cancelled directly, running ones are killed by the worker
+	cursor.execute('UPDATE tasks SET status = "CANCELLED", finished = datetime(\'now\') WHERE task_id = ? AND status = "QUEUED"', (taskID,))
+	cursor.execute('UPDATE tasks SET status = "CANCELLING" WHERE task_id = ? AND status = "RUNNING"', (taskID,))
+
+###########################################
+## Worker
+###########################################
+
+class Worker(object):
+	def __init__(self, db, workers, memory_limit=None):
+		self.db = db
+		self.workers = workers
+		self.memory_limit = memory_limit
+		self.running = dict()
+
+	def limit_resources(self):
+		# Runs in the child process before exec
+		os.setsid()
+		if self.memory_limit is not None:
+			import resource
+			limit = self.memory_limit * 1024 * 1024
+			resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+	def start(self, cursor, taskID, cmds, log):
+		out = open(log, 'a')
+		process = subprocess.Popen(" && ".join(cmds), shell=True, stdout=out, stderr=subprocess.STDOUT, preexec_fn=self.limit_resources, close_fds=True)
+		out.close()
+		self.running[taskID] = process
+		cursor.execute('UPDATE tasks SET status = "RUNNING", pid = ?, started = datetime(\'now\') WHERE task_id = ?', (process.pid, taskID))
+		# Jobs are started by their compute task, or the one they are attached to
+		cursor.execute('UPDATE jobs SET started = datetime(\'now\') WHERE coalesce(lsf_id, depends_on) = ? AND started IS NULL', (taskID,))
+		if verbose:
+			print 'Started task %i (pid %i): %s' % (taskID, process.pid, " && ".join(cmds))
+
+	def reap(self, cursor):
+		for taskID, process in self.running.items():
+			ret = process.poll()
+			if ret is None:
+				continue
+			del self.running[taskID]
+			if ret == 0:
+				status = 'DONE'
+			elif cursor.execute('SELECT status FROM tasks WHERE task_id = ?', (taskID,)).fetchone()[0] == 'CANCELLING':
+				status = 'CANCELLED'
+			else:
+				status = 'ERROR'
+			cursor.execute('UPDATE tasks SET status = ?, return_value = ?, finished = datetime(\'now\') WHERE task_id = ?', (status, ret, taskID))
+			if verbose:
+				print 'Task %i finished with status %s (%i)' % (taskID, status, ret)
+
+	def kill_cancelled(self, cursor):
+		for taskID, in cursor.execute('SELECT task_id FROM tasks WHERE status = "CANCELLING"').fetchall():
+			if taskID in self.running:
+				try:
+					os.killpg(self.running[taskID].pid, signal.SIGTERM)
+				except OSError:
+					pass
+
+	def skip_orphans(self, cursor):
+		# Tasks depending on a failed or cancelled task can never run
+		cursor.execute('''
+		UPDATE tasks SET status = "CANCELLED", finished = datetime('now')
+		WHERE status = "QUEUED"
+		AND dependency IN (SELECT task_id FROM tasks WHERE status IN ("ERROR", "CANCELLED"))
+		''')
+
+	def launch_ready(self, cursor):
+		free = self.workers - len(self.running)
+		if free <= 0:
+			return
+		ready = cursor.execute('''
+		SELECT task_id, cmds, log FROM tasks
+		WHERE status = "QUEUED"
+		AND (dependency IS NULL OR dependency IN (SELECT task_id FROM tasks WHERE status = "DONE"))
+		ORDER BY task_id
+		LIMIT ?
+		''', (free,)).fetchall()
+		for taskID, cmds, log in ready:
+			self.start(cursor, taskID, json.loads(cmds), log)
+
+	def step(self):
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		cursor = conn.cursor()
+		self.reap(cursor)
+		self.kill_cancelled(cursor)
+		self.skip_orphans(cursor)
+		self.launch_ready(cursor)
+		conn.commit()
+		conn.close()
+
+	def recover(self):
+		# Tasks left running by a previous worker are lost
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		cursor = conn.cursor()
+		create_task_table(cursor)
+		cursor.execute('UPDATE tasks SET status = "ERROR", finished = datetime(\'now\') WHERE status IN ("RUNNING", "CANCELLING")')
+		conn.commit()
+		conn.close()
+
+###########################################
+## Main
+###########################################
+
+def get_options():
+	import wiggledb.wiggleDB
+	parser = argparse.ArgumentParser(description='WiggleDB local batch system.')
+	parser.add_argument('--db', '-d', dest='db', help='Database file')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file')
+	parser.add_argument('--workers','-n',dest='workers',help='Number of concurrent tasks',type=int)
+	parser.add_argument('--memory','-m',dest='memory',help='Address space limit per task, in MB',type=int)
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	options = parser.parse_args()
+
+	if options.config is not None:
+		config = wiggledb.wiggleDB.read_config_file(options.config)
+	else:
+		config = dict()
+	if options.db is None:
+		options.db = config['database_location']
+	if options.workers is None:
+		options.workers = int(config.get('local_workers', 4))
+	if options.memory is None and 'local_memory_limit' in config:
+		options.memory = int(config['local_memory_limit'])
+	options.interval = float(config.get('local_poll_interval', 2))
+
+	global verbose
+	verbose = options.verbose
+	return options
+
+def main():
+	options = get_options()
+	worker = Worker(options.db, options.workers, options.memory)
+	worker.recover()
+	while True:
+		try:
+			worker.step()
+		except sqlite3.Error:
+			traceback.print_exc()
+		sys.stdout.flush()
+		time.sleep(options.interval)
+
+if __name__ == "__main__":
+	main()
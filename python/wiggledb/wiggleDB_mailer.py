@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sends the emails queued in the outbox table, in batches, over a single
+# SMTP connection which is kept open between batches:
+#
+#	wiggleDB_mailer.py --config /path/to/wiggletools.conf
+#
+# Failed messages are retried with exponential backoff. If the server
+# cannot be reached, the rest of the batch is left queued and the
+# connection is retried with the same backoff. Relevant config
+# keys: smtp_server, smtp_port, user and password (no login if unset),
+# smtp_starttls (default true), mail_batch_size (default 50),
+# mail_max_attempts (default 8), mail_retry_delay (seconds, default 60) and
+# mail_idle_timeout (seconds before closing an unused connection, default
+# 60). For testing, any SMTP stand-in will do, e.g.:
+#
+#	python -m smtpd -n -c DebuggingServer localhost:1025
+
+import sys
+import json
+import time
+import socket
+import argparse
+import sqlite3
+import smtplib
+import traceback
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_sqlite
+import wiggledb.wiggleDB_metrics
+
+###########################################
+## Command line interface
+###########################################
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB outgoing mail sender.')
+	parser.add_argument('--db', '-d', dest='db', help='Database file')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file',required=True)
+	parser.add_argument('--interval','-i',dest='interval',help='Seconds between checks of the outbox',type=float,default=5)
+	parser.add_argument('--once',dest='once',help='Send the queued messages then exit',action='store_true')
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	options = parser.parse_args()
+
+	config = wiggledb.wiggleDB.read_config_file(options.config)
+	if options.db is None:
+		options.db = config['database_location']
+	return options, config
+
+###########################################
+## Sender
+###########################################
+
+class Mailer(object):
+	def __init__(self, db, config, verbose=False):
+		self.db = db
+		self.config = config
+		self.verbose = verbose
+		self.batch_size = int(config.get('mail_batch_size', 50))
+		self.max_attempts = int(config.get('mail_max_attempts', 8))
+		self.retry_delay = float(config.get('mail_retry_delay', 60))
+		self.idle_timeout = float(config.get('mail_idle_timeout', 60))
+		self.smtp = None
+		self.last_used = 0
+		# Consecutive failed connections, and when to try again
+		self.connect_failures = 0
+		self.next_connect = 0
+
+	def connect(self):
+		smtp = smtplib.SMTP(self.config['smtp_server'], int(self.config.get('smtp_port', 25)))
+		smtp.ehlo()
+		if self.config.get('smtp_starttls', 'true').lower() != 'false':
+			smtp.starttls()
+			smtp.ehlo()
+		if 'user' in self.config:
+			smtp.login(self.config['user'], self.config['password'])
+		return smtp
+
+	def disconnect(self):
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except (smtplib.SMTPException, socket.error):
+				pass
+			self.smtp = None
+
+	def get_connection(self):
+		# The connection is reused as long as the server keeps it open
+		if self.smtp is not None:
+			try:
+				if self.smtp.noop()[0] != 250:
+					self.disconnect()
+			except (smtplib.SMTPException, socket.error):
+				self.smtp = None
+		if self.smtp is None:
+			self.smtp = self.connect()
+			self.connect_failures = 0
+		self.last_used = time.time()
+		return self.smtp
+
+	def back_off(self, error):
+		self.connect_failures += 1
+		delay = self.retry_delay * 2 ** min(self.connect_failures - 1, self.max_attempts)
+		self.next_connect = time.time() + delay
+		if self.verbose:
+			print 'Could not connect to %s, retrying in %is: %s' % (self.config['smtp_server'], delay, error)
+
+	def queued_messages(self):
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		try:
+			return conn.execute('SELECT message_id, sender, recipients, message, attempts FROM outbox WHERE status = "QUEUED" AND next_attempt <= datetime(\'now\') ORDER BY message_id LIMIT ?', (self.batch_size,)).fetchall()
+		finally:
+			conn.close()
+
+	def send(self, messages):
+		# Returns the outcome of each message sent, the SMTP conversation
+		# happens outside of any database transaction. Messages are not
+		# charged for connections which fail, those left over keep their
+		# place in the queue.
+		res = []
+		for messageID, sender, recipients, message, attempts in messages:
+			try:
+				smtp = self.get_connection()
+			except (smtplib.SMTPException, socket.error) as e:
+				self.back_off(e)
+				break
+			try:
+				with wiggledb.wiggleDB_metrics.timer('smtp_send_seconds'):
+					smtp.sendmail(sender, json.loads(recipients), message)
+				res.append((messageID, 'SENT', attempts + 1, None))
+			except smtplib.SMTPRecipientsRefused as e:
+				res.append((messageID, 'FAILED', attempts + 1, str(e)))
+			except (smtplib.SMTPException, socket.error) as e:
+				self.disconnect()
+				if attempts + 1 >= self.max_attempts:
+					res.append((messageID, 'FAILED', attempts + 1, str(e)))
+				else:
+					res.append((messageID, 'QUEUED', attempts + 1, str(e)))
+		return res
+
+	def record_results(self, cursor, results):
+		for messageID, status, attempts, error in results:
+			if status == 'SENT':
+				cursor.execute('UPDATE outbox SET status = ?, attempts = ?, error = NULL, sent = datetime(\'now\') WHERE message_id = ?', (status, attempts, messageID))
+			else:
+				delay = '+%i seconds' % (self.retry_delay * 2 ** (attempts - 1))
+				cursor.execute('UPDATE outbox SET status = ?, attempts = ?, error = ?, next_attempt = datetime(\'now\', ?) WHERE message_id = ?', (status, attempts, error, delay, messageID))
+
+	def step(self):
+		messages = self.queued_messages()
+		if len(messages) == 0:
+			if self.smtp is not None and time.time() - self.last_used > self.idle_timeout:
+				self.disconnect()
+			return []
+		if time.time() < self.next_connect:
+			return []
+		results = self.send(messages)
+		wiggledb.wiggleDB_sqlite.write(self.db, self.record_results, results)
+		for messageID, status, attempts, error in results:
+			wiggledb.wiggleDB_metrics.increment('emails_total', status=status)
+			if self.verbose:
+				print '%i\t%s\t%i\t%s' % (messageID, status, attempts, error)
+		return results
+
+###########################################
+## Main
+###########################################
+
+def main():
+	options, config = get_options()
+	wiggledb.wiggleDB_metrics.configure(config, options.db)
+	mailer = Mailer(options.db, config, options.verbose)
+	while True:
+		try:
+			results = mailer.step()
+		except sqlite3.Error:
+			if options.once:
+				raise
+			traceback.print_exc()
+			results = []
+		wiggledb.wiggleDB_metrics.maybe_flush()
+		sys.stdout.flush()
+		# Full batches are followed up immediately
+		if len(results) < mailer.batch_size:
+			if options.once:
+				break
+			time.sleep(options.interval)
+	mailer.disconnect()
+
+if __name__ == "__main__":
+	main()
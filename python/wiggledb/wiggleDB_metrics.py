@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Counters and timings of the hot paths: dataset selection, cache lookups,
+# job submission, scheduler polls, SMTP sends and result uploads. They are
+# off unless the config file sets metrics to true, in which case each
+# process accumulates them in memory and adds them to the metrics table on
+# exit, or every metrics_flush_interval seconds (default 10) in long
+# running processes, so that the figures of the servers, finish jobs and
+# daemons add up. Job counts, queue waits and run times are read from the
+# jobs table when reporting:
+#
+#	wiggleDB.py --db database.sqlite3 --stats
+#	wiggleDB.py --db database.sqlite3 --stats prometheus
+#
+# The latter is also served by wiggleWSGI.py under ?metrics, for scraping.
+
+import sys
+import time
+import atexit
+import sqlite3
+import functools
+import threading
+
+import wiggledb.wiggleDB_sqlite
+
+PREFIX = 'wiggledb_'
+
+enabled = False
+database = None
+flush_interval = 10
+last_flush = time.time()
+
+# (name, labels) -> [count, total]
+values = dict()
+values_lock = threading.Lock()
+
+###########################################
+## Configuration
+###########################################
+
+def configure(config, db=None):
+	global enabled, database, flush_interval
+	if enabled or config is None or config.get('metrics', 'false').lower() != 'true':
+		return
+	database = db or config['database_location']
+	flush_interval = float(config.get('metrics_flush_interval', 10))
+	enabled = True
+	atexit.register(flush)
+
+def create_metrics_table(cursor):
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	metrics
+	(
+	name varchar(255),
+	labels varchar(1000),
+	count int,
+	total real,
+	PRIMARY KEY (name, labels)
+	)
+	''')
+
+###########################################
+## Recording
+###########################################
+
+def format_labels(labels):
+	return ",".join('%s="%s"' % (X, labels[X]) for X in sorted(labels))
+
+def record(name, labels, count, total):
+	key = (name, format_labels(labels))
+	with values_lock:
+		entry = values.setdefault(key, [0, 0.0])
+		entry[0] += count
+		entry[1] += total
+
+def increment(name, value=1, **labels):
+	if enabled:
+		record(name, labels, value, value)
+
+def observe(name, seconds, **labels):
+	if enabled:
+		record(name, labels, 1, seconds)
+
+class Timer(object):
+	def __init__(self, name, labels):
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		record(self.name, self.labels, 1, time.time() - self.start)
+
+class NullTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		pass
+
+NULL_TIMER = NullTimer()
+
+def timer(name, **labels):
+	# with timer('x_seconds'): ...
+	if enabled:
+		return Timer(name, labels)
+	return NULL_TIMER
+
+def timed(name, **labels):
+	# Decorator, costs a global lookup per call when metrics are off
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return function(*args, **kwargs)
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				record(name, labels, 1, time.time() - start)
+		return wrapper
+	return decorator
+
+###########################################
+## Storing
+###########################################
+
+def add_values(cursor, snapshot):
+	for (name, labels), (count, total) in snapshot.items():
+		cursor.execute('UPDATE metrics SET count = count + ?, total = total + ? WHERE name = ? AND labels = ?', (count, total, name, labels))
+		if cursor.rowcount == 0:
+			cursor.execute('INSERT INTO metrics (name, labels, count, total) VALUES (?, ?, ?, ?)', (name, labels, count, total))
+
+def flush():
+	global values, last_flush
+	with values_lock:
+		snapshot = values
+		values = dict()
+		last_flush = time.time()
+	if len(snapshot) == 0 or database is None:
+		return
+	try:
+		wiggledb.wiggleDB_sqlite.write(database, add_values, snapshot)
+	except sqlite3.Error as e:
+		# Metrics are never worth failing a request or a job
+		print >>sys.stderr, 'Could not store metrics: %s' % e
+
+def maybe_flush():
+	if enabled and time.time() - last_flush > flush_interval:
+		flush()
+
+###########################################
+## Reporting
+###########################################
+
+def stored_values(cursor):
+	return cursor.execute('SELECT name, labels, count, total FROM metrics ORDER BY name, labels').fetchall()
+
+def job_counts(cursor):
+	return cursor.execute('SELECT status, count(*) FROM jobs GROUP BY status ORDER BY status').fetchall()
+
+def job_durations(cursor, start, end):
+	# Number, sum and max of the durations in seconds, over the jobs which
+	# have both time stamps
+	return cursor.execute('SELECT count(*), coalesce(sum(duration), 0), max(duration) FROM (SELECT (julianday(%s) - julianday(%s)) * 86400 AS duration FROM jobs WHERE %s IS NOT NULL AND %s IS NOT NULL)' % (end, start, start, end)).fetchone()
+
+JOB_DURATIONS = [
+	('job_queue_seconds', 'submitted', 'started'),
+	('job_run_seconds', 'started', 'finished'),
+	('job_turnaround_seconds', 'submitted', 'finished')
+]
+
+# Whole requests found in the cache, and the reductions and nodes they are
+# computed from, reported apart
+CACHE_LOOKUPS = [
+	('Result cache hit ratio', 'result_cache_lookups_total'),
+	('Intermediate cache hit ratio', 'intermediate_cache_lookups_total')
+]
+
+def prometheus_report(cursor):
+	lines = []
+	names = set()
+	for name, labels, count, total in stored_values(cursor):
+		if name not in names:
+			names.add(name)
+			lines.append('# TYPE %s%s %s' % (PREFIX, name, 'summary' if name.endswith('_seconds') else 'counter'))
+		if name.endswith('_seconds'):
+			lines.append('%s%s_count{%s} %i' % (PREFIX, name, labels, count))
+			lines.append('%s%s_sum{%s} %.6f' % (PREFIX, name, labels, total))
+		else:
+			lines.append('%s%s{%s} %i' % (PREFIX, name, labels, count))
+
+	lines.append('# TYPE %sjobs gauge' % PREFIX)
+	for status, count in job_counts(cursor):
+		lines.append('%sjobs{status="%s"} %i' % (PREFIX, status, count))
+	for name, start, end in JOB_DURATIONS:
+		count, total, maximum = job_durations(cursor, start, end)
+		lines.append('# TYPE %s%s summary' % (PREFIX, name))
+		lines.append('%s%s_count %i' % (PREFIX, name, count))
+		lines.append('%s%s_sum %.6f' % (PREFIX, name, total))
+	return "\n".join(X.replace('{}', '') for X in lines) + "\n"
+
+def text_report(cursor):
+	lines = ['Jobs:']
+	for status, count in job_counts(cursor):
+		lines.append('\t%s\t%i' % (status, count))
+	for name, start, end in JOB_DURATIONS:
+		count, total, maximum = job_durations(cursor, start, end)
+		if count > 0:
+			lines.append('\t%s\tmean %.1fs\tmax %.1fs\tover %i jobs' % (name, total / count, maximum, count))
+
+	stored = stored_values(cursor)
+	for title, counter in CACHE_LOOKUPS:
+		lookups = [(labels, count) for name, labels, count, total in stored if name == counter]
+		if len(lookups) > 0:
+			# Anything but a miss saves a computation
+			hits = sum(count for labels, count in lookups if 'result="miss"' not in labels)
+			total = sum(count for labels, count in lookups)
+			lines.append('%s:\t%.3f (%i/%i)' % (title, float(hits) / total, hits, total))
+
+	lines.append('Counters:')
+	for name, labels, count, total in stored:
+		if not name.endswith('_seconds'):
+			lines.append('\t%s{%s}\t%i' % (name, labels, count))
+	lines.append('Timings:')
+	for name, labels, count, total in stored:
+		if name.endswith('_seconds'):
+			lines.append('\t%s{%s}\t%i calls\tmean %.4fs\ttotal %.3fs' % (name, labels, count, total / count, total))
+	return "\n".join(X.replace('{}', '') for X in lines)
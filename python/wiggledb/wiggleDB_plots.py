@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Streaming post-processing for the finish step. The histogram and
+# apply_paste commands write to stdout, which is copied to the result file
+# while being parsed, block by block, into numeric arrays. Outputs without
+# any numbers are reported as empty, the others are plotted by wigglePlots,
+# as all WiggleDB plots. numpy is optional: without it, blocks are parsed
+# in pure Python.
+
+import array
+import subprocess
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+BLOCK_SIZE = 1 << 20
+
+###########################################
+## Parsing
+###########################################
+
+def concatenate(blocks):
+	# Blocks are only joined once the whole output is parsed
+	if numpy is not None:
+		if len(blocks) == 0:
+			return numpy.zeros(0)
+		return numpy.concatenate(blocks)
+	res = array.array('d')
+	for block in blocks:
+		res.extend(block)
+	return res
+
+class HistogramParser(object):
+	# Rows of numbers: bin value, then one count per set
+	def __init__(self):
+		self.width = None
+		self.blocks = []
+
+	def feed(self, block):
+		if self.width is None:
+			self.width = len(block.split('\n', 1)[0].split())
+		if numpy is not None:
+			self.blocks.append(numpy.fromstring(block, sep=' '))
+		else:
+			self.blocks.append(array.array('d', (float(X) for X in block.split())))
+
+	def values(self):
+		return concatenate(self.blocks)
+
+	def rows(self):
+		if not self.width:
+			return 0
+		return len(self.values()) // self.width
+
+class OverlapParser(object):
+	# Region lines, with the statistic appended in the last column
+	def __init__(self):
+		self.blocks = []
+
+	def feed(self, block):
+		self.blocks.append(array.array('d', (float(line.rsplit(None, 1)[-1]) for line in block.split('\n') if line.strip() != '')))
+
+	def values(self):
+		return concatenate(self.blocks)
+
+def stream_wiggletools(cmd, destination, parser):
+	# The destination of the command (its first argument) is replaced by
+	# stdout, the output is copied to the destination file and only complete
+	# lines are handed to the parser
+	words = cmd.split()
+	p = subprocess.Popen(['wiggletools', words[0], '-'] + words[2:], stdout=subprocess.PIPE)
+	out = open(destination, 'w')
+	size = 0
+	remainder = ''
+	while True:
+		block = p.stdout.read(BLOCK_SIZE)
+		if len(block) == 0:
+			break
+		out.write(block)
+		size += len(block)
+		block = remainder + block
+		end = block.rfind('\n') + 1
+		remainder = block[end:]
+		if end > 0:
+			parser.feed(block[:end])
+	if remainder.strip() != '':
+		parser.feed(remainder)
+	out.close()
+	assert p.wait() == 0, 'Failed to run wiggletools %s' % cmd
+	return size
+
+###########################################
+## Plots
+###########################################
+
+def make_histogram(cmd, destination, labels):
+	# Returns False if the command produced no numbers
+	parser = HistogramParser()
+	if stream_wiggletools(cmd, destination, parser) == 0 or parser.rows() == 0:
+		return False
+	import wiggletools.wigglePlots
+	wiggletools.wigglePlots.make_histogram(destination, labels, destination + ".png", format='png')
+	return True
+
+def make_overlaps(cmd, destination):
+	parser = OverlapParser()
+	if stream_wiggletools(cmd, destination, parser) == 0 or len(parser.values()) == 0:
+		return False
+	import wiggletools.wigglePlots
+	wiggletools.wigglePlots.make_overlaps(destination, destination + ".png", format='png')
+	return True
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Polls the batch system once per interval for all the jobs which are still
+# running, and writes their status back into the jobs table. Once a job has
+# been polled, query_result answers from the database without calling
+# qstat/qacct/bjobs itself.
+#
+# The scheduler commands can be overridden in the config file (qstat, qacct
+# and bjobs keys), e.g. to point at stub scripts when testing.
+
+import sys
+import json
+import time
+import argparse
+import sqlite3
+import subprocess
+import traceback
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_sqlite
+import wiggledb.wiggleDB_metrics
+
+###########################################
+## Command line interface
+###########################################
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB batch system status poller.')
+	parser.add_argument('--db', '-d', dest='db', help='Database file')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file')
+	parser.add_argument('--interval','-i',dest='interval',help='Seconds between polls',type=float,default=30)
+	parser.add_argument('--once',dest='once',help='Poll once then exit',action='store_true')
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	options = parser.parse_args()
+
+	if options.config is not None:
+		config = wiggledb.wiggleDB.read_config_file(options.config)
+		if options.db is None:
+			options.db = config['database_location']
+	else:
+		config = dict()
+	assert options.db is not None, 'No database specified'
+	return options, config
+
+###########################################
+## Scheduler queries
+###########################################
+
+def run_command(cmd):
+	p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	(stdout, stderr) = p.communicate()
+	return p.returncode, stdout
+
+@wiggledb.wiggleDB_metrics.timed('scheduler_poll_seconds', command='qstat')
+def sge_running_jobs(qstat):
+	# One call lists every job known to the scheduler, with its state
+	ret, stdout = run_command([qstat, '-u', '*'])
+	assert ret == 0, 'Error when listing SGE jobs'
+	running = dict()
+	for line in stdout.split('\n'):
+		items = line.split()
+		if len(items) > 0 and items[0].isdigit():
+			running[int(items[0])] = items[4] if len(items) > 4 else ''
+	return running
+
+@wiggledb.wiggleDB_metrics.timed('scheduler_poll_seconds', command='bjobs')
+def lsf_job_states(bjobs, lsfIDs):
+	# bjobs exits with an error if any of the jobs is unknown, the others are still reported
+	ret, stdout = run_command([bjobs, '-noheader', '-a'] + [str(X) for X in lsfIDs])
+	states = dict()
+	for line in stdout.split('\n'):
+		items = line.split()
+		if len(items) > 2 and items[0].isdigit():
+			states[int(items[0])] = items[2]
+	return states
+
+###########################################
+## Status updates
+###########################################
+
+class Poller(object):
+	def __init__(self, db, config):
+		self.db = db
+		self.batch_system = config.get('batch_system', 'SGE')
+		self.qstat = config.get('qstat', 'qstat')
+		self.qacct = config.get('qacct', 'qacct')
+		self.bjobs = config.get('bjobs', 'bjobs')
+		# Accounting records of finished compute steps, which never change
+		self.accounted = dict()
+		# Jobs whose compute step was seen running in the last poll
+		self.started = []
+
+	def launched_jobs(self, cursor):
+		# Jobs attached to others wait on the compute step of their owner
+		return cursor.execute('SELECT job_id, coalesce(lsf_id, depends_on), lsf_id2 FROM jobs WHERE status = "LAUNCHED" AND lsf_id2 IS NOT NULL').fetchall()
+
+	def sge_return_values(self, lsfID):
+		if lsfID not in self.accounted:
+			try:
+				self.accounted[lsfID] = wiggledb.wiggleDB.sge_job_return_values(lsfID, qacct=self.qacct)
+			except AssertionError:
+				# Accounting is written with a delay after the job ends
+				return None
+		return self.accounted[lsfID]
+
+	def sge_status(self, running, jobID, lsfID, lsfID2):
+		if lsfID is not None and 'r' in running.get(lsfID, ''):
+			self.started.append(jobID)
+		if lsfID2 in running and (lsfID is None or lsfID in running):
+			return 'WAITING', None
+		elif lsfID2 in running:
+			values = self.sge_return_values(lsfID)
+		else:
+			values = self.sge_return_values(lsfID2)
+
+		if values is not None and any(X != '0' for X in values):
+			return 'ERROR', values
+		else:
+			return 'WAITING', values
+
+	def statuses(self, jobs):
+		if self.batch_system == 'SGE':
+			running = sge_running_jobs(self.qstat)
+			return [(jobID,) + self.sge_status(running, jobID, lsfID, lsfID2) for jobID, lsfID, lsfID2 in jobs]
+		elif self.batch_system == 'LSF':
+			states = lsf_job_states(self.bjobs, [X[2] for X in jobs] + [X[1] for X in jobs if X[1] is not None])
+			res = []
+			for jobID, lsfID, lsfID2 in jobs:
+				if states.get(lsfID) == 'RUN':
+					self.started.append(jobID)
+				if states.get(lsfID2) == 'EXIT':
+					res.append((jobID, 'ERROR', [states[lsfID2]]))
+				elif lsfID2 in states:
+					res.append((jobID, 'WAITING', [states[lsfID2]]))
+				else:
+					res.append((jobID, 'WAITING', None))
+			return res
+		else:
+			return []
+
+	def poll(self):
+		conn = wiggledb.wiggleDB_sqlite.connect(self.db)
+		cursor = conn.cursor()
+		jobs = self.launched_jobs(cursor)
+		if len(jobs) == 0:
+			conn.close()
+			return []
+
+		self.started = []
+		res = self.statuses(jobs)
+		for jobID, status, values in res:
+			if values is None:
+				encoded = None
+			else:
+				encoded = json.dumps(values)
+			cursor.execute('UPDATE jobs SET batch_status = ?, return_values = ?, polled = datetime(\'now\') WHERE job_id = ?', (status, encoded, jobID))
+			if status == 'ERROR':
+				cursor.execute('UPDATE jobs SET status = "ERROR", finished = datetime(\'now\') WHERE job_id = ? AND status = "LAUNCHED"', (jobID,))
+		for jobID in self.started:
+			cursor.execute('UPDATE jobs SET started = datetime(\'now\') WHERE job_id = ? AND started IS NULL', (jobID,))
+		conn.commit()
+		conn.close()
+
+		launched = set(X[1] for X in jobs if X[1] is not None) | set(X[2] for X in jobs)
+		for lsfID in self.accounted.keys():
+			if lsfID not in launched:
+				del self.accounted[lsfID]
+		return res
+
+###########################################
+## Main
+###########################################
+
+def main():
+	options, config = get_options()
+	wiggledb.wiggleDB_metrics.configure(config, options.db)
+	poller = Poller(options.db, config)
+	while True:
+		try:
+			res = poller.poll()
+		except (AssertionError, OSError, sqlite3.Error):
+			if options.once:
+				raise
+			traceback.print_exc()
+			res = []
+		wiggledb.wiggleDB_metrics.maybe_flush()
+		if options.verbose:
+			for jobID, status, values in res:
+				print '%i\t%s\t%s' % (jobID, status, values)
+			sys.stdout.flush()
+		if options.once:
+			break
+		time.sleep(options.interval)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-chromosome runs of the wiggletools commands which parallelWiggleTools
+# cannot take: commands which wait on another batch job, e.g. a computation
+# in flight they are attached to, and commands which also write
+# intermediate results. The chromosomes are submitted as one step, held
+# until the job waited on is done. Every file written by a command,
+# including the nested writes, gets one part per chromosome. Once all the
+# chromosomes are computed, the parts of each file are merged as
+# parallelWiggleTools merges its output: concatenated and converted to
+# bigWig, or flagged with a .empty file if there was nothing to write.
+# Commands which do not start with a write, e.g. profiles, run over the
+# whole genome in a single job.
+#
+# As for parallelWiggleTools, wigToBigWig must be in the PATH of the jobs.
+
+import wiggletools.multiJob
+
+###########################################
+## Plan
+###########################################
+
+def chromosomes(chrom_sizes):
+	res = []
+	for line in open(chrom_sizes):
+		items = line.split()
+		if len(items) >= 2:
+			res.append((items[0], int(items[1])))
+	return res
+
+def written_files(cmd):
+	tokens = cmd.split()
+	return [tokens[X + 1] for X in range(len(tokens) - 1) if tokens[X] == 'write']
+
+def nested_writes(cmd):
+	return len(written_files(cmd)) > 1
+
+def chromosome_part(location, chrom):
+	return '%s.%s.wig' % (location, chrom)
+
+def split_command(cmd, chrom, length):
+	tokens = cmd.split()
+	for index in range(len(tokens) - 1):
+		if tokens[index] == 'write':
+			tokens[index + 1] = chromosome_part(tokens[index + 1], chrom)
+	# The whole expression is restricted to the chromosome, nested writes
+	# included
+	return " ".join(tokens[:2] + ['seek', chrom, '1', str(length)] + tokens[2:])
+
+def merge_command(location, chroms, chrom_sizes):
+	parts = [chromosome_part(location, X[0]) for X in chroms]
+	wig = location + '.wig'
+	return 'cat %s > %s && rm -f %s && if [ -s %s ]; then wigToBigWig %s %s %s && rm %s; else touch %s.empty && rm %s; fi' % (" ".join(parts), wig, " ".join(parts), wig, wig, chrom_sizes, location, wig, location, wig)
+
+def plan(cmds, chrom_sizes):
+	# Returns the commands of the per-chromosome step, and of the merge step
+	chroms = chromosomes(chrom_sizes)
+	compute = []
+	merge = []
+	for cmd in cmds:
+		if cmd.split()[0] != 'write':
+			compute.append('wiggletools ' + cmd)
+			continue
+		compute.extend('wiggletools ' + split_command(cmd, chrom, length) for chrom, length in chroms)
+		merge.extend(merge_command(X, chroms, chrom_sizes) for X in written_files(cmd))
+	return compute, merge
+
+###########################################
+## Submission
+###########################################
+
+def run(cmds, chrom_sizes, batch_system, working_directory, dependency=None):
+	# Same return values as parallelWiggleTools.run: the batch job to wait on
+	# and the temporary files
+	compute, merge = plan(cmds, chrom_sizes)
+	computeID, computeTemp = wiggletools.multiJob.submit(compute, batch_system=batch_system, dependency=dependency, working_directory=working_directory)
+	if len(merge) == 0:
+		return computeID, [computeTemp]
+	mergeID, mergeTemp = wiggletools.multiJob.submit(merge, batch_system=batch_system, dependency=computeID, working_directory=working_directory)
+	return mergeID, [computeTemp, mergeTemp]
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared access to the SQLite database, used by every process which opens
+# it (CGI/WSGI server, finish jobs, poller, local workers, mailer, cron).
+# Connections are in WAL mode, so that readers never wait on writers, wait
+# for locks instead of failing at once, and take the write lock at the
+# start of a write transaction rather than upgrading a read lock halfway.
+# Short write transactions from other processes go through write(), which
+# retries the whole transaction if the database is still busy.
+
+import time
+import random
+import sqlite3
+
+BUSY_TIMEOUT = 30
+RETRIES = 5
+RETRY_DELAY = 0.1
+CACHED_STATEMENTS = 256
+
+def is_busy(error):
+	message = str(error)
+	return 'locked' in message or 'busy' in message
+
+def retry(function, *args):
+	# Retries a function which failed because the database was busy
+	for attempt in range(RETRIES):
+		try:
+			return function(*args)
+		except sqlite3.OperationalError as e:
+			if not is_busy(e) or attempt == RETRIES - 1:
+				raise
+			time.sleep(RETRY_DELAY * 2 ** attempt * (1 + random.random()))
+
+def open_connection(db, timeout):
+	conn = sqlite3.connect(db, timeout=timeout, cached_statements=CACHED_STATEMENTS)
+	# The journal mode is stored in the database file, so this is only a
+	# check once it has been set
+	conn.execute('PRAGMA journal_mode=WAL')
+	conn.execute('PRAGMA synchronous=NORMAL')
+	conn.isolation_level = 'IMMEDIATE'
+	return conn
+
+def connect(db, timeout=BUSY_TIMEOUT):
+	return retry(open_connection, db, timeout)
+
+def lock(cursor):
+	# Takes the write lock now rather than at the first write of the
+	# transaction, so that what is read next cannot change before the
+	# commit. The sqlite3 module opens the transaction before any write,
+	# even one which changes nothing, and this works within a transaction
+	# already open, where BEGIN IMMEDIATE would fail.
+	cursor.execute('UPDATE jobs SET job_id = job_id WHERE 0')
+
+def write(db, function, *args):
+	# Runs function(cursor, *args) in its own transaction, and returns its
+	# result
+	def transaction():
+		conn = connect(db)
+		try:
+			res = function(conn.cursor(), *args)
+			conn.commit()
+			return res
+		except:
+			conn.rollback()
+			raise
+		finally:
+			conn.close()
+	return retry(transaction)
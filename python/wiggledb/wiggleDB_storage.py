@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Long term storage of results. The backend is chosen by the storage key of
+# the config file, which defaults to s3 when s3_bucket is set, local
+# otherwise:
+#	- local: results stay in the working directory, or are copied to
+#	storage_directory, and are served from storage_url if set, as file://
+#	URLs otherwise.
+#	- s3: results are uploaded to s3_bucket, on AWS (s3_region, or the
+#	global endpoint if unset) or any S3 compatible endpoint (s3_endpoint). Files are uploaded in parallel, in
+#	parts of s3_part_size MB (default 64) with s3_concurrency parts in
+#	flight (default 8), with boto3 if installed or the aws command line
+#	otherwise. Failed uploads are retried s3_retries times (default 5).
+
+import os
+import time
+import urllib
+import shutil
+import tempfile
+import threading
+import subprocess
+
+try:
+	import boto3
+	import boto3.s3.transfer
+except ImportError:
+	boto3 = None
+
+###########################################
+## Parallel transfers
+###########################################
+
+def run_parallel(function, locations):
+	# One thread per file, the first error is raised once all are done
+	errors = []
+	def run(location):
+		try:
+			function(location)
+		except Exception as e:
+			errors.append(e)
+	threads = [threading.Thread(target=run, args=(X,)) for X in locations]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if len(errors) > 0:
+		raise errors[0]
+
+def retry(function, location, retries, delay=1):
+	for attempt in range(retries):
+		try:
+			return function(location)
+		except Exception:
+			if attempt == retries - 1:
+				raise
+			time.sleep(delay * 2 ** attempt)
+
+###########################################
+## Backends
+###########################################
+
+class LocalStorage(object):
+	def __init__(self, config):
+		self.directory = config.get('storage_directory')
+		self.base_url = config.get('storage_url')
+
+	def copy(self, location):
+		fh, temp = tempfile.mkstemp(dir=self.directory)
+		os.close(fh)
+		shutil.copyfile(location, temp)
+		os.chmod(temp, 0644)
+		os.rename(temp, os.path.join(self.directory, os.path.basename(location)))
+
+	def store(self, locations):
+		if self.directory is not None:
+			run_parallel(self.copy, locations)
+
+	def path(self, location):
+		if self.directory is None:
+			return os.path.abspath(location)
+		return os.path.abspath(os.path.join(self.directory, os.path.basename(location)))
+
+	def url(self, location):
+		if self.base_url is None:
+			return 'file://' + urllib.pathname2url(self.path(location))
+		return self.base_url.rstrip('/') + '/' + urllib.quote(os.path.basename(location))
+
+class S3Storage(object):
+	def __init__(self, config):
+		self.bucket = config['s3_bucket']
+		self.region = config.get('s3_region')
+		self.endpoint = config.get('s3_endpoint')
+		self.part_size = int(config.get('s3_part_size', 64)) * 1024 * 1024
+		self.concurrency = int(config.get('s3_concurrency', 8))
+		self.retries = int(config.get('s3_retries', 5))
+		if 'aws_config' in config:
+			os.environ['AWS_CONFIG_FILE'] = config['aws_config']
+		self.client = None
+		self.client_lock = threading.Lock()
+
+	def key(self, location):
+		return os.path.basename(location)
+
+	def url(self, location):
+		if self.endpoint is not None:
+			return '%s/%s/%s' % (self.endpoint.rstrip('/'), self.bucket, self.key(location))
+		elif self.region is None:
+			return 'http://s3.amazonaws.com/%s/%s' % (self.bucket, self.key(location))
+		else:
+			return 'http://s3-%s.amazonaws.com/%s/%s' % (self.region, self.bucket, self.key(location))
+
+	def get_client(self):
+		with self.client_lock:
+			if self.client is None:
+				self.client = boto3.session.Session().client('s3', region_name=self.region, endpoint_url=self.endpoint)
+			return self.client
+
+	def upload(self, location):
+		if boto3 is not None:
+			transfer = boto3.s3.transfer.TransferConfig(multipart_threshold=self.part_size, multipart_chunksize=self.part_size, max_concurrency=self.concurrency)
+			self.get_client().upload_file(location, self.bucket, self.key(location), ExtraArgs={'ACL':'public-read'}, Config=transfer)
+		else:
+			cmd = ['aws', 's3', 'cp', location, 's3://%s/%s' % (self.bucket, self.key(location)), '--acl', 'public-read']
+			if self.endpoint is not None:
+				cmd += ['--endpoint-url', self.endpoint]
+			assert subprocess.call(cmd) == 0, 'Failed to upload %s' % location
+
+	def store(self, locations):
+		run_parallel(lambda X: retry(self.upload, X, self.retries), locations)
+
+def get_storage(config):
+	if config.get('storage', 's3' if 's3_bucket' in config else 'local') == 's3':
+		return S3Storage(config)
+	else:
+		return LocalStorage(config)
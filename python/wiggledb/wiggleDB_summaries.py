@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# Copyright 2013 EMBL-EBI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-dataset summaries, computed once when datasets are loaded: for every
+# chromosome, the covered length, sum, sum of squares, min and max of the
+# values at a few bin sizes. Genome wide totals are also stored in the
+# summaries table, so that selection statistics, approximate histograms
+# and cost estimates need not open the bigWig/bigBed files.
+#
+# Each summary is a binary file, memory mapped when read:
+#	- a fixed header (magic, version, length of the index)
+#	- a JSON index with the bin sizes, chromosome lengths, totals and the
+#	offset of each (bin size, chromosome) array
+#	- arrays of little endian float32 records (coverage, sum, sum of
+#	squares, min, max), one per bin. Empty bins have NaN min and max.
+#
+# Relevant config keys: summary_bin_sizes (comma separated, default
+# 100000,1000000,10000000) and wiggletools.
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import tempfile
+import threading
+import subprocess
+import collections
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_region
+
+MAGIC = 'WDBS'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+RECORD = struct.Struct('<5f')
+FIELDS = 5
+NAN = float('nan')
+# Most summaries kept mapped at once, each holds a file descriptor
+MAX_SUMMARIES = 128
+
+verbose = False
+
+# Least recently used first
+summaries = collections.OrderedDict()
+summaries_lock = threading.Lock()
+
+###########################################
+## Records
+###########################################
+
+def empty_record():
+	return [0.0, 0.0, 0.0, NAN, NAN]
+
+def merge_record(record, other):
+	# NaN comparisons are always False, so empty records never win
+	record[0] += other[0]
+	record[1] += other[1]
+	record[2] += other[2]
+	if other[0] > 0 and not other[3] >= record[3]:
+		record[3] = other[3]
+	if other[0] > 0 and not other[4] <= record[4]:
+		record[4] = other[4]
+	return record
+
+###########################################
+## Building summaries
+###########################################
+
+class SummaryBuilder(object):
+	def __init__(self, lengths, bin_sizes):
+		self.lengths = lengths
+		self.bin_sizes = sorted(bin_sizes)
+		self.finest = self.bin_sizes[0]
+		assert all(X % self.finest == 0 for X in self.bin_sizes), 'Bin sizes must be multiples of the smallest one'
+		self.bins = dict()
+
+	def chrom_bins(self, chrom):
+		if chrom not in self.bins:
+			count = (self.lengths[chrom] + self.finest - 1) // self.finest
+			self.bins[chrom] = array.array('d', empty_record() * count)
+		return self.bins[chrom]
+
+	def add(self, chrom, start, end, value):
+		if chrom not in self.lengths:
+			return
+		bins = self.chrom_bins(chrom)
+		position = start
+		while position < end:
+			index = position // self.finest
+			next = min(end, (index + 1) * self.finest)
+			width = next - position
+			offset = index * FIELDS
+			bins[offset] += width
+			bins[offset + 1] += value * width
+			bins[offset + 2] += value * value * width
+			if not bins[offset + 3] <= value:
+				bins[offset + 3] = value
+			if not bins[offset + 4] >= value:
+				bins[offset + 4] = value
+			position = next
+
+	def level(self, chrom, bin_size):
+		finest = self.chrom_bins(chrom)
+		if bin_size == self.finest:
+			return finest
+		factor = bin_size // self.finest
+		count = len(finest) // FIELDS
+		res = array.array('d')
+		for first in range(0, count, factor):
+			record = empty_record()
+			for index in range(first, min(count, first + factor)):
+				merge_record(record, finest[index * FIELDS:(index + 1) * FIELDS])
+			res.extend(record)
+		return res
+
+	def write(self, path):
+		totals = empty_record()
+		offsets = dict()
+		data = []
+		position = 0
+		for bin_size in self.bin_sizes:
+			offsets[str(bin_size)] = dict()
+			for chrom in sorted(self.lengths):
+				values = array.array('f', self.level(chrom, bin_size))
+				offsets[str(bin_size)][chrom] = [position, len(values) // FIELDS]
+				data.append(values)
+				position += len(values) * values.itemsize
+		for chrom in self.lengths:
+			bins = self.chrom_bins(chrom)
+			for index in range(len(bins) // FIELDS):
+				merge_record(totals, bins[index * FIELDS:(index + 1) * FIELDS])
+
+		index = json.dumps({'bin_sizes':self.bin_sizes, 'chroms':self.lengths, 'offsets':offsets, 'totals':totals})
+		# Arrays are aligned on 4 bytes
+		index += ' ' * (-(HEADER.size + len(index)) % 4)
+
+		fh, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+		out = os.fdopen(fh, 'wb')
+		out.write(HEADER.pack(MAGIC, VERSION, len(index)))
+		out.write(index)
+		for values in data:
+			if sys.byteorder != 'little':
+				values.byteswap()
+			values.tofile(out)
+		out.close()
+		os.rename(temp, path)
+		return totals
+
+def summary_path(directory, location):
+	return os.path.join(directory, wiggledb.wiggleDB.query_digest(location) + '.sum')
+
+def summarise_file(location, type, lengths, bin_sizes, path, wiggletools='wiggletools'):
+	# Regions are summarised as coverage, i.e. a value of 1 where covered
+	if type == 'regions':
+		cmd = [wiggletools, 'print', '-', 'unit', location]
+	else:
+		cmd = [wiggletools, 'print', '-', location]
+	builder = SummaryBuilder(lengths, bin_sizes)
+	p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	for line in p.stdout:
+		items = line.split()
+		if len(items) == 4 and items[0] in lengths:
+			builder.add(items[0], int(items[1]), int(items[2]), float(items[3]))
+	stderr = p.stderr.read()
+	assert p.wait() == 0, 'Error when summarising %s: %s' % (location, stderr)
+	return builder.write(path)
+
+def summarise_datasets(conn, directory, config):
+	# Summarises every dataset which does not have a summary yet, one
+	# transaction per dataset so that an interrupted run can be resumed
+	cursor = conn.cursor()
+	bin_sizes = [int(X) for X in config.get('summary_bin_sizes', '100000,1000000,10000000').split(',')]
+	wiggletools = config.get('wiggletools', 'wiggletools')
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+
+	datasets = cursor.execute('SELECT location, type, assembly FROM datasets WHERE location NOT IN (SELECT location FROM summaries)').fetchall()
+	count = 0
+	for location, type, assembly in datasets:
+		path = summary_path(directory, location)
+		try:
+			lengths = wiggledb.wiggleDB_region.get_chrom_lengths(cursor, assembly)
+			totals = summarise_file(location, type, lengths, bin_sizes, path, wiggletools)
+		except (AssertionError, OSError, IOError, IndexError) as e:
+			print >>sys.stderr, 'Could not summarise %s: %s' % (location, e)
+			continue
+		cursor.execute('INSERT OR REPLACE INTO summaries (location, path, coverage, total, total_squares, minimum, maximum) VALUES (?, ?, ?, ?, ?, ?, ?)', [location, path] + [None if X != X else X for X in totals])
+		conn.commit()
+		count += 1
+		if verbose:
+			print 'Summarised %s (%i/%i)' % (location, count, len(datasets))
+	return count
+
+###########################################
+## Reading summaries
+###########################################
+
+def file_stamp(stat):
+	# Summaries are replaced by renaming a new file over the old one
+	return stat.st_ino, stat.st_mtime, stat.st_size
+
+class Summary(object):
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.map, self.stamp = self.open()
+		magic, version, length = HEADER.unpack_from(self.map, 0)
+		assert magic == MAGIC and version == VERSION, 'Not a summary file: %s' % path
+		index = json.loads(self.map[HEADER.size:HEADER.size + length])
+		self.bin_sizes = index['bin_sizes']
+		self.chroms = index['chroms']
+		self.offsets = index['offsets']
+		self.totals = index['totals']
+		self.data_start = HEADER.size + length
+
+	def open(self):
+		f = open(self.path, 'rb')
+		try:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), file_stamp(os.fstat(f.fileno()))
+		finally:
+			f.close()
+
+	def close(self):
+		with self.lock:
+			if self.map is not None:
+				self.map.close()
+				self.map = None
+
+	def read(self, start, end):
+		with self.lock:
+			if self.map is None:
+				# Evicted while still in use
+				self.map, stamp = self.open()
+				assert stamp == self.stamp, 'Summary file changed: %s' % self.path
+			return self.map[start:end]
+
+	def bins(self, chrom, bin_size):
+		# Flat array of records, FIELDS values per bin
+		offset, count = self.offsets[str(bin_size)][chrom]
+		start = self.data_start + offset
+		res = array.array('f')
+		res.fromstring(self.read(start, start + count * RECORD.size))
+		if sys.byteorder != 'little':
+			res.byteswap()
+		return res
+
+	def region(self, chrom, start, end, bin_size=None):
+		# Approximate statistics over a region, at bin resolution
+		if bin_size is None:
+			bin_size = self.bin_sizes[0]
+		bins = self.bins(chrom, bin_size)
+		record = empty_record()
+		for index in range(start // bin_size, min(len(bins) // FIELDS, (end + bin_size - 1) // bin_size)):
+			merge_record(record, bins[index * FIELDS:(index + 1) * FIELDS])
+		return record
+
+def get_summary(path):
+	# Files rewritten since they were mapped are opened again
+	try:
+		stamp = file_stamp(os.stat(path))
+	except OSError:
+		stamp = None
+	with summaries_lock:
+		summary = summaries.pop(path, None)
+		if summary is not None and summary.stamp != stamp:
+			summary.close()
+			summary = None
+		if summary is None:
+			summary = Summary(path)
+		summaries[path] = summary
+		while len(summaries) > MAX_SUMMARIES:
+			summaries.popitem(last=False)[1].close()
+		return summary
+
+def get_summary_paths(cursor, data):
+	res = []
+	for start in range(0, len(data), 500):
+		chunk = data[start:start+500]
+		res.extend(cursor.execute('SELECT location, path FROM summaries WHERE location IN (%s)' % ",".join('?' for X in chunk), chunk).fetchall())
+	return res
+
+def selection_summary(cursor, data):
+	# Genome wide statistics of a selection, from the summaries table alone
+	totals = empty_record()
+	summarised = 0
+	for start in range(0, len(data), 500):
+		chunk = data[start:start+500]
+		res = cursor.execute('SELECT count(*), sum(coverage), sum(total), sum(total_squares), min(minimum), max(maximum) FROM summaries WHERE location IN (%s)' % ",".join('?' for X in chunk), chunk).fetchone()
+		if res[0] > 0:
+			summarised += res[0]
+			merge_record(totals, [X if X is not None else NAN for X in res[1:]])
+	res = {'datasets':len(data), 'summarised':summarised}
+	if totals[0] > 0:
+		res.update({'coverage':totals[0], 'sum':totals[1], 'mean':totals[1] / totals[0], 'min':totals[3], 'max':totals[4]})
+	return res
+
+def approximate_histogram(cursor, data, width=20, bin_size=None):
+	# Distribution of the mean values of the genomic bins of each dataset,
+	# weighted by covered length
+	totals = selection_summary(cursor, data)
+	if 'min' not in totals or totals['max'] <= totals['min']:
+		return None
+	minimum, maximum = totals['min'], totals['max']
+	step = (maximum - minimum) / width
+	counts = [0.0] * width
+	for location, path in get_summary_paths(cursor, data):
+		summary = get_summary(path)
+		level = bin_size or summary.bin_sizes[-1]
+		for chrom in summary.chroms:
+			bins = summary.bins(chrom, level)
+			for index in range(0, len(bins), FIELDS):
+				if bins[index] > 0:
+					bucket = min(width - 1, max(0, int((bins[index + 1] / bins[index] - minimum) / step)))
+					counts[bucket] += bins[index]
+	return {'min':minimum, 'max':maximum, 'counts':counts}